@@ -0,0 +1,226 @@
+'''Precomputed alert tiles, so the hot path is a tile lookup instead of a spatial query.
+
+A user's warnings only change when new trips are ingested. An offline build
+rasterizes every route of a user into square cells of settings.ALERT_TILE_SIZE
+metres in the projected (UTM) plane. Each cell stores the trips whose buffer
+touches it and the events of those trips that can warn somewhere in the cell,
+that is whose point is within settings.ALERT_DISTANCE of it. With
+settings.ALERT_ALONG_ROUTE, SpatialQueries measures that distance along the
+route, and the driver is then within ALERT_DISTANCE plus
+SpatialQueries.match_radius() of where the event lies on the trip's path, so
+events are filed by that position on the path, with that reach. An alert then
+reads the cells under its points in one indexed primary key lookup:
+
+  * a trip matches if it is in the cell of every point, which stands in for
+    ST_Within(line, trip.geom)
+  * the warnings are the last cell's events whose trip matches and, with
+    settings.ALERT_TILE_EXACT, whose filed position is really within reach
+
+Cells are filled conservatively (anything within reach of some point of the cell
+is included), so a trip can only be matched spuriously when the line passes less
+than a cell diagonal outside its buffer. Warnings are never missed.
+
+Ingesting trips drops the user's tiles. Until they are rebuilt, alerts for that
+user fall back to SpatialQueries. Rebuild every user's tiles after changing
+ALERT_ALONG_ROUTE.
+
+Build tiles with:
+  python alert_tiles.py [username ...]
+'''
+import math
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy.sql import and_, select, tuple_
+
+from engine import engine
+from models import AlertTile, AlertTileBuild, User, SpatialQueries as SQ
+from spatial_index import GridIndex, load_history, point_segment_distance
+import projection
+import settings
+
+class TileEvent(object):
+    '''Stands in for a mapped event in tile results; str() gives the same warning.'''
+
+    def __init__(self, event_cls, trip_id, event_id):
+        self.event_cls = event_cls
+        self.trip_id = trip_id
+        self.event_id = event_id
+
+    def __repr__(self):
+        return self.event_cls.message.format(settings.ALERT_DISTANCE)
+
+def event_radius():
+    '''How far from an event's filed position it can warn.'''
+    if settings.ALERT_ALONG_ROUTE:
+        return settings.ALERT_DISTANCE + SQ.match_radius()
+    return settings.ALERT_DISTANCE
+
+def event_position(history, trip_id, event, x, y):
+    '''Where an event is filed: its point, or with settings.ALERT_ALONG_ROUTE
+    where it lies on its trip's path. None if it can't warn.'''
+    if not settings.ALERT_ALONG_ROUTE:
+        return x, y
+    if event.route_distance_m is None:
+        return None
+    xy, distances = history.route(trip_id)
+    return (float(np.interp(event.route_distance_m, distances, xy[:, 0])),
+            float(np.interp(event.route_distance_m, distances, xy[:, 1])))
+
+def rasterize(history, cell_size):
+    '''Computes a user's tiles from their UserHistory.
+
+    Args:
+      history (UserHistory): every trip and event of the user
+      cell_size (float): cell edge in metres
+
+    Returns:
+      dict: (cell_x, cell_y) -> (sorted trip_ids, events), where events is a list
+        of (trip_id, event_type, event_id, x, y) in SpatialQueries' order, and x, y
+        is the event's position from event_position
+    '''
+    grid = GridIndex(cell_size)
+    half_diagonal = cell_size * math.sqrt(2) / 2
+    trip_reach = SQ.match_radius() + half_diagonal
+    event_reach = event_radius() + half_diagonal
+
+    events_grid = GridIndex(settings.ALERT_DISTANCE)
+    for trip_id, trip_events in history.events_by_trip.items():
+        if trip_id not in history.paths:
+            continue
+        for event_type, event, x, y in trip_events:
+            position = event_position(history, trip_id, event, x, y)
+            if position is not None:
+                x, y = position
+                events_grid.insert((event_type, event, x, y), x, y, x, y)
+
+    cell_trips = defaultdict(set)
+    for trip_id, path in history.paths.items():
+        for (ax, ay), (bx, by) in zip(path, path[1:]):
+            min_i, min_j = grid.cell(min(ax, bx) - trip_reach, min(ay, by) - trip_reach)
+            max_i, max_j = grid.cell(max(ax, bx) + trip_reach, max(ay, by) + trip_reach)
+            for i in range(min_i, max_i + 1):
+                for j in range(min_j, max_j + 1):
+                    cx, cy = (i + 0.5) * cell_size, (j + 0.5) * cell_size
+                    if point_segment_distance(cx, cy, ax, ay, bx, by) <= trip_reach:
+                        cell_trips[(i, j)].add(trip_id)
+
+    tiles = {}
+    for (i, j), trip_ids in cell_trips.items():
+        cx, cy = (i + 0.5) * cell_size, (j + 0.5) * cell_size
+        events = []
+        for event_type, event, x, y in events_grid.query(cx, cy, event_reach):
+            if event.trip_id in trip_ids and math.hypot(x - cx, y - cy) <= event_reach:
+                event_id, = SQ.event_classes[event_type].__mapper__\
+                                                        .primary_key_from_instance(event)
+                events.append((event.trip_id, event_type, event_id, x, y))
+        events.sort()
+        tiles[(i, j)] = (sorted(trip_ids), events)
+    return tiles
+
+def build(user_id, cell_size=None):
+    '''Replaces a user's tiles with freshly computed ones.
+
+    Returns:
+      int: number of tiles written
+    '''
+    cell_size = cell_size or settings.ALERT_TILE_SIZE
+    tiles = rasterize(load_history(user_id), cell_size)
+    rows = []
+    for (i, j), (trip_ids, events) in tiles.items():
+        columns = list(zip(*events)) or [()] * 5
+        rows.append(dict(user_id=user_id, cell_x=i, cell_y=j, trip_ids=trip_ids,
+                         event_trip_ids=list(columns[0]), event_types=list(columns[1]),
+                         event_ids=list(columns[2]), event_x=list(columns[3]),
+                         event_y=list(columns[4])))
+    with engine.begin() as connection:
+        delete(connection, user_id)
+        if rows:
+            connection.execute(AlertTile.__table__.insert(), rows)
+        connection.execute(AlertTileBuild.__table__.insert(),
+                           user_id=user_id, cell_size=cell_size, built_at=int(time.time()))
+    return len(rows)
+
+def delete(connection, user_id):
+    connection.execute(AlertTileBuild.__table__.delete()
+                       .where(AlertTileBuild.user_id == user_id))
+    connection.execute(AlertTile.__table__.delete().where(AlertTile.user_id == user_id))
+
+def invalidate(user_id):
+    '''Drops a user's tiles, which are stale once their history changes.'''
+    with engine.begin() as connection:
+        delete(connection, user_id)
+
+class AlertTiles(object):
+    '''Alert backend answering from the tiles; same contract as SpatialQueries.'''
+
+    def __init__(self, cell_size=None, exact=None):
+        self.cell_size = cell_size or settings.ALERT_TILE_SIZE
+        self.exact = settings.ALERT_TILE_EXACT if exact is None else exact
+        self.grid = GridIndex(self.cell_size)
+
+    def tiles(self, user_id, cells):
+        '''Reads the given cells of a user's tiles.
+
+        Returns:
+          dict: (cell_x, cell_y) -> AlertTile row for the cells that exist, or None
+            if the user's tiles haven't been built at this cell size
+        '''
+        builds = AlertTileBuild.__table__
+        tiles = AlertTile.__table__
+        joined = builds.outerjoin(tiles, and_(
+            tiles.c.user_id == builds.c.user_id,
+            tuple_(tiles.c.cell_x, tiles.c.cell_y).in_(list(cells))))
+        s = select([tiles]).select_from(joined)\
+                           .where(builds.c.user_id == user_id)\
+                           .where(builds.c.cell_size == self.cell_size)
+        rows = engine.execute(s).fetchall()
+        if not rows:
+            return None
+        return dict(((row.cell_x, row.cell_y), row) for row in rows if row.cell_x is not None)
+
+    def adjacent_events_from_point_sequence(self, point_group, user_id):
+        if len(point_group) < 2:
+            return []
+        line = projection.to_projected(point_group)
+        line_cells = [self.grid.cell(x, y) for x, y in line]
+        tiles = self.tiles(user_id, set(line_cells))
+        if tiles is None:
+            return SQ.adjacent_events_from_point_sequence(point_group, user_id)
+        matching = None
+        for cell in line_cells:
+            tile = tiles.get(cell)
+            trip_ids = set(tile.trip_ids) if tile is not None else set()
+            matching = trip_ids if matching is None else matching & trip_ids
+        tile = tiles.get(line_cells[-1])
+        if not matching or tile is None:
+            return []
+        x, y = line[-1]
+        events = []
+        for trip_id, event_type, event_id, ex, ey in zip(
+                tile.event_trip_ids, tile.event_types, tile.event_ids,
+                tile.event_x, tile.event_y):
+            if trip_id not in matching:
+                continue
+            if self.exact and math.hypot(ex - x, ey - y) > event_radius():
+                continue
+            events.append(TileEvent(SQ.event_classes[event_type], trip_id, event_id))
+        return events
+
+    def adjacent_events_from_point_sequences(self, probes):
+        '''One tile lookup per probe; each is a single primary key read.'''
+        return [self.adjacent_events_from_point_sequence(point_group, user_id)
+                for point_group, user_id in probes]
+
+alert_tiles = AlertTiles()
+
+if __name__ == '__main__':
+    users = select([User.user_id, User.username])
+    if len(sys.argv) > 1:
+        users = users.where(User.username.in_(sys.argv[1:]))
+    for user_id, username in engine.execute(users).fetchall():
+        start = time.time()
+        count = build(user_id)
+        print('{}: {} tiles in {:.2f}s'.format(username, count, time.time() - start))
@@ -1,12 +1,31 @@
+import numbers
+
 from flask import Flask, request, json, abort, jsonify
 
 from sqlalchemy.sql import select
 
-from engine import engine, session
+from alert_tiles import alert_tiles
+from caching import MISSING, alert_cache, alert_cache_key, user_ids
+from corridors import corridor_queries
+from engine import engine, limit_statement_time, session, Session
 from models import User
 from models import SpatialQueries as SQ
+from spatial_index import spatial_index
+from trip_sessions import trip_sessions
+import prepared
+import settings
 
 app = Flask(__name__)
+limit_statement_time(settings.DB_STATEMENT_TIMEOUT_MS)
+
+# anything with adjacent_events_from_point_sequence(point_group, user_id) and
+# adjacent_events_from_point_sequences(probes)
+alert_backends = {
+    'postgis': SQ,
+    'memory': spatial_index,
+    'tiles': alert_tiles,
+    'corridors': corridor_queries,
+}
 
 class InvalidUsage(Exception):
     status_code = 400
@@ -23,12 +42,57 @@ class InvalidUsage(Exception):
         rv['message'] = self.message
         return rv
 
+@app.teardown_appcontext
+def remove_session(exception=None):
+    '''Hand this thread's session (and its connection) back at the end of a request.'''
+    Session.remove()
+
 @app.errorhandler(InvalidUsage)
 def handle_access_denied(error):
     response = jsonify(error.to_dict());
     response.status_code = error.status_code
     return response
 
+def json_from_request():
+    '''Returns the json query parameter, which must hold a points list, or raises InvalidUsage.'''
+    json_unicode = request.args.get('json')
+    if json_unicode is None:
+        raise InvalidUsage('A json parameter is required', 400)
+    try:
+        json_object = json.loads(json_unicode)
+    except:
+        raise InvalidUsage('Error: malformed json object', 400)
+    points = json_object.get('points')
+    if points is None:
+        # this too!
+        raise InvalidUsage('json must contain a points list', 400)
+    return json_object
+
+def points_from_request():
+    '''Returns the points list from the json query parameter, or raises InvalidUsage.'''
+    return json_from_request()['points']
+
+def is_point_sequence(points):
+    '''True if points is a list of [lat, lon] pairs of numbers.'''
+    return isinstance(points, list) and all(
+        isinstance(point, list) and len(point) == 2 and
+        all(isinstance(value, numbers.Real) and not isinstance(value, bool)
+            for value in point)
+        for point in points)
+
+def user_id_for(username):
+    '''Returns the user_id of username, or None, through caching.user_ids.'''
+    user_id = user_ids.get(username, MISSING)
+    if user_id is MISSING:
+        s = select([User.user_id]).where(User.username == username)
+        if settings.PREPARED_STATEMENTS:
+            user_id = prepared.execute(session.connection(), s).scalar()
+        else:
+            user_id = session.execute(s).scalar()
+        user_ids.put(username, user_id,
+                     settings.USER_ID_NEGATIVE_TTL if user_id is None else None)
+    return user_id
+
 @app.route('/alerts/<username>', methods=['GET'])
 def alerts(username):
     '''This controller will recieve a url with a username and a json object as a parameter.
@@ -41,29 +105,97 @@ def alerts(username):
 
       On success, the json object will contain a list of relevant warnings based on
         proximity to the user.
+
+      If the json object also names a "device", successive pings from that device
+        share a trip session (see trip_sessions.py) instead of being matched from
+        scratch every time. Otherwise warnings are cached per user, position and
+        heading (see caching.py).
     '''
-    s = select([User.user_id]).where(User.username == username)
-    user_id = engine.execute(s).scalar()
+    user_id = user_id_for(username)
     if user_id is None:
         raise InvalidUsage('Please try again with a valid username', status_code=403)
 
-    
-    json_unicode = request.args.get('json')
-    if json_unicode is None:
-        raise InvalidUsage('A json parameter is required', 400)
-    try:
-        json_object = json.loads(json_unicode)
-    except:
-        raise InvalidUsage('Error: malformed json object', 400)
-    points = json_object.get('points')
-    if points is None:
-        # this too!
-        raise InvalidUsage('json must contain a points list', 400)
+    json_object = json_from_request()
+    points = json_object['points']
+    device = json_object.get('device')
+    if isinstance(device, (list, dict)):
+        raise InvalidUsage('device must be a string or a number', 400)
 
-    
-    events = SQ.adjacent_events_from_point_sequence(points, user_id)
-    return_events = [str(event) for event in events]
+    if device is not None:
+        events = trip_sessions.adjacent_events_from_point_sequence(points, user_id, device)
+        return_events = [str(event) for event in events]
+    elif len(points) < 2:
+        return_events = []
+    else:
+        key = alert_cache_key(user_id, points)
+        return_events = alert_cache.get(key)
+        if return_events is None:
+            backend = alert_backends[settings.ALERT_BACKEND]
+            events = backend.adjacent_events_from_point_sequence(points, user_id)
+            return_events = [str(event) for event in events]
+            alert_cache.put(key, return_events)
     return jsonify(**dict(warnings=return_events))
+
+@app.route('/alerts', methods=['POST'])
+def batch_alerts():
+    '''Alerts for many devices at once, for gateways that aggregate pings.
+
+    The request body is a json object like
+      {"devices": [{"username": "...", "points": [[lat, lon], ...]}, ...]}
+
+    All usernames are resolved with one query, and every point sequence is
+    evaluated with one spatial query.
+
+    Returns:
+      str: A serialized json object {"results": [...]}, with one entry per device
+        in request order. An entry holds the username and either "warnings" or, for
+        a device that was rejected, "status" and "message" as /alerts would have
+        returned them. A malformed body is rejected as a whole with a 400.
+    '''
+    json_object = request.get_json(force=True, silent=True)
+    if not isinstance(json_object, dict):
+        raise InvalidUsage('Error: malformed json object', 400)
+    devices = json_object.get('devices')
+    if not isinstance(devices, list) or \
+       not all(isinstance(device, dict) for device in devices):
+        raise InvalidUsage('json must contain a devices list', 400)
+
+    usernames = set(device.get('username') for device in devices
+                    if isinstance(device.get('username'), basestring))
+    device_user_ids = {}
+    if usernames:
+        s = select([User.username, User.user_id]).where(User.username.in_(usernames))
+        device_user_ids = dict(session.execute(s).fetchall())
+
+    results = []
+    probes = []
+    probe_results = []
+    for device in devices:
+        username = device.get('username')
+        points = device.get('points')
+        result = dict(username=username)
+        if not isinstance(username, basestring):
+            result.update(status=400, message='each device must name a username')
+        elif device_user_ids.get(username) is None:
+            result.update(status=403, message='Please try again with a valid username')
+        elif not is_point_sequence(points):
+            result.update(status=400,
+                          message='each device must contain a list of [lat, lon] points')
+        else:
+            probes.append((points, device_user_ids[username]))
+            probe_results.append(result)
+        results.append(result)
+
+    backend = alert_backends[settings.ALERT_BACKEND]
+    for result, events in zip(probe_results,
+                              backend.adjacent_events_from_point_sequences(probes)):
+        result['warnings'] = [str(event) for event in events]
+    return jsonify(**dict(results=results))
     
+@app.route('/stats', methods=['GET'])
+def stats():
+    '''Hit and miss counts of the in-process caches.'''
+    return jsonify(**dict(alert_cache=alert_cache.stats(), user_ids=user_ids.stats()))
+
 if __name__ == '__main__':
     app.run(debug=True)
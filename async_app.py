@@ -0,0 +1,150 @@
+'''Cooperative server for the alerts endpoint, built on gevent.
+
+app.py ties up a worker thread for the whole of every PostGIS call. Importing
+this module monkey patches the standard library and makes psycopg2 yield to
+other greenlets while it waits on the database, so one process can keep
+thousands of requests in flight. The limit becomes the connection pool, not
+the number of threads. Python 2 has no asyncio, and gevent with psycogreen is
+the usual way to get non-blocking psycopg2 there.
+
+It also adds /async/alerts/<username>. That route runs the username lookup and
+the spatial query concurrently, on separate connections. The spatial query
+resolves the username in a subquery, so it does not have to wait for the
+lookup. The lookup only decides whether the answer is a 403.
+
+/stream/alerts/<username> is a websocket, for devices that would otherwise poll.
+The device opens it once and pushes its positions, and each one is answered
+with the warnings for where it is now. The user is looked up once per
+connection, and the connection keeps a trip session of its own (see
+trip_sessions.py), so most updates are matched in memory. An idle connection
+is just a greenlet, and holds no database connection. load_test.py measures
+how many one process can serve.
+
+Run with:
+  python async_app.py
+'''
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import itertools
+import json
+from collections import deque
+
+import gevent
+from gevent.pywsgi import WSGIServer
+from geventwebsocket.handler import WebSocketHandler
+from flask import jsonify, request
+from sqlalchemy.sql import select
+
+from app import app, InvalidUsage, points_from_request, user_id_for
+from engine import Session
+from models import User
+from models import SpatialQueries as SQ
+from trip_sessions import trip_sessions
+import settings
+
+# tells the trip sessions of different streaming connections apart
+stream_ids = itertools.count()
+
+def in_own_session(f, *args):
+    '''Runs f in the calling greenlet, then releases that greenlet's session.
+
+    The scoped session is greenlet-local once threading is patched, so every
+    greenlet spawned here checks out its own connection.
+    '''
+    try:
+        return f(*args)
+    finally:
+        Session.remove()
+
+def lookup_user_id(username):
+    s = select([User.user_id]).where(User.username == username)
+    return Session.execute(s).scalar()
+
+def adjacent_events_for_username(point_group, username):
+    '''adjacent_events_from_point_sequence, keyed by username instead of user_id.'''
+    user_id = select([User.user_id]).where(User.username == username).as_scalar()
+    return SQ.adjacent_events_from_point_sequence(point_group, user_id)
+
+@app.route('/async/alerts/<username>', methods=['GET'])
+def async_alerts(username):
+    '''Same contract as app.alerts, including which error wins when several apply.'''
+    user_lookup = gevent.spawn(in_own_session, lookup_user_id, username)
+    try:
+        points = points_from_request()
+    except InvalidUsage:
+        if user_lookup.get() is None:
+            raise InvalidUsage('Please try again with a valid username', status_code=403)
+        raise
+    events = gevent.spawn(in_own_session, adjacent_events_for_username, points, username)
+    gevent.joinall([user_lookup, events], raise_error=True)
+    if user_lookup.value is None:
+        raise InvalidUsage('Please try again with a valid username', status_code=403)
+    return_events = [str(event) for event in events.value]
+    return jsonify(**dict(warnings=return_events))
+
+def serve_stream(ws, user_id):
+    '''Answers a connection's position updates until it closes.
+
+    Each message is a json object like {"points": [[lat, lon], ...]} with the
+    device's newest positions, oldest first. The last settings.STREAM_WINDOW
+    positions received make up the point sequence, so old ones are never sent
+    twice. Every message gets a reply: {"warnings": [...]} as GET /alerts would
+    give for that sequence, or {"status": 400, "message": ...} if the message
+    couldn't be read.
+
+    Args:
+      ws (WebSocket): anything with receive() and send(message)
+      user_id (int): the connection's user
+    '''
+    device = ('stream', next(stream_ids))
+    window = deque(maxlen=settings.STREAM_WINDOW)
+    try:
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            try:
+                points = [(float(lat), float(lon))
+                          for lat, lon in json.loads(message)['points']]
+            except (ValueError, KeyError, TypeError):
+                ws.send(json.dumps(dict(status=400, message='Error: malformed json object')))
+                continue
+            window.extend(points)
+            try:
+                events = trip_sessions.adjacent_events_from_point_sequence(
+                    list(window), user_id, device)
+                warnings = [str(event) for event in events]
+            finally:
+                # don't hold a database connection while the device is quiet
+                Session.remove()
+            ws.send(json.dumps(dict(warnings=warnings)))
+    finally:
+        trip_sessions.discard((user_id, device))
+
+@app.route('/stream/alerts/<username>', methods=['GET'])
+def stream_alerts(username):
+    '''Websocket streaming warnings to one device, see serve_stream.
+
+    The handshake is over by the time this runs, so an unknown username gets
+    {"status": 403, ...} and the socket is closed.
+    '''
+    ws = request.environ.get('wsgi.websocket')
+    if ws is None:
+        raise InvalidUsage('This endpoint needs a websocket connection', 400)
+    try:
+        user_id = user_id_for(username)
+    finally:
+        Session.remove()
+    if user_id is None:
+        ws.send(json.dumps(dict(status=403, message='Please try again with a valid username')))
+    else:
+        serve_stream(ws, user_id)
+    ws.close()
+    return ''
+
+if __name__ == '__main__':
+    WSGIServer(('0.0.0.0', settings.PORT), app,
+               handler_class=WebSocketHandler).serve_forever()
@@ -0,0 +1,257 @@
+'''Rough benchmarks for the alerts endpoint and for ingestion.
+
+These run against the same database as the tests, and clobber it, so only run
+them on a development machine.
+
+Usage:
+  python benchmark.py indexes [max_copies]
+  python benchmark.py load [copies]
+  python benchmark.py threads [max_threads] [seconds]
+  python benchmark.py batch [devices]
+  python benchmark.py geometry [copies]
+  python benchmark.py overhead [repeats]
+  python benchmark.py fleet [max_users] [partitions]
+
+threads serves the app with a threaded WSGI server and only reads the database.
+'''
+import json
+import sys
+import threading
+import time
+from urllib import urlencode
+from urllib2 import urlopen
+
+from sqlalchemy import func
+from sqlalchemy.sql import select, text
+from werkzeug.serving import make_server
+
+from app import app
+from caching import alert_cache, user_ids
+from engine import engine
+from insert import DatabaseManager as DBM
+from models import Trip
+from models import SpatialQueries as SQ
+from parse_inputs import get_json
+import settings
+
+def copied_trips(trips, copy):
+    '''Returns trips with trip_id_strings made unique to this copy.'''
+    batch = []
+    for trip in trips:
+        trip = dict(trip)
+        trip['id'] = '{}_{}'.format(trip['id'], copy)
+        trip['drive_events'] = [dict(event) for event in trip['drive_events']]
+        batch.append(trip)
+    return batch
+
+def load_copies(copies, insert=DBM.insert_json_into_db):
+    '''Reset the database and load data1 `copies` times for settings.USERNAME.
+
+    Every copy gets a distinct trip_id_string, so trip count (and the amount of
+    overlapping route geometry) grows linearly with copies.
+    '''
+    trips = get_json(settings.DATAPATH)
+    DBM.clear_database_and_create_tables()
+    DBM.create_new_user(username=settings.USERNAME)
+    for copy in range(copies):
+        insert(settings.USERNAME, copied_trips(trips, copy))
+    return len([trip for trip in trips if len(trip['path']) > 1]) * copies
+
+def alert_point_groups(trip_id=1, group_size=3):
+    '''The point groups that test_endpoint walks along a route.'''
+    points = SQ.segmentized_line_with_geographic_points(trip_id)
+    point_groups = []
+    for start in range(0, len(points), group_size):
+        point_group = points[start:start + group_size]
+        if len(point_group) < 2:
+            continue
+        point_groups.append([list(p) for p in point_group])
+    return point_groups
+
+def alert_urls(trip_id=1, group_size=3):
+    '''Builds the same /alerts urls that test_endpoint walks along a route.'''
+    urls = []
+    for point_group in alert_point_groups(trip_id, group_size):
+        qs = urlencode(dict(json=json.dumps(dict(points=point_group))))
+        urls.append('/alerts/{}?{}'.format(settings.USERNAME, qs))
+    return urls
+
+def time_requests(client, urls, before=None):
+    '''Returns mean milliseconds per request, calling before() ahead of each one.'''
+    start = time.time()
+    for url in urls:
+        if before is not None:
+            before()
+        rv = client.get(url)
+        assert rv.status_code == 200, rv.status_code
+    return (time.time() - start) * 1000 / len(urls)
+
+def bench_indexes(max_copies=8):
+    '''/alerts latency versus trip count, without and then with spatial indexes.'''
+    client = app.test_client()
+    print('{:>8} {:>16} {:>16}'.format('trips', 'no index (ms)', 'indexed (ms)'))
+    copies = 1
+    while copies <= max_copies:
+        trip_count = load_copies(copies)
+        urls = alert_urls()
+        DBM.drop_indexes()
+        unindexed = time_requests(client, urls)
+        DBM.ensure_indexes()
+        indexed = time_requests(client, urls)
+        print('{:>8} {:>16.1f} {:>16.1f}'.format(trip_count, unindexed, indexed))
+        copies *= 2
+
+def bench_load(copies=10):
+    '''Rows/s of the ORM insert path against the COPY based bulk loader.'''
+    for name, insert in [('orm', DBM.insert_json_into_db),
+                         ('bulk', DBM.bulk_insert_json_into_db)]:
+        start = time.time()
+        trip_count = load_copies(copies, insert)
+        seconds = time.time() - start
+        print('{:>6}: {} trips in {:.2f}s ({:.0f} trips/s)'.format(
+            name, trip_count, seconds, trip_count / seconds))
+
+def bench_threads(max_threads=16, seconds=10):
+    '''Throughput of a threaded server as the number of concurrent clients grows.
+
+    With the per-thread sessions in engine.py this should scale until the
+    connection pool (settings.DB_POOL_SIZE + DB_MAX_OVERFLOW) or the database
+    runs out of room.
+    '''
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    urls = alert_urls()
+
+    def client(deadline, counts, index):
+        i = index
+        while time.time() < deadline:
+            urlopen(base + urls[i % len(urls)]).read()
+            counts[index] += 1
+            i += 1
+
+    print('{:>8} {:>12}'.format('threads', 'requests/s'))
+    threads = 1
+    while threads <= max_threads:
+        counts = [0] * threads
+        deadline = time.time() + seconds
+        clients = [threading.Thread(target=client, args=(deadline, counts, i))
+                   for i in range(threads)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        print('{:>8} {:>12.1f}'.format(threads, sum(counts) / float(seconds)))
+        threads *= 2
+    server.shutdown()
+
+def bench_batch(devices=200):
+    '''One GET per device against a single batch POST for the same devices.'''
+    client = app.test_client()
+    point_groups = alert_point_groups()
+    point_groups = (point_groups * (devices // len(point_groups) + 1))[:devices]
+    urls = alert_urls()
+    urls = (urls * (devices // len(urls) + 1))[:devices]
+    fan_out = time_requests(client, urls) * devices
+    body = json.dumps(dict(devices=[dict(username=settings.USERNAME, points=point_group)
+                                    for point_group in point_groups]))
+    start = time.time()
+    rv = client.post('/alerts', data=body, content_type='application/json')
+    assert rv.status_code == 200, rv.status_code
+    batch = (time.time() - start) * 1000
+    print('{} devices: {:.1f}ms as separate GETs, {:.1f}ms as one batch POST'.format(
+        devices, fan_out, batch))
+
+def bench_geometry(copies=4):
+    '''/alerts latency and trips.geom size, full resolution buffers against prepared ones.'''
+    client = app.test_client()
+    trip_count = load_copies(copies)
+    urls = alert_urls()
+    print('{} trips'.format(trip_count))
+    print('{:>10} {:>12} {:>12} {:>12}'.format('geometry', 'vertices', 'size (kB)', 'ms/request'))
+    for name, simplify in [('raw', False), ('prepared', True)]:
+        DBM.prepare_trip_geometries(simplify=simplify)
+        vertices, size = engine.execute(select([func.sum(func.ST_NPoints(Trip.geom)),
+                                                func.sum(func.ST_MemSize(Trip.geom))])).first()
+        latency = time_requests(client, urls)
+        print('{:>10} {:>12} {:>12.1f} {:>12.1f}'.format(name, vertices, size / 1024.0, latency))
+
+def bench_overhead(repeats=20):
+    '''Per-request cost with and without the username cache and prepared statements.
+
+    The alert cache is emptied before every request, so each one runs the
+    spatial query.
+    '''
+    client = app.test_client()
+    load_copies(1)
+    urls = alert_urls() * repeats
+    print('{:>16} {:>10} {:>12}'.format('username cache', 'prepared', 'ms/request'))
+    try:
+        for cache_usernames in [False, True]:
+            for prepare in [False, True]:
+                settings.PREPARED_STATEMENTS = prepare
+                def before():
+                    alert_cache.invalidate()
+                    if not cache_usernames:
+                        user_ids.invalidate()
+                # warm up, so statements are prepared on the pooled connection
+                time_requests(client, urls[:1], before)
+                print('{:>16} {:>10} {:>12.2f}'.format(
+                    cache_usernames, prepare, time_requests(client, urls, before)))
+    finally:
+        settings.PREPARED_STATEMENTS = True
+
+def bench_fleet(max_users=64, partitions=16):
+    '''/alerts latency for one user as other users' trips pile up.
+
+    Each user gets their own copy of data1, and settings.USERNAME's route is
+    the one requested, with the alert cache emptied before every request. The
+    fleet is grown first with unpartitioned tables, then with trips and events
+    hash partitioned into `partitions` by user_id.
+    '''
+    client = app.test_client()
+    trips = get_json(settings.DATAPATH)
+    latency = {}
+    try:
+        for partition_count in [0, partitions]:
+            settings.PARTITION_COUNT = partition_count
+            load_copies(1, DBM.bulk_insert_json_into_db)
+            urls = alert_urls()
+            loaded = 1
+            users = 1
+            while users <= max_users:
+                while loaded < users:
+                    username = 'fleet_{}'.format(loaded)
+                    DBM.create_new_user(username=username)
+                    DBM.bulk_insert_json_into_db(username, copied_trips(trips, loaded))
+                    loaded += 1
+                engine.execute(text('ANALYZE').execution_options(autocommit=True))
+                latency.setdefault(partition_count, []).append(
+                    (users, time_requests(client, urls, alert_cache.invalidate)))
+                users *= 2
+    finally:
+        settings.PARTITION_COUNT = 0
+    trip_count = len([trip for trip in trips if len(trip['path']) > 1])
+    print('{:>8} {:>8} {:>20} {:>20}'.format('users', 'trips', 'unpartitioned (ms)',
+                                           '{} partitions (ms)'.format(partitions)))
+    for (users, unpartitioned), (_, partitioned) in zip(latency[0], latency[partitions]):
+        print('{:>8} {:>8} {:>20.1f} {:>20.1f}'.format(users, users * trip_count,
+                                                     unpartitioned, partitioned))
+
+benchmarks = {
+    'indexes': bench_indexes,
+    'load': bench_load,
+    'threads': bench_threads,
+    'batch': bench_batch,
+    'geometry': bench_geometry,
+    'overhead': bench_overhead,
+    'fleet': bench_fleet,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(__doc__)
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
@@ -0,0 +1,299 @@
+'''Bulk loading of trips and drive events with PostgreSQL COPY.
+
+DatabaseManager.insert_json_into_db builds a mapped Trip per trip, whose
+geometries are SQL expressions that are evaluated row by row as the session
+flushes. That is fine for a handful of trips but far too slow for a fleet's
+history, so this module does the same work in bulk:
+
+  * paths and event points are projected with projection.py, and speeding event
+    sublines are cut from the projected path in NumPy
+  * trip ids are reserved from the trips sequence up front, so event rows can
+    reference their trip without a round trip per trip
+  * trips and the three event tables are streamed in with one COPY each per
+    batch, and the buffered trips.geom is filled in by a single UPDATE, using
+    SpatialQueries.buffered_path like the ORM path does
+
+The rows written are the same ones the ORM path writes.
+
+SyncLoader makes a load idempotent, for refreshing a database that already
+holds most of the trips. Trips whose trip_id_string is already stored for the
+user with the same end_time are skipped. Trips whose end_time changed replace
+the stored trip and its events, in the same transaction. Unless trips are
+partitioned, trip_id_string is unique across users, so trips whose id another
+user already has are skipped and counted as conflicts, rather than failing
+the batch. Each batch first
+takes a transaction level advisory lock on its user, so batches of one user
+loaded in parallel (see ingest.py) run their lookup, delete and insert one
+after the other, and each sees what the ones before it committed.
+'''
+import binascii
+import io
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.sql import select, text
+from geoalchemy2 import Geometry
+
+from engine import engine
+from models import (CorridorTrip, EncodedPath, Trip, SpeedingEvent, HardBrakeEvent,
+                    HardAccelerationEvent, event_route_fields)
+from models import SpatialQueries as SQ
+from projection import path_distances
+import projection
+import settings
+
+def copy_field(column, value):
+    '''Formats one value for COPY's text format.'''
+    if value is None:
+        return u'\\N'
+    if isinstance(column.type, ARRAY):
+        # array literal; the only array copied is trips.route_distances
+        return u'{' + u','.join(repr(float(v)) for v in value) + u'}'
+    if isinstance(column.type, (EncodedPath, JSONB)):
+        # the same text the column's type would bind
+        value = column.type.bind_processor(engine.dialect)(value)
+    if isinstance(column.type, Geometry):
+        # geometry input accepts hex EWKB
+        return binascii.hexlify(value).decode('ascii')
+    if isinstance(value, float):
+        return repr(value)
+    if not isinstance(value, type(u'')):
+        value = u'{}'.format(value)
+    return value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t')\
+                .replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+def reserve_ids(connection, column, count):
+    '''Takes count values from a serial column's sequence, so rows can be COPYed with ids.'''
+    s = text("SELECT nextval(pg_get_serial_sequence(:table, :column)) "
+             "FROM generate_series(1, :count)")
+    return [row[0] for row in connection.execute(s, table=column.table.name,
+                                                 column=column.name, count=count)]
+
+def delete_trips(connection, trip_ids):
+    '''Deletes trips along with their events and corridor memberships.'''
+    for cls in [SpeedingEvent, HardBrakeEvent, HardAccelerationEvent, CorridorTrip]:
+        connection.execute(cls.__table__.delete().where(cls.trip_id.in_(trip_ids)))
+    connection.execute(Trip.__table__.delete().where(Trip.trip_id.in_(trip_ids)))
+
+class CopyBuffer(object):
+    '''Accumulates rows for one table, then sends them with a single COPY.'''
+
+    def __init__(self, table, skip=()):
+        self.table = table
+        self.columns = [column for column in table.columns if column.name not in skip]
+        self.lines = []
+
+    def append(self, row):
+        '''row is a dict keyed by column name; missing columns are NULL.'''
+        self.lines.append(u'\t'.join(copy_field(column, row.get(column.name))
+                                     for column in self.columns))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def copy(self, connection):
+        if not self.lines:
+            return
+        statement = 'COPY {} ({}) FROM STDIN'.format(
+            self.table.name, ', '.join(column.name for column in self.columns))
+        data = io.BytesIO((u'\n'.join(self.lines) + u'\n').encode('utf-8'))
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(statement, data)
+        finally:
+            cursor.close()
+        self.lines = []
+
+class LoadStats(object):
+    '''Row counts and wall clock time for a bulk load, in total and per stage.'''
+
+    def __init__(self):
+        self.trips = 0
+        self.events = 0
+        self.seconds = 0.0
+        # trips a SyncLoader skipped as already stored, and replaced as changed
+        self.unchanged = 0
+        self.replaced = 0
+        # trips a SyncLoader skipped because another user has their trip_id_string
+        self.conflicts = 0
+        # stage name -> seconds
+        self.stages = defaultdict(float)
+
+    def add(self, other):
+        '''Adds another load's counts and times into these.'''
+        self.trips += other.trips
+        self.events += other.events
+        self.seconds += other.seconds
+        self.unchanged += other.unchanged
+        self.replaced += other.replaced
+        self.conflicts += other.conflicts
+        for stage, seconds in other.stages.items():
+            self.stages[stage] += seconds
+
+    @property
+    def rows(self):
+        return self.trips + self.events
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        summary = '{} trips and {} events in {:.2f}s ({:.0f} rows/s)'.format(
+            self.trips, self.events, self.seconds, self.rows_per_second)
+        if self.unchanged or self.replaced:
+            summary += ', {} unchanged trips skipped, {} replaced'.format(
+                self.unchanged, self.replaced)
+        if self.conflicts:
+            summary += ', {} trips of other users skipped'.format(self.conflicts)
+        return summary
+
+class BulkLoader(object):
+    '''Loads trip json, as returned by parse_inputs.get_json, for one user.'''
+
+    event_types = {
+        'speeding': SpeedingEvent,
+        'hard_accel': HardAccelerationEvent,
+        'hard_brake': HardBrakeEvent,
+    }
+
+    def __init__(self, user_id, batch_size=1000):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.stats = LoadStats()
+
+    def load(self, trips):
+        '''Loads an iterable of trips, committing every batch_size trips.
+
+        Returns:
+          LoadStats: totals for everything loaded by this loader so far
+        '''
+        batch = []
+        for trip in trips:
+            if len(trip['path']) > 1:
+                batch.append(trip)
+            if len(batch) >= self.batch_size:
+                self.load_batch(batch)
+                batch = []
+        if batch:
+            self.load_batch(batch)
+        return self.stats
+
+    def select_batch(self, connection, trips, stats):
+        '''Returns the trips of a batch that should be written, inside its transaction.
+
+        stats is the batch's LoadStats, added to the loader's once it commits.
+        '''
+        return trips
+
+    def reserve_trip_ids(self, connection, count):
+        return reserve_ids(connection, Trip.trip_id, count)
+
+    def load_batch(self, trips):
+        '''Loads one batch in one transaction; self.stats only counts it once committed.'''
+        start = time.time()
+        trip_rows = CopyBuffer(Trip.__table__, skip=('geom',))
+        event_rows = dict(
+            (cls, CopyBuffer(cls.__table__, skip=(cls.__mapper__.primary_key[0].name,)))
+            for cls in self.event_types.values()
+        )
+        stats = LoadStats()
+        stages = stats.stages
+        with engine.begin() as connection:
+            trips = self.select_batch(connection, trips, stats)
+            if not trips:
+                stats.seconds += time.time() - start
+                self.stats.add(stats)
+                return
+            trip_ids = self.reserve_trip_ids(connection, len(trips))
+            stage_start = time.time()
+            for trip_id, trip in zip(trip_ids, trips):
+                xy = projection.to_projected(trip['path'])
+                distances = path_distances(xy)
+                trip_rows.append(self.trip_row(trip_id, trip, xy, distances))
+                for event in trip['drive_events']:
+                    cls = self.event_types[event['type']]
+                    event_rows[cls].append(self.event_row(cls, trip_id, event, xy, distances))
+            stages['prepare'] += time.time() - stage_start
+            stage_start = time.time()
+            trip_rows.copy(connection)
+            for rows in event_rows.values():
+                stats.events += len(rows)
+                rows.copy(connection)
+            stages['copy'] += time.time() - stage_start
+            stage_start = time.time()
+            connection.execute(
+                Trip.__table__.update()
+                .where(Trip.trip_id.in_(trip_ids))
+                .values(geom=SQ.buffered_path(Trip.geom_path)))
+            stages['buffer'] += time.time() - stage_start
+            stage_start = time.time()
+        stages['commit'] += time.time() - stage_start
+        stats.trips += len(trips)
+        stats.seconds += time.time() - start
+        self.stats.add(stats)
+
+    def trip_row(self, trip_id, trip, xy, distances):
+        '''Same remapping Trip.__init__ does, given the trip's projected path.'''
+        row = dict(trip)
+        row.pop('user', None)
+        row.pop('drive_events', None)
+        row['trip_id_string'] = row.pop('id')
+        row['trip_id'] = trip_id
+        row['user_id'] = self.user_id
+        row['geom_path'] = projection.linestring_ewkb(xy)
+        row['route_distances'] = distances
+        return row
+
+    def event_row(self, cls, trip_id, event, xy, distances):
+        '''Same remapping the event classes' __init__ does, computed client-side.'''
+        row = dict(event)
+        row.pop('type')
+        row['trip_id'] = trip_id
+        row['user_id'] = self.user_id
+        row.update(event_route_fields(cls, event, xy, distances))
+        return row
+
+def lock_user(connection, user_id):
+    '''Holds an advisory lock on a user's trips until the transaction ends.'''
+    connection.execute(text("SELECT pg_advisory_xact_lock("
+                            "CAST(CAST(CAST('trips' AS regclass) AS oid) AS integer), "
+                            ":user_id)"), user_id=user_id)
+
+class SyncLoader(BulkLoader):
+    '''BulkLoader that only writes trips that are new or whose end_time changed.'''
+
+    def select_batch(self, connection, trips, stats):
+        # the last copy of a trip listed twice wins
+        trips = list(OrderedDict((trip['id'], trip) for trip in trips).values())
+        # another batch of this user may be replacing the same trips
+        lock_user(connection, self.user_id)
+        stored = {}
+        # ids other users have; only unique per user once trips are partitioned
+        taken = set()
+        for row in connection.execute(
+                select([Trip.trip_id_string, Trip.trip_id, Trip.end_time, Trip.user_id])
+                .where(Trip.trip_id_string.in_([trip['id'] for trip in trips]))):
+            if row.user_id == self.user_id:
+                stored[row.trip_id_string] = row
+            elif not settings.PARTITION_COUNT:
+                taken.add(row.trip_id_string)
+        fresh = []
+        stale_ids = []
+        for trip in trips:
+            row = stored.get(trip['id'])
+            if trip['id'] in taken:
+                stats.conflicts += 1
+            elif row is None:
+                fresh.append(trip)
+            elif row.end_time != trip.get('end_time'):
+                fresh.append(trip)
+                stale_ids.append(row.trip_id)
+            else:
+                stats.unchanged += 1
+        if stale_ids:
+            delete_trips(connection, stale_ids)
+            stats.replaced += len(stale_ids)
+        return fresh
@@ -0,0 +1,112 @@
+'''Small in-process caches, and the caches in front of the alerts endpoint.
+
+Devices sitting at lights or in traffic send nearly the same points every few
+seconds. alert_cache remembers the warnings sent for a user at a spot, keyed by
+the ALERT_CACHE_CELL metre grid cell of the last point and the heading rounded
+to one of ALERT_CACHE_HEADINGS directions. Repeat requests are then answered
+without running the spatial query. Entries live for ALERT_CACHE_TTL seconds,
+and DatabaseManager drops a user's entries when their history changes.
+
+user_ids maps usernames to user_ids, so most requests skip that lookup too.
+Unknown usernames are cached as None for settings.USER_ID_NEGATIVE_TTL, and
+DatabaseManager.create_new_user drops the entry of the name it creates.
+'''
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import projection
+import settings
+
+# a get default that can't be confused with a cached value, None included
+MISSING = object()
+
+class LRUCache(object):
+    '''Thread-safe, size bounded least recently used cache with an optional ttl.'''
+
+    def __init__(self, max_size, ttl=None, clock=time.time):
+        '''
+        Args:
+          max_size (int): entries kept before the least recently used are dropped
+          ttl (float): seconds an entry stays valid after it's put, or None
+          clock (callable): returns the current time in seconds
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (expires, value), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        '''Returns the cached value for key, or default if it's missing or expired.'''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (entry[0] is not None and entry[0] <= self.clock()):
+                self.misses += 1
+                return default
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        '''Caches value under key, for ttl seconds if given instead of self.ttl.'''
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else self.clock() + ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate(self, predicate=None):
+        '''Drops every entry whose key satisfies predicate, or all of them.'''
+        with self.lock:
+            if predicate is None:
+                self.entries.clear()
+            else:
+                for key in [key for key in self.entries if predicate(key)]:
+                    del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        '''Whether key is cached and unexpired; unlike get, not counted as a use.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and (entry[0] is None or entry[0] > self.clock())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self.entries), hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    hit_rate=float(self.hits) / lookups if lookups else 0.0)
+
+def alert_cache_key(user_id, point_group):
+    '''Returns (user_id, cell_x, cell_y, heading) for a point group.
+
+    heading is the direction from the first point to the last, in one of
+    settings.ALERT_CACHE_HEADINGS sectors, or None for a device that has barely
+    moved.
+    '''
+    line = projection.to_projected(point_group)
+    (x0, y0), (x, y) = line[0], line[-1]
+    cell_size = settings.ALERT_CACHE_CELL
+    heading = None
+    if math.hypot(x - x0, y - y0) >= settings.ALERT_CACHE_MIN_MOVEMENT:
+        sector = 2 * math.pi / settings.ALERT_CACHE_HEADINGS
+        heading = int(round(math.atan2(y - y0, x - x0) / sector)) % settings.ALERT_CACHE_HEADINGS
+    return (user_id, int(math.floor(x / cell_size)), int(math.floor(y / cell_size)), heading)
+
+alert_cache = LRUCache(settings.ALERT_CACHE_SIZE, settings.ALERT_CACHE_TTL)
+user_ids = LRUCache(settings.USER_ID_CACHE_SIZE, settings.USER_ID_CACHE_TTL)
@@ -0,0 +1,224 @@
+'''Route corridors: repeated trips merged into one canonical route per commute.
+
+A driver who takes the same commute every day has hundreds of trips whose
+buffers all overlap, and find_trips_matching_line returns every one of them.
+Their events are then scanned one by one, and the same pothole shows up as a
+separate warning for every trip that braked there.
+
+A clustering job merges a user's trips into corridors. A trip joins a corridor
+that starts and ends near where it does and whose canonical path is within
+settings.CORRIDOR_TOLERANCE of it in both directions, checked at the vertices
+of both paths. Otherwise it starts a new corridor, with its own path as the
+canonical one. Each corridor's events are then merged per event type: an event
+within settings.CORRIDOR_EVENT_MERGE_DISTANCE of an existing aggregate is
+counted into it. The result is one row per distinct spot, with a count and the
+time it was last seen.
+
+CorridorQueries answers alerts from the corridors, so the matching cost grows
+with the number of distinct routes rather than the number of trips. A corridor's
+buffer is wide enough to hold every member trip's buffer, so it matches wherever
+one of its trips would.
+
+Ingesting trips drops the user's corridors. Until the job is run again, alerts
+for that user fall back to SpatialQueries.
+
+Run the job with:
+  python corridors.py [username ...]
+'''
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.sql import exists, select
+
+from bulk_load import CopyBuffer, reserve_ids
+from engine import engine, session
+from models import Corridor, CorridorEvent, CorridorTrip, Trip, User
+from models import SpatialQueries as SQ
+from spatial_index import GridIndex, read_history
+import projection
+import settings
+
+def distances_to_path(points, path):
+    '''Distance from each point to the nearest segment of path.
+
+    Args:
+      points (array): (n, 2) projected points
+      path (array): (m, 2) projected vertices, m >= 2
+
+    Returns:
+      array: (n,) distances
+    '''
+    a = path[:-1]
+    d = path[1:] - a
+    length_squared = (d * d).sum(axis=1)
+    length_squared[length_squared == 0] = 1.0
+    ap = points[:, np.newaxis, :] - a[np.newaxis, :, :]
+    t = np.clip((ap * d).sum(axis=2) / length_squared, 0.0, 1.0)
+    offsets = ap - t[:, :, np.newaxis] * d
+    return np.sqrt((offsets * offsets).sum(axis=2)).min(axis=1)
+
+def same_route(path, other, tolerance):
+    '''True if every vertex of each path is within tolerance of the other path.'''
+    return distances_to_path(path, other).max() <= tolerance and \
+        distances_to_path(other, path).max() <= tolerance
+
+class Cluster(object):
+    '''A corridor being built: its canonical path, member trips and event aggregates.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.trip_ids = []
+        # one [event_type, x, y, count, last_seen] list per distinct spot
+        self.events = []
+
+    def add_event(self, event_type, x, y, seen):
+        merge_distance = settings.CORRIDOR_EVENT_MERGE_DISTANCE
+        for aggregate in self.events:
+            if aggregate[0] == event_type and \
+               np.hypot(aggregate[1] - x, aggregate[2] - y) <= merge_distance:
+                count = aggregate[3]
+                aggregate[1] = (aggregate[1] * count + x) / (count + 1)
+                aggregate[2] = (aggregate[2] * count + y) / (count + 1)
+                aggregate[3] = count + 1
+                aggregate[4] = max(aggregate[4], seen)
+                return
+        self.events.append([event_type, x, y, 1, seen])
+
+def event_time(event):
+    '''Speeding events span an interval and have no ts; use when they started.'''
+    return getattr(event, type(event).time_column) or 0
+
+def cluster(paths, events, tolerance=None):
+    '''Groups trips into corridors.
+
+    Args:
+      paths (dict): trip_id -> projected (x, y) vertices, as read_history returns
+      events (list): (event_type, event, x, y), as read_history returns
+      tolerance (float): defaults to settings.CORRIDOR_TOLERANCE
+
+    Returns:
+      list of Cluster, ordered by their first trip
+    '''
+    tolerance = settings.CORRIDOR_TOLERANCE if tolerance is None else tolerance
+    clusters = []
+    # every cluster is filed under the cells of its path's two ends
+    ends = GridIndex(settings.ALERT_DISTANCE)
+    cluster_of_trip = {}
+    for trip_id in sorted(paths):
+        path = np.asarray(paths[trip_id], dtype=float)
+        (sx, sy), (ex, ey) = path[0], path[-1]
+        near_end = set(id(c) for c in ends.query(ex, ey, tolerance))
+        for c in ends.query(sx, sy, tolerance):
+            if id(c) in near_end and same_route(path, c.path, tolerance):
+                break
+        else:
+            c = Cluster(path)
+            clusters.append(c)
+            ends.insert(c, sx, sy, sx, sy)
+            ends.insert(c, ex, ey, ex, ey)
+        c.trip_ids.append(trip_id)
+        cluster_of_trip[trip_id] = c
+    for event_type, event, x, y in sorted(events, key=lambda e: (e[1].trip_id, e[0], e[2], e[3])):
+        cluster_of_trip[event.trip_id].add_event(event_type, x, y, event_time(event))
+    return clusters
+
+def delete(connection, user_id):
+    corridor_ids = select([Corridor.corridor_id]).where(Corridor.user_id == user_id)
+    connection.execute(CorridorEvent.__table__.delete()
+                       .where(CorridorEvent.corridor_id.in_(corridor_ids)))
+    connection.execute(CorridorTrip.__table__.delete()
+                       .where(CorridorTrip.corridor_id.in_(corridor_ids)))
+    connection.execute(Corridor.__table__.delete().where(Corridor.user_id == user_id))
+
+def invalidate(user_id):
+    '''Drops a user's corridors, which are stale once their history changes.'''
+    with engine.begin() as connection:
+        delete(connection, user_id)
+
+def build(user_id):
+    '''Replaces a user's corridors with freshly clustered ones.
+
+    Returns:
+      int: number of corridors written
+    '''
+    paths, events = read_history(user_id)
+    clusters = cluster(paths, events)
+    end_times = dict(engine.execute(
+        select([Trip.trip_id, Trip.end_time]).where(Trip.user_id == user_id)).fetchall())
+    corridor_rows = CopyBuffer(Corridor.__table__, skip=('geom',))
+    trip_rows = CopyBuffer(CorridorTrip.__table__)
+    event_rows = CopyBuffer(CorridorEvent.__table__, skip=('corridor_event_id',))
+    with engine.begin() as connection:
+        delete(connection, user_id)
+        corridor_ids = reserve_ids(connection, Corridor.corridor_id, len(clusters))
+        for corridor_id, c in zip(corridor_ids, clusters):
+            corridor_rows.append(dict(
+                corridor_id=corridor_id, user_id=user_id,
+                geom_path=projection.linestring_ewkb(c.path),
+                trip_count=len(c.trip_ids),
+                last_seen=max(end_times.get(trip_id) or 0 for trip_id in c.trip_ids)))
+            for trip_id in c.trip_ids:
+                trip_rows.append(dict(trip_id=trip_id, corridor_id=corridor_id))
+            for event_type, x, y, count, seen in c.events:
+                event_rows.append(dict(corridor_id=corridor_id, event_type=event_type,
+                                       point=projection.point_ewkb(x, y),
+                                       count=count, last_seen=seen))
+        corridor_rows.copy(connection)
+        connection.execute(
+            Corridor.__table__.update()
+            .where(Corridor.user_id == user_id)
+            .values(geom=SQ.buffered_path(Corridor.geom_path, settings.MAX_GPS_ERROR_TOLERANCE +
+                                          settings.CORRIDOR_TOLERANCE)))
+        trip_rows.copy(connection)
+        event_rows.copy(connection)
+    return len(clusters)
+
+class CorridorQueries(object):
+    '''Alert backend answering from corridors; same contract as SpatialQueries.
+
+    Returns CorridorEvents, which render as the same warnings as the events
+    they aggregate, but only once per spot.
+    '''
+
+    def adjacent_events_query(self, point_group, user_id):
+        line = SQ.points_to_projected_line(point_group)
+        point = SQ.convert_geographic_coordinates_to_projected_point(*point_group[-1])
+        matching = select([Corridor.corridor_id])\
+            .where(Corridor.user_id == user_id)\
+            .where(func.ST_Within(line, Corridor.geom))
+        return session.query(CorridorEvent)\
+                      .filter(CorridorEvent.corridor_id.in_(matching))\
+                      .filter(func.ST_DWithin(CorridorEvent.point, point,
+                                              settings.ALERT_DISTANCE))\
+                      .order_by(CorridorEvent.corridor_id, CorridorEvent.event_type,
+                                CorridorEvent.corridor_event_id)
+
+    def has_corridors(self, user_id):
+        return session.query(exists().where(Corridor.user_id == user_id)).scalar()
+
+    def adjacent_events_from_point_sequence(self, point_group, user_id):
+        if len(point_group) < 2:
+            return []
+        events = self.adjacent_events_query(point_group, user_id).all()
+        if not events and not self.has_corridors(user_id):
+            return SQ.adjacent_events_from_point_sequence(point_group, user_id)
+        return events
+
+    def adjacent_events_from_point_sequences(self, probes):
+        return [self.adjacent_events_from_point_sequence(point_group, user_id)
+                for point_group, user_id in probes]
+
+corridor_queries = CorridorQueries()
+
+if __name__ == '__main__':
+    users = select([User.user_id, User.username])
+    if len(sys.argv) > 1:
+        users = users.where(User.username.in_(sys.argv[1:]))
+    for user_id, username in engine.execute(users).fetchall():
+        start = time.time()
+        count = build(user_id)
+        trip_count = engine.execute(select([func.count()]).where(Trip.user_id == user_id)).scalar()
+        print('{}: {} trips in {} corridors in {:.2f}s'.format(
+            username, trip_count, count, time.time() - start))
@@ -1,9 +1,49 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 import settings
 
 engine = create_engine('postgresql://{user}@localhost/automatic_test'.format(user=settings.OS_USERNAME)
-                       , echo=False)
-Session = sessionmaker(bind=engine)
-session = Session()
+                       , echo=False
+                       , pool_size=settings.DB_POOL_SIZE
+                       , max_overflow=settings.DB_MAX_OVERFLOW
+                       , pool_timeout=settings.DB_POOL_TIMEOUT
+                       , pool_recycle=settings.DB_POOL_RECYCLE)
+
+if settings.DB_POOL_PRE_PING:
+    @event.listens_for(engine.pool, 'checkout')
+    def ping_connection(dbapi_connection, connection_record, connection_proxy):
+        '''Test connections as they leave the pool, so a restarted database
+        costs one reconnect instead of a failed request.'''
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            # the pool retries the checkout with a fresh connection
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+
+def limit_statement_time(timeout_ms):
+    '''Cancels statements running longer than timeout_ms on this process's connections.
+
+    Only the web app calls this, at import. Bulk loads, index builds and
+    backfills legitimately run for minutes, so other processes keep Postgres'
+    default of no limit. Pooled connections opened before the call are dropped.
+    '''
+    @event.listens_for(engine.pool, 'connect')
+    def set_statement_timeout(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SET statement_timeout = %s', (int(timeout_ms),))
+        finally:
+            cursor.close()
+        # SET opened a transaction; it has to be committed to last
+        dbapi_connection.commit()
+    engine.dispose()
+
+# for sessions that must not be shared with the current request
+session_factory = sessionmaker(bind=engine)
+# one session per thread; app.py removes it when each request ends
+Session = scoped_session(session_factory)
+session = Session
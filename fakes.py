@@ -0,0 +1,10 @@
+'''Stand-ins shared by the unit tests.'''
+
+class FakeClock(object):
+    '''A clock for the caches' clock argument, moved by setting now.'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,237 @@
+'''Parallel ingestion of json trip exports, sharded by user.
+
+DatabaseManager.bulk_insert_files_into_db loads one user's files in a single
+process, so a backfill of thousands of users uses one core. This splits the
+work across a process pool:
+
+  * the parent streams each file with parse_inputs.iter_json_array and groups
+    the trips by user, into batches of batch_size; once max_buffered trips are
+    waiting, the largest batch goes early
+  * each full batch goes to a worker, which decodes the paths and loads them
+    with a BulkLoader, committing the batch as one transaction
+  * every worker has its own connection; the parent's pool is emptied before
+    the workers fork, so none of them inherit its connections
+
+With --sync, trips already stored with the same end_time are skipped and
+those whose end_time changed are replaced (see bulk_load.SyncLoader), so a
+daily refresh can be run over the whole export and only writes what's new.
+Derived data and caches are only dropped for users that got new trips.
+
+Exports name their owner by Automatic's user id, in the "user": {"id": ...}
+field of each trip, which isn't a username here. Like the single process
+loaders, every trip goes to settings.USERNAME, or to --username, unless
+--usernames names a json file mapping Automatic user ids to usernames. Trips of
+ids missing from that file are skipped. Unknown users are created with
+--create-users and skipped otherwise.
+
+The parent holds at most max_buffered trips waiting for their batch to fill,
+plus up to twice as many batches as there are workers in flight, so memory
+stays bounded by (max_buffered + 2 * processes * batch_size) trips whatever
+the size of the input or the number of users in it.
+
+Usage:
+  python ingest.py [--username NAME | --usernames FILE] [--create-users] [--sync]
+                   [--processes N] [--batch-size N] [--max-buffered N]
+                   file [file ...]
+'''
+import argparse
+import io
+import json
+import multiprocessing
+import time
+from collections import defaultdict, deque
+
+from bulk_load import BulkLoader, LoadStats, SyncLoader
+from engine import engine, Session
+from insert import DatabaseManager as DBM
+from models import User
+from parse_inputs import decode_path, iter_json_array
+import settings
+
+def load_shard(shard):
+    '''Worker: decodes and loads one batch of one user's trips.
+
+    Args:
+      shard (tuple): (user_id, trips, sync), with paths still polyline encoded
+
+    Returns:
+      tuple: (user_id, LoadStats for this batch)
+    '''
+    user_id, trips, sync = shard
+    loader = (SyncLoader if sync else BulkLoader)(user_id, batch_size=len(trips))
+    start = time.time()
+    for trip in trips:
+        trip['path'] = decode_path(trip['path'])
+    loader.stats.stages['decode'] += time.time() - start
+    loader.load(trips)
+    loader.stats.seconds += loader.stats.stages['decode']
+    return user_id, loader.stats
+
+def owner(trip, username=None, usernames=None):
+    '''The username a trip is loaded for, or None if it isn't mapped to one.
+
+    Args:
+      trip (dict): a trip of a json export
+      username (str): load every trip for this user
+      usernames (dict): Automatic user id -> username, used when username isn't given
+    '''
+    if username is not None:
+        return username
+    if usernames is not None:
+        return usernames.get(trip['user']['id'])
+    return settings.USERNAME
+
+def shards(paths, batch_size, username=None, usernames=None, max_buffered=None):
+    '''Yields (username, trips) batches of at most batch_size trips.
+
+    A user's batch is sent as soon as it is full, and what's left of every
+    user's trips once a file has been read. Whenever max_buffered trips are
+    waiting across all users, the largest batch is sent early, so however many
+    users a file holds, no more than max_buffered trips are held here. Trips
+    without a username (see owner) come in batches for None.
+    '''
+    if max_buffered is None:
+        max_buffered = batch_size
+    for path in paths:
+        batches = defaultdict(list)
+        buffered = 0
+        with io.open(path, 'r', encoding='utf-8') as f:
+            for trip in iter_json_array(f):
+                name = owner(trip, username, usernames)
+                batch = batches[name]
+                batch.append(trip)
+                buffered += 1
+                if len(batch) < batch_size and buffered >= max_buffered:
+                    name = max(batches, key=lambda key: len(batches[key]))
+                elif len(batch) < batch_size:
+                    continue
+                batch = batches.pop(name)
+                buffered -= len(batch)
+                yield name, batch
+        for name, batch in batches.items():
+            yield name, batch
+
+class Ingest(object):
+    '''One parallel load, with its totals.'''
+
+    def __init__(self, processes=None, batch_size=1000, create_users=False, sync=False,
+                 max_buffered=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered or self.processes * batch_size
+        self.create_users = create_users
+        self.sync = sync
+        self.stats = LoadStats()
+        self.skipped = 0
+        self.user_ids = {}
+        # users that got new trips
+        self.changed_user_ids = set()
+
+    def user_id(self, username):
+        '''The user_id for username, creating the user if asked to; None to skip.'''
+        if username is None:
+            return None
+        if username not in self.user_ids:
+            user_id = Session.query(User.user_id).filter(User.username == username).scalar()
+            if user_id is None and self.create_users:
+                DBM.create_new_user(username=username)
+                user_id = Session.query(User.user_id).filter(User.username == username).scalar()
+            self.user_ids[username] = user_id
+        return self.user_ids[username]
+
+    def run(self, paths, username=None, usernames=None):
+        '''Loads every trip in paths.
+
+        Args:
+          paths (list): json export files
+          username (str): load every trip for this user
+          usernames (dict): Automatic user id -> username; see owner
+
+        Returns:
+          LoadStats: summed over all workers; stats.seconds is the wall clock time
+        '''
+        start = time.time()
+        # workers must not share connections the parent already opened
+        Session.remove()
+        engine.dispose()
+        pool = multiprocessing.Pool(self.processes, initializer=engine.dispose)
+        pending = deque()
+        try:
+            read_start = time.time()
+            for name, trips in shards(paths, self.batch_size, username, usernames,
+                                      self.max_buffered):
+                user_id = self.user_id(name)
+                if user_id is None:
+                    self.skipped += len(trips)
+                    continue
+                self.stats.stages['read'] += time.time() - read_start
+                pending.append(pool.apply_async(load_shard, ((user_id, trips, self.sync),)))
+                while len(pending) >= 2 * self.processes:
+                    self.collect(pending.popleft())
+                read_start = time.time()
+            while pending:
+                self.collect(pending.popleft())
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        for user_id in self.changed_user_ids:
+            DBM.user_history_changed(user_id)
+        Session.remove()
+        self.stats.seconds = time.time() - start
+        return self.stats
+
+    def collect(self, result):
+        user_id, stats = result.get()
+        self.stats.add(stats)
+        if stats.trips:
+            self.changed_user_ids.add(user_id)
+
+    def report(self):
+        lines = [str(self.stats)]
+        if self.skipped:
+            lines.append('{} trips of unknown or unmapped users skipped'.format(self.skipped))
+        lines.append('{} processes, {:.0f} trips/s'.format(
+            self.processes, self.stats.trips / self.stats.seconds if self.stats.seconds else 0))
+        lines.append('seconds per stage, summed over workers:')
+        for stage in ['read', 'decode', 'prepare', 'copy', 'buffer', 'commit']:
+            lines.append('  {:>8} {:10.2f}'.format(stage, self.stats.stages[stage]))
+        return '\n'.join(lines)
+
+def ingest(paths, username=None, usernames=None, processes=None, batch_size=1000,
+           create_users=False, sync=False, max_buffered=None):
+    '''Loads json export files in parallel; see the module docstring.
+
+    Returns:
+      Ingest: holds the LoadStats and the number of skipped trips
+    '''
+    job = Ingest(processes=processes, batch_size=batch_size, create_users=create_users,
+                 sync=sync, max_buffered=max_buffered)
+    job.run(paths, username, usernames)
+    return job
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load json trip exports in parallel.')
+    parser.add_argument('paths', nargs='+', metavar='file')
+    owners = parser.add_mutually_exclusive_group()
+    owners.add_argument('--username', help='load every trip for this user')
+    owners.add_argument('--usernames', metavar='FILE',
+                        help='json object mapping Automatic user ids to usernames')
+    parser.add_argument('--create-users', action='store_true',
+                        help='create users that do not exist yet')
+    parser.add_argument('--sync', action='store_true',
+                        help='only write trips that are new or whose end_time changed')
+    parser.add_argument('--processes', type=int, help='workers, default one per cpu')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='trips per transaction')
+    parser.add_argument('--max-buffered', type=int,
+                        help='trips held while batches fill, default processes * batch size')
+    args = parser.parse_args()
+    usernames = None
+    if args.usernames:
+        with open(args.usernames) as f:
+            usernames = json.load(f)
+    print(ingest(args.paths, username=args.username, usernames=usernames,
+                 processes=args.processes, batch_size=args.batch_size,
+                 create_users=args.create_users, sync=args.sync,
+                 max_buffered=args.max_buffered).report())
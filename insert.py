@@ -1,23 +1,296 @@
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.sql import bindparam, select, text
+
+import pickle
+
+import numpy as np
+
+import alert_tiles
+import corridors
+from bulk_load import BulkLoader, SyncLoader
+from caching import alert_cache, user_ids
 from engine import engine, session
-from models import User, Trip, SpeedingEvent, HardBrakeEvent, HardAccelerationEvent
+from models import EncodedPath
+from models import SpatialQueries as SQ
+from models import (User, Trip, SpeedingEvent, HardBrakeEvent, HardAccelerationEvent,
+                    AlertTileBuild, AlertTile, EventCount, Corridor, CorridorTrip,
+                    CorridorEvent)
+from parse_inputs import iter_trips
+from spatial_index import history_versions, parse_linestring, spatial_index
+from trip_sessions import trip_sessions
+import projection
+import relevance
 import settings
 
 class DatabaseManager(object):
     engine = engine
     session = session
-    
+    # creation order; drops happen in reverse
+    tables = [User, Trip, SpeedingEvent, HardAccelerationEvent, HardBrakeEvent,
+              AlertTileBuild, AlertTile, EventCount, Corridor, CorridorTrip, CorridorEvent]
+
     @classmethod
     def clear_database_and_create_tables(cls):
-        HardBrakeEvent.__table__.drop(engine, checkfirst=True)
-        HardAccelerationEvent.__table__.drop(engine, checkfirst=True)
-        SpeedingEvent.__table__.drop(engine, checkfirst=True)
-        Trip.__table__.drop(engine, checkfirst=True)
-        User.__table__.drop(engine, checkfirst=True)
-        User.__table__.create(engine)
-        Trip.__table__.create(engine)
-        SpeedingEvent.__table__.create(engine)
-        HardAccelerationEvent.__table__.create(engine)
-        HardBrakeEvent.__table__.create(engine)
+        for model in reversed(cls.tables):
+            model.__table__.drop(engine, checkfirst=True)
+        spatial_index.invalidate()
+        trip_sessions.invalidate()
+        alert_cache.invalidate()
+        user_ids.invalidate()
+        cls.create_extensions()
+        for model in cls.tables:
+            model.__table__.create(engine)
+
+    @classmethod
+    def create_extensions(cls):
+        '''btree_gist is needed for the composite (user_id, geom) GiST index.'''
+        engine.execute(text('CREATE EXTENSION IF NOT EXISTS btree_gist')
+                       .execution_options(autocommit=True))
+
+    @classmethod
+    def existing_indexes(cls, table_name):
+        '''Returns the set of index names Postgres currently has on table_name.'''
+        s = text('SELECT indexname FROM pg_indexes WHERE tablename = :table_name')
+        return set(row[0] for row in engine.execute(s, table_name=table_name))
+
+    @classmethod
+    def ensure_indexes(cls):
+        '''Create any index declared on the models that the database is missing.
+
+        This is safe to run against a populated database, and is the migration
+        path for databases created before the indexes were declared explicitly.
+        The implicit "idx_<table>_<column>" indexes that GeoAlchemy used to create
+        duplicate the declared ones, so they are dropped.
+
+        Returns:
+          list of str: names of the indexes that were created
+        '''
+        cls.create_extensions()
+        created = []
+        for model in cls.tables:
+            table = model.__table__
+            existing = cls.existing_indexes(table.name)
+            for column in table.columns:
+                legacy_name = 'idx_{}_{}'.format(table.name, column.name)
+                if legacy_name in existing:
+                    engine.execute(text('DROP INDEX "{}"'.format(legacy_name))
+                                   .execution_options(autocommit=True))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(engine)
+                    created.append(index.name)
+            # refresh planner statistics so the new indexes actually get picked
+            engine.execute(text('ANALYZE {}'.format(table.name))
+                           .execution_options(autocommit=True))
+        return created
+
+    @classmethod
+    def drop_indexes(cls):
+        '''Drop every declared index. Only intended for benchmarking.'''
+        for model in cls.tables:
+            table = model.__table__
+            existing = cls.existing_indexes(table.name)
+            for index in table.indexes:
+                if index.name in existing:
+                    index.drop(engine)
+
+    @classmethod
+    def migrate(cls):
+        '''Bring an existing database up to the current schema without dropping data.'''
+        for model in cls.tables:
+            model.__table__.create(engine, checkfirst=True)
+        cls.add_missing_columns()
+        cls.migrate_pickled_trip_columns()
+        cls.backfill_route_fractions()
+        cls.backfill_route_distances()
+        cls.backfill_event_user_ids()
+        return cls.ensure_indexes()
+
+    @classmethod
+    def add_missing_columns(cls):
+        '''Adds columns declared on the models that existing tables don't have yet.
+
+        New columns are nullable and start out NULL; backfilling them is up to
+        the caller.
+
+        Returns:
+          list of str: "table.column" for every column added
+        '''
+        added = []
+        for model in cls.tables:
+            table = model.__table__
+            for column in table.columns:
+                if cls.column_type(table.name, column.name) is None:
+                    engine.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name, column.type.compile(dialect=engine.dialect)))
+                                   .execution_options(autocommit=True))
+                    added.append('{}.{}'.format(table.name, column.name))
+        return added
+
+    @classmethod
+    def backfill_route_fractions(cls):
+        '''Fills in route_fraction for events stored before it existed.
+
+        Returns:
+          int: number of events updated
+        '''
+        updated = 0
+        for event_cls in SQ.event_classes:
+            table = event_cls.__table__
+            fraction = select([func.ST_LineLocatePoint(Trip.geom_path, event_cls.point)])\
+                .where(Trip.trip_id == event_cls.trip_id).as_scalar()
+            result = engine.execute(table.update()
+                                    .where(event_cls.route_fraction == None)
+                                    .values(route_fraction=fraction))
+            updated += result.rowcount
+        return updated
+
+    @classmethod
+    def backfill_route_distances(cls, batch_size=1000):
+        '''Fills in trips.route_distances and the events' route_distance_m where missing.
+
+        The trips' vertex distances are computed in Python, batch_size trips at a
+        time. Events are then placed from their route_fraction.
+
+        Returns:
+          int: number of trips and events updated
+        '''
+        update = Trip.__table__.update()\
+            .where(Trip.trip_id == bindparam('id'))\
+            .values(route_distances=bindparam('distances'))
+        updated = 0
+        while True:
+            rows = engine.execute(
+                select([Trip.trip_id, func.ST_AsText(Trip.geom_path)])
+                .where(Trip.route_distances == None)
+                .order_by(Trip.trip_id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            params = [dict(id=trip_id, distances=projection.path_distances(
+                np.array(parse_linestring(wkt))).tolist()) for trip_id, wkt in rows]
+            with engine.begin() as connection:
+                connection.execute(update, params)
+            updated += len(rows)
+        for event_cls in SQ.event_classes:
+            length = select([func.ST_Length(Trip.geom_path)])\
+                .where(Trip.trip_id == event_cls.trip_id).as_scalar()
+            result = engine.execute(event_cls.__table__.update()
+                                    .where(event_cls.route_distance_m == None)
+                                    .values(route_distance_m=event_cls.route_fraction * length))
+            updated += result.rowcount
+        return updated
+
+    @classmethod
+    def backfill_event_user_ids(cls):
+        '''Copies user_id onto events stored before they had one, from their trips.
+
+        Returns:
+          int: number of events updated
+        '''
+        updated = 0
+        for event_cls in SQ.event_classes:
+            user_id = select([Trip.user_id]).where(Trip.trip_id == event_cls.trip_id).as_scalar()
+            result = engine.execute(event_cls.__table__.update()
+                                    .where(event_cls.user_id == None)
+                                    .values(user_id=user_id))
+            updated += result.rowcount
+        return updated
+
+    @classmethod
+    def partitions(cls, table_name):
+        '''Returns the names of table_name's partitions, empty if it isn't partitioned.'''
+        s = text('SELECT inhrelid::regclass::text FROM pg_inherits '
+                 'WHERE inhparent = CAST(:table_name AS regclass) ORDER BY 1')
+        return [row[0] for row in engine.execute(s, table_name=table_name)]
+
+    @classmethod
+    def column_type(cls, table_name, column_name):
+        '''Returns a column's type as information_schema reports it, or None.'''
+        s = text('SELECT data_type FROM information_schema.columns '
+                 'WHERE table_name = :table_name AND column_name = :column_name')
+        return engine.execute(s, table_name=table_name, column_name=column_name).scalar()
+
+    @classmethod
+    def migrate_pickled_trip_columns(cls, batch_size=1000):
+        '''Converts trips.path, score and the locations from pickles to their current types.
+
+        Databases created while these were PickleType columns store them as bytea.
+        Each one gets a column of the new type, filled in batches of trip_ids
+        by unpickling in Python, and then takes the old column's place. Nothing is
+        done if the columns have already been converted.
+
+        Returns:
+          list of str: the columns that were converted
+        '''
+        new_types = [('path', EncodedPath(), 'text'),
+                     ('score', JSONB(), 'jsonb'),
+                     ('start_location', JSONB(), 'jsonb'),
+                     ('end_location', JSONB(), 'jsonb')]
+        new_types = [(name, type_, sql_type) for name, type_, sql_type in new_types
+                     if cls.column_type('trips', name) == 'bytea']
+        if not new_types:
+            return []
+        for name, type_, sql_type in new_types:
+            engine.execute(text('ALTER TABLE trips ADD COLUMN {}_new {}'.format(name, sql_type))
+                           .execution_options(autocommit=True))
+        names = [name for name, type_, sql_type in new_types]
+        update = text('UPDATE trips SET {} WHERE trip_id = :trip_id'.format(
+            ', '.join('{0}_new = :{0}'.format(name) for name in names)))\
+            .bindparams(*[bindparam(name, type_=type_) for name, type_, sql_type in new_types])
+        last_id = 0
+        while True:
+            rows = engine.execute(
+                text('SELECT trip_id, {} FROM trips WHERE trip_id > :last_id '
+                     'ORDER BY trip_id LIMIT :limit'.format(', '.join(names))),
+                last_id=last_id, limit=batch_size).fetchall()
+            if not rows:
+                break
+            params = []
+            for row in rows:
+                values = dict(trip_id=row[0])
+                for name, pickled in zip(names, row[1:]):
+                    values[name] = None if pickled is None else pickle.loads(bytes(pickled))
+                params.append(values)
+            with engine.begin() as connection:
+                connection.execute(update, params)
+            last_id = rows[-1][0]
+        with engine.begin() as connection:
+            for name in names:
+                connection.execute(text('ALTER TABLE trips DROP COLUMN {0}; '
+                                        'ALTER TABLE trips RENAME COLUMN {0}_new TO {0}'
+                                        .format(name)))
+        return names
+
+    @classmethod
+    def prepare_trip_geometries(cls, batch_size=1000, simplify=True):
+        '''Rebuild every trips.geom from its geom_path with SpatialQueries.buffered_path.
+
+        This backfills trips stored before paths were simplified, and is safe to
+        rerun. Trips are updated in trip_id ranges of batch_size, each committed on
+        its own, so the table is never locked as a whole for long.
+
+        Args:
+          batch_size (int): trip_ids per UPDATE
+          simplify (bool): False restores the full resolution buffers
+
+        Returns:
+          int: number of trips updated
+        '''
+        first, last = engine.execute(select([func.min(Trip.trip_id),
+                                             func.max(Trip.trip_id)])).first()
+        if first is None:
+            return 0
+        updated = 0
+        for start in range(first, last + 1, batch_size):
+            with engine.begin() as connection:
+                result = connection.execute(
+                    Trip.__table__.update()
+                    .where(Trip.trip_id.between(start, start + batch_size - 1))
+                    .values(geom=SQ.buffered_path(Trip.geom_path, simplify=simplify)))
+                updated += result.rowcount
+        engine.execute(text('ANALYZE trips').execution_options(autocommit=True))
+        return updated
 
     @classmethod
     def insert_json_into_db(cls, username, json):
@@ -25,6 +298,62 @@ class DatabaseManager(object):
         user.trips.extend([Trip(trip=trip, srid=settings.TARGET_DATUM) for trip in json 
                            if len(trip['path']) > 1])
         cls.session.commit()
+        cls.user_history_changed(user.user_id)
+
+    @classmethod
+    def bulk_insert_json_into_db(cls, username, json, batch_size=1000, sync=False):
+        '''Faster equivalent of insert_json_into_db for large inputs; see bulk_load.py.
+
+        Args:
+          username (str): an existing user
+          json (iterable): trips as returned by parse_inputs.get_json
+          batch_size (int): trips per COPY batch, each batch is its own transaction
+          sync (bool): skip trips already stored unchanged, and replace those whose
+            end_time changed, so loading the same export twice adds nothing
+
+        Returns:
+          bulk_load.LoadStats: row counts and rows/s for the load
+        '''
+        user = cls.session.query(User).filter_by(username=username).first()
+        loader_cls = SyncLoader if sync else BulkLoader
+        stats = loader_cls(user.user_id, batch_size=batch_size).load(json)
+        if stats.trips:
+            cls.user_history_changed(user.user_id)
+        return stats
+
+    @classmethod
+    def bulk_insert_files_into_db(cls, username, paths, batch_size=1000, processes=None,
+                                  sync=False):
+        '''Streams json export files into the database with bounded memory.
+
+        Trips flow from parse_inputs.iter_trips straight into the bulk loader, so
+        neither side ever holds more than one batch of trips.
+        '''
+        trips = iter_trips(paths, processes=processes, window=batch_size)
+        return cls.bulk_insert_json_into_db(username, trips, batch_size=batch_size, sync=sync)
+
+    @classmethod
+    def user_history_changed(cls, user_id):
+        '''Drop anything derived from a user's trips once new ones are committed.
+
+        Event counts are rebuilt rather than dropped while relevance.py uses them.
+        The user's history version is bumped too, so other processes, such as the
+        web server when this runs from ingest.py, reload their in-memory
+        histories and trip sessions (see spatial_index.py).
+        '''
+        engine.execute(User.__table__.update()
+                       .where(User.user_id == user_id)
+                       .values(history_version=func.coalesce(User.history_version, 0) + 1))
+        history_versions.discard(user_id)
+        spatial_index.invalidate(user_id)
+        trip_sessions.invalidate(user_id)
+        alert_tiles.invalidate(user_id)
+        corridors.invalidate(user_id)
+        if settings.RELEVANCE_MIN_SCORE:
+            relevance.build(user_id)
+        else:
+            relevance.invalidate(user_id)
+        alert_cache.invalidate(lambda key: key[0] == user_id)
         
     
     @classmethod
@@ -33,3 +362,5 @@ class DatabaseManager(object):
             user = User(username=username)
             cls.session.add(user)
             cls.session.commit()
+            # the name may be cached as unknown from an earlier request
+            user_ids.discard(username)
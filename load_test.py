@@ -0,0 +1,100 @@
+'''Load test for the streaming alerts endpoint in async_app.py.
+
+Starts async_app.py in a child process and opens websocket connections to it.
+Each connection drives along the test route, sending one position per
+interval and waiting for its reply. The test reports how many connections stay
+open, the updates answered per second, reply latency, and the server's memory
+per connection. Like benchmark.py it reads the test database, but it doesn't
+change it.
+
+Usage:
+  python load_test.py [connections] [seconds] [interval_ms]
+
+Needs websocket-client, which the server itself doesn't.
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import socket
+import subprocess
+import sys
+import time
+
+import gevent
+import websocket
+
+from models import SpatialQueries as SQ
+import settings
+
+def resident_kb(pid):
+    '''VmRSS of a process, from /proc.'''
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            gevent.sleep(0.1)
+    raise RuntimeError('async_app.py did not start listening on {}'.format(port))
+
+def drive(url, points, offset, deadline, interval, stats):
+    '''One device: a position every interval seconds until deadline.'''
+    try:
+        ws = websocket.create_connection(url)
+    except Exception:
+        stats['refused'] += 1
+        return
+    stats['open'] += 1
+    try:
+        i = offset
+        while time.time() < deadline:
+            start = time.time()
+            ws.send(json.dumps(dict(points=[points[i % len(points)]])))
+            reply = json.loads(ws.recv())
+            stats['latency'].append(time.time() - start)
+            if 'warnings' in reply:
+                stats['updates'] += 1
+            i += 1
+            gevent.sleep(max(0, interval - (time.time() - start)))
+    except Exception:
+        stats['dropped'] += 1
+    finally:
+        ws.close()
+
+def run(connections=1000, seconds=30, interval_ms=1000):
+    points = [list(point) for point in SQ.segmentized_line_with_geographic_points(1)]
+    server = subprocess.Popen([sys.executable, 'async_app.py'])
+    try:
+        wait_for_port(settings.PORT)
+        idle_kb = resident_kb(server.pid)
+        url = 'ws://127.0.0.1:{}/stream/alerts/{}'.format(settings.PORT, settings.USERNAME)
+        stats = dict(open=0, refused=0, dropped=0, updates=0, latency=[])
+        deadline = time.time() + seconds
+        devices = [gevent.spawn(drive, url, points, i, deadline, interval_ms / 1000.0, stats)
+                   for i in range(connections)]
+        # memory once every connection had time to open
+        gevent.sleep(seconds / 2.0)
+        busy_kb = resident_kb(server.pid)
+        gevent.joinall(devices)
+    finally:
+        server.terminate()
+        server.wait()
+    latency = sorted(stats['latency']) or [0]
+    print('{} connections opened, {} refused, {} dropped'.format(
+        stats['open'], stats['refused'], stats['dropped']))
+    print('{:.1f} updates/s, median {:.1f}ms, 99th percentile {:.1f}ms'.format(
+        stats['updates'] / float(seconds), latency[len(latency) // 2] * 1000,
+        latency[int(len(latency) * 0.99)] * 1000))
+    print('server memory {:.1f}MB idle, {:.1f}MB loaded, {:.1f}kB per connection'.format(
+        idle_kb / 1024.0, busy_kb / 1024.0,
+        (busy_kb - idle_kb) / float(max(stats['open'], 1))))
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])
@@ -1,30 +1,69 @@
 '''ORM models for a Postgres database with PostGIS extensions.
 
-The biggest missing thing here is spatial indexes. Could provide a huge speedup.
+Spatial indexes are declared explicitly in each table's __table_args__ rather than
+left to GeoAlchemy's implicit per-column indexes, so that
+DatabaseManager.ensure_indexes can check for and rebuild them by name.
 '''
 ## California UTM zone 10: srid 26910
 ## Assuming NAD83 for datum: srid 4326
 
+import math
 import random
 
 from geoalchemy2 import Geometry
+from geoalchemy2.elements import WKBElement
 from geoalchemy2.functions import GenericFunction
+from polyline.codec import PolylineCodec
 
-from sqlalchemy import (Column, Integer, BigInteger, String, Float, PickleType, Time,
-                        ForeignKey, func)
+from sqlalchemy import (Column, Integer, BigInteger, SmallInteger, String, Float, Text,
+                        Time, ForeignKey, Index, LargeBinary, and_, cast, extract, func,
+                        literal, union_all)
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.event import listen
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, deferred, Load, subqueryload
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.sql import select, text
+from sqlalchemy.sql.expression import ClauseElement
 
 from engine import engine, session
+import partitioning
+import prepared
+import projection
 import settings
 Base = declarative_base()
 
+class EncodedPath(TypeDecorator):
+    '''A list of (lat, lon) pairs, stored as an encoded polyline.
+
+    This is the format the API sends paths in. It takes a few bytes per point,
+    where a pickled list of tuples takes over twenty. Coordinates are kept to
+    1e-5 degrees (about a metre), the precision the API provides.
+    '''
+    impl = Text
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not value:
+            return u''
+        # round first, so the codec's per-vertex deltas can't accumulate error
+        return PolylineCodec().encode([(round(lat, 5), round(lon, 5)) for lat, lon in value])
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if not value:
+            return []
+        return PolylineCodec().decode(value)
+
 class User(Base):
     '''username, which is assumed to be unique, and one-to-many rel with Trip.'''
     __tablename__ = 'users'
     user_id = Column(Integer, primary_key=True)
     username = Column(String, unique=True)
+    # bumped whenever the user's trips change, see DatabaseManager.user_history_changed
+    history_version = Column(Integer, default=0)
     trips = relationship('Trip', backref=backref('users', order_by=user_id))
 
     def __repr__(self):
@@ -33,16 +72,32 @@ class User(Base):
 class Trip(Base):
     '''Trips contain all information available from the API as fields.'''
     __tablename__ = 'trips'
+    __table_args__ = (
+        Index('ix_trips_geom', 'geom', postgresql_using='gist'),
+        Index('ix_trips_geom_path', 'geom_path', postgresql_using='gist'),
+        # (user_id, geom) lets the planner satisfy both filters of
+        # find_trips_matching_line from one index; needs btree_gist
+        Index('ix_trips_user_id_geom', 'user_id', 'geom', postgresql_using='gist'),
+        # a user's newest trip, and the trips within settings.RELEVANCE_MAX_AGE_DAYS of it
+        Index('ix_trips_user_id_start_time', 'user_id', 'start_time'),
+        # hash partitioned by user_id with settings.PARTITION_COUNT, see partitioning.py
+        {'info': {'partition_key': 'user_id'}},
+    )
     trip_id = Column(Integer, primary_key=True)
-    geom = Column(Geometry(geometry_type='POLYGON', srid=settings.TARGET_PROJECTION))
-    geom_path = Column(Geometry(geometry_type='LINESTRING', srid=settings.TARGET_PROJECTION))
+    # the geometries and the raw path are large and rarely needed on a loaded
+    # Trip, so they are only fetched when accessed
+    geom = deferred(Column(Geometry(geometry_type='POLYGON', srid=settings.TARGET_PROJECTION,
+                                    spatial_index=False)))
+    geom_path = deferred(Column(Geometry(geometry_type='LINESTRING',
+                                         srid=settings.TARGET_PROJECTION,
+                                         spatial_index=False)))
     user_id = Column(Integer, ForeignKey('users.user_id'))
     average_mpg = Column(Float)
     distance_m = Column(Float)
     duration_over_70_s = Column(Integer)
     duration_over_75_s = Column(Integer)
     duration_over_80_s = Column(Integer)
-    end_location = Column(PickleType)
+    end_location = Column(JSONB)
     end_time = Column(BigInteger)
     end_time_zone = Column(String)
     fuel_cost_usd = Column(Float)
@@ -50,9 +105,11 @@ class Trip(Base):
     hard_accels = Column(Integer)
     hard_brakes = Column(Integer)
     trip_id_string = Column(String, unique=True)
-    path = Column(PickleType)
-    score = Column(PickleType)
-    start_location = Column(PickleType)
+    path = deferred(Column(EncodedPath))
+    # metres from the start of geom_path to each of its vertices
+    route_distances = deferred(Column(ARRAY(Float)))
+    score = Column(JSONB)
+    start_location = Column(JSONB)
     start_time = Column(BigInteger)
     start_time_zone = Column(String)
     uri = Column(String)
@@ -75,15 +132,19 @@ class Trip(Base):
         if trip is None:
             raise ValueError("A trip object must be supplied")
         trip.pop('user')
-        # this path will be used to find speeding_event substrings
-        path_linestring = SpatialQueries.points_to_projected_line(trip['path'])
+        # the projected path, and the distance along it of each vertex, place
+        # the events on the route
+        xy = projection.to_projected(trip['path'])
+        distances = projection.path_distances(xy)
+        path_linestring = SpatialQueries.ewkb_to_geometry(projection.linestring_ewkb(xy))
         trip['geom_path'] = path_linestring
+        trip['route_distances'] = distances.tolist()
         # paths are stored with a 20 M buffer as a polygon to account for gps
         # inaccuracies. This is just a very rough way to do this, more care
         # would be needed for a robust solution, such as greater buffer size,
         # or simply checking that a high percentage of points are within a smaller
         # buffer.
-        trip['geom'] = func.ST_Buffer(path_linestring, 20)
+        trip['geom'] = SpatialQueries.buffered_path(path_linestring)
         trip_id_string = trip.pop('id')
         trip['trip_id_string'] = trip_id_string
         drive_events = trip.pop('drive_events')
@@ -95,94 +156,262 @@ class Trip(Base):
         for event in drive_events:
             cls = self.event_types[event.pop('type')]
             lst = getattr(self, cls.__tablename__)
-            lst.append(cls(trip['trip_id_string'], event, path_linestring))
+            lst.append(cls(trip['trip_id_string'], event, xy, distances))
 
 class SpeedingEvent(Base):
     '''Database table for speeding events, child of relation from trips table.'''
 
     __tablename__ = 'speeding_events'
+    message = "Warning! Based on your driving patterns, " \
+        "you are likely to speed within {} meters."
+    # when the event happened, in ms since the epoch
+    time_column = 'start_time'
+    __table_args__ = (
+        Index('ix_speeding_events_point', 'point', postgresql_using='gist'),
+        {'info': {'partition_key': 'user_id'}},
+    )
     speeding_event_id = Column(Integer, primary_key=True)
-    trip_id = Column(Integer, ForeignKey('trips.trip_id'))
+    trip_id = Column(Integer, ForeignKey('trips.trip_id'), index=True)
+    # the trip's user, so events can be partitioned like trips
+    user_id = Column(Integer, ForeignKey('users.user_id'))
     
     start_distance_m = Column(Float)
     end_distance_m = Column(Float)
     start_time = Column(BigInteger)
     end_time = Column(BigInteger)
-    point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION))
-    end_point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION))
-    line = Column(Geometry(geometry_type='LINESTRING', srid=settings.TARGET_PROJECTION))
+    point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION,
+                            spatial_index=False))
+    # end_point and line are never filtered on, so they are left unindexed
+    end_point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION,
+                                spatial_index=False))
+    line = Column(Geometry(geometry_type='LINESTRING', srid=settings.TARGET_PROJECTION,
+                           spatial_index=False))
     velocity_mph = Column(Float)
+    # ST_LineLocatePoint(trip path, point): how far along its trip the event is
+    route_fraction = Column(Float)
+    # the same position in metres from the start of the trip
+    route_distance_m = Column(Float)
 
-    def __init__(self, trip, event, path):
+    def __init__(self, trip, event, xy, distances):
         '''Remap names to avoid collisions and create geometries.'''
 
         event = event.copy()
-        event['line'] = SpatialQueries.find_line_substring(
-            path, 
-            event['start_distance_m'],
-            event['end_distance_m']
-        )
-        event['point'] = SpatialQueries.line_start_point(event['line'])
-        event['end_point'] = SpatialQueries.line_end_point(event['line'])
-        
+        event.update(event_route_fields(SpeedingEvent, event, xy, distances,
+                                        SpatialQueries.ewkb_to_geometry))
         super(SpeedingEvent, self).__init__(**event)
 
     def __repr__(self):
-        return "Warning! Based on your driving patterns, " \
-            "you are likely to speed within {} meters.".format(settings.ALERT_DISTANCE)
+        return self.message.format(settings.ALERT_DISTANCE)
 
 class HardBrakeEvent(Base):
     '''Database table for hard braking events, child of relation from trips table.'''
 
     __tablename__ = 'hard_brake_events'
+    message = "Warning! Based on your driving patterns, " \
+        "you are likely to brake hard within {} meters."
+    time_column = 'ts'
+    __table_args__ = (
+        Index('ix_hard_brake_events_point', 'point', postgresql_using='gist'),
+        {'info': {'partition_key': 'user_id'}},
+    )
     hard_brake_event_id = Column(Integer, primary_key=True)
-    trip_id = Column(Integer, ForeignKey('trips.trip_id'))
+    trip_id = Column(Integer, ForeignKey('trips.trip_id'), index=True)
+    # the trip's user, so events can be partitioned like trips
+    user_id = Column(Integer, ForeignKey('users.user_id'))
     lat = Column(Float)
     lon = Column(Float)
     ts = Column(BigInteger)
     g = Column(Float)
-    point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION))
+    point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION,
+                            spatial_index=False))
+    # ST_LineLocatePoint(trip path, point): how far along its trip the event is
+    route_fraction = Column(Float)
+    # the same position in metres from the start of the trip
+    route_distance_m = Column(Float)
 
-    def __init__(self, trip, event, path):
+    def __init__(self, trip, event, xy, distances):
         '''Remap names to avoid collisions and create geometries.'''
 
         event = event.copy()
-        event['point'] = SpatialQueries.convert_geographic_coordinates_to_projected_point(
-            event['lat'], 
-            event['lon']
-        )
+        event.update(event_route_fields(HardBrakeEvent, event, xy, distances,
+                                        SpatialQueries.ewkb_to_geometry))
         super(HardBrakeEvent, self).__init__(**event)
 
     def __repr__(self):
-        return "Warning! Based on your driving patterns, " \
-            "you are likely to brake hard within {} meters.".format(settings.ALERT_DISTANCE)
+        return self.message.format(settings.ALERT_DISTANCE)
         
     
 class HardAccelerationEvent(Base):
     '''Database table for hard braking events, child of relation from trips table.
     '''
     __tablename__ = 'hard_acceleration_events'
+    message = "Warning! Based on your driving patterns, " \
+        "you are likely to accelerate hard within {} meters."
+    time_column = 'ts'
+    __table_args__ = (
+        Index('ix_hard_acceleration_events_point', 'point', postgresql_using='gist'),
+        {'info': {'partition_key': 'user_id'}},
+    )
     hard_accleration_event_id = Column(Integer, primary_key=True)
-    trip_id = Column(Integer, ForeignKey('trips.trip_id'))
+    trip_id = Column(Integer, ForeignKey('trips.trip_id'), index=True)
+    # the trip's user, so events can be partitioned like trips
+    user_id = Column(Integer, ForeignKey('users.user_id'))
     lat = Column(Float)
     lon = Column(Float)
     ts = Column(BigInteger)
     g = Column(Float)
-    point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION))
+    point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION,
+                            spatial_index=False))
+    # ST_LineLocatePoint(trip path, point): how far along its trip the event is
+    route_fraction = Column(Float)
+    # the same position in metres from the start of the trip
+    route_distance_m = Column(Float)
 
-    def __init__(self, trip, event, path):
+    def __init__(self, trip, event, xy, distances):
         '''Remap names to avoid collisions and create geometries.
         '''
         event = event.copy()
-        event['point'] = SpatialQueries.convert_geographic_coordinates_to_projected_point(
-            event['lat'], 
-            event['lon']
-        )
+        event.update(event_route_fields(HardAccelerationEvent, event, xy, distances,
+                                        SpatialQueries.ewkb_to_geometry))
         super(HardAccelerationEvent, self).__init__(**event)
 
     def __repr__(self):
-        return "Warning! Based on your driving patterns, " \
-            "you are likely to accelerate hard within {} meters.".format(settings.ALERT_DISTANCE)
+        return self.message.format(settings.ALERT_DISTANCE)
+
+def event_route_fields(event_cls, event, xy, distances, geometry=lambda ewkb: ewkb):
+    '''Places a drive event on its trip's projected path, without asking PostGIS.
+
+    Speeding events cover the part of the path between their start_distance_m
+    and end_distance_m; the others sit at their lat and lon.
+
+    Args:
+      event_cls (type): one of SpatialQueries.event_classes
+      event (dict): the event from the API
+      xy (array): the trip's projected path
+      distances (array): projection.path_distances(xy)
+      geometry (callable): applied to each geometry's EWKB
+
+    Returns:
+      dict: point (and line and end_point for speeding events), plus
+        route_distance_m and route_fraction, the point's position along the path
+    '''
+    fields = {}
+    if event_cls is SpeedingEvent:
+        line = projection.line_substring(xy, distances, event['start_distance_m'],
+                                         event['end_distance_m'])
+        fields['line'] = geometry(projection.linestring_ewkb(line))
+        fields['end_point'] = geometry(projection.point_ewkb(*line[-1]))
+        x, y = line[0]
+    else:
+        (x, y), = projection.to_projected([(event['lat'], event['lon'])])
+    fields['point'] = geometry(projection.point_ewkb(x, y))
+    fields['route_distance_m'] = projection.locate_distance(xy, distances, x, y)
+    fields['route_fraction'] = projection.locate_point(xy, distances, x, y)
+    return fields
+
+def set_event_user_id(mapper, connection, target):
+    '''Copies an event's user_id from its trip as it is inserted.
+
+    The trip is inserted first, so its user_id is known by then.
+    '''
+    if target.user_id is None and target.trips is not None:
+        target.user_id = target.trips.user_id
+
+for event_cls in (SpeedingEvent, HardBrakeEvent, HardAccelerationEvent):
+    listen(event_cls, 'before_insert', set_event_user_id)
+
+class AlertTileBuild(Base):
+    '''Marks a user's alert tiles as built, and for which cell size; see alert_tiles.py.'''
+    __tablename__ = 'alert_tile_builds'
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    cell_size = Column(Float)
+    built_at = Column(BigInteger)
+
+class AlertTile(Base):
+    '''One grid cell of a user's routes, with the warnings reachable from it.
+
+    The event arrays are parallel and sorted like SpatialQueries' results.
+    '''
+    __tablename__ = 'alert_tiles'
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    cell_x = Column(Integer, primary_key=True)
+    cell_y = Column(Integer, primary_key=True)
+    # trips whose buffer touches the cell
+    trip_ids = Column(ARRAY(Integer))
+    event_trip_ids = Column(ARRAY(Integer))
+    # index into SpatialQueries.event_classes
+    event_types = Column(ARRAY(SmallInteger))
+    event_ids = Column(ARRAY(Integer))
+    event_x = Column(ARRAY(Float))
+    event_y = Column(ARRAY(Float))
+
+class EventCount(Base):
+    '''How often a user's events of one type happened in one grid cell; see relevance.py.
+
+    score is the count weighted by recency, with weights halving every
+    settings.RELEVANCE_HALF_LIFE_DAYS before the user's newest trip.
+    '''
+    __tablename__ = 'event_counts'
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    # index into SpatialQueries.event_classes
+    event_type = Column(SmallInteger, primary_key=True)
+    cell_x = Column(Integer, primary_key=True)
+    cell_y = Column(Integer, primary_key=True)
+    events = Column(Integer)
+    score = Column(Float)
+    last_time = Column(BigInteger)
+
+class Corridor(Base):
+    '''A route a user drives repeatedly: one canonical path for many similar trips.
+
+    Built by corridors.py. geom buffers geom_path by enough to contain the
+    buffers of every member trip.
+    '''
+    __tablename__ = 'corridors'
+    __table_args__ = (
+        Index('ix_corridors_user_id_geom', 'user_id', 'geom', postgresql_using='gist'),
+    )
+    corridor_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'), index=True)
+    geom = Column(Geometry(geometry_type='POLYGON', srid=settings.TARGET_PROJECTION,
+                           spatial_index=False))
+    geom_path = Column(Geometry(geometry_type='LINESTRING', srid=settings.TARGET_PROJECTION,
+                                spatial_index=False))
+    trip_count = Column(Integer)
+    # end_time of the most recent member trip
+    last_seen = Column(BigInteger)
+
+class CorridorTrip(Base):
+    '''Which corridor each trip was merged into.'''
+    __tablename__ = 'corridor_trips'
+    trip_id = Column(Integer, ForeignKey('trips.trip_id'), primary_key=True)
+    corridor_id = Column(Integer, ForeignKey('corridors.corridor_id'), index=True)
+
+class CorridorEvent(Base):
+    '''Events of one type that recur at the same spot of a corridor, counted once.'''
+    __tablename__ = 'corridor_events'
+    __table_args__ = (
+        Index('ix_corridor_events_point', 'point', postgresql_using='gist'),
+    )
+    corridor_event_id = Column(Integer, primary_key=True)
+    corridor_id = Column(Integer, ForeignKey('corridors.corridor_id'), index=True)
+    # index into SpatialQueries.event_classes
+    event_type = Column(SmallInteger)
+    # mean position of the merged events
+    point = Column(Geometry(geometry_type='POINT', srid=settings.TARGET_PROJECTION,
+                            spatial_index=False))
+    count = Column(Integer)
+    # latest timestamp of the merged events
+    last_seen = Column(BigInteger)
+
+    def __repr__(self):
+        return SpatialQueries.event_classes[self.event_type].message.format(
+            settings.ALERT_DISTANCE)
+
+# slack for float error when comparing a count of points with a fraction of them,
+# so that 0.7 of 10 points asks for 7 rather than 8
+FRACTION_EPSILON = 1e-9
+MS_PER_DAY = 24 * 60 * 60 * 1000
 
 class SpatialQueries:
     '''This class provides wrappers around spatial functions.
@@ -195,6 +424,12 @@ class SpatialQueries:
     Initially this class was in its own file, until I ran in to problems with
     circular imports.
     '''
+    # same order that get_associated_events accumulates them in
+    event_classes = [SpeedingEvent, HardAccelerationEvent, HardBrakeEvent]
+    # all the alert path reads from an event, besides its primary key; the
+    # warning text only depends on the event's class
+    alert_columns = ('trip_id', 'point')
+
     @classmethod
     def find_trips_matching_line(cls, line, user_id):
         '''Find trips which completely contain the given line.
@@ -212,11 +447,20 @@ class SpatialQueries:
         Another interesting addition would be to relax the contraint that
         every point of the given line needs to be inside of the target
         route buffer. Instead, maybe only 90% of points from a sufficiently
-        large sample size would be sufficient.
+        large sample size would be sufficient. (The alert query now does both,
+        see settings.MATCH_DIRECTION, settings.MATCH_FRACTION and
+        matching_trips_select.)
+
+        The events of every matching trip are loaded up front, with one query per
+        event table for all trips, so get_associated_events doesn't issue three
+        queries per trip. Only SpatialQueries.alert_columns are loaded.
         '''
         proj_line = cls.points_to_projected_line(line)
         s = session.query(Trip).filter_by(user_id=user_id).filter(func.ST_Within(proj_line, Trip.geom))
-        return s
+        return s.options(*[subqueryload(relation).load_only(*cls.alert_columns)
+                           for relation in (Trip.speeding_events,
+                                            Trip.hard_acceleration_events,
+                                            Trip.hard_brake_events)])
     
     @classmethod
     def get_associated_events(cls, trip):
@@ -263,12 +507,268 @@ class SpatialQueries:
         return list(engine.execute(s))
         
 
+    @classmethod
+    def event_time(cls, event_cls):
+        '''The column holding when events of event_cls happened.'''
+        return getattr(event_cls, event_cls.time_column)
+
+    @classmethod
+    def event_cell(cls, event_cls, cell_size):
+        '''(cell_x, cell_y) of the grid cell of cell_size metres an event's point is in.'''
+        return tuple(cast(func.floor(coordinate(event_cls.point) / cell_size), Integer)
+                     for coordinate in (func.ST_X, func.ST_Y))
+
+    @classmethod
+    def hour_of_day(cls, timestamp, time_zone):
+        '''Local time of day of a timestamp with time zone, in hours.'''
+        local = func.timezone(func.coalesce(time_zone, 'UTC'), timestamp)
+        return extract('epoch', cast(local, Time)) / 3600.0
+
+    @classmethod
+    def probes_select(cls, probes):
+        '''Returns one row of (probe_id, user_id, line, point) per probe.
+
+        Args:
+          cls (SpatialQueries): Class object
+          probes (list): (point_group, user_id) pairs. user_id may also be a
+            scalar subquery.
+
+        Returns:
+          Select: probe_id is the index of the probe in probes, line the projected
+            point_group and point its projected last point. With
+            settings.RELEVANCE_MAX_AGE_DAYS, latest is the start_time of the
+            user's newest trip.
+        '''
+        selects = []
+        for probe_id, (point_group, user_id) in enumerate(probes):
+            if not isinstance(user_id, ClauseElement):
+                user_id = literal(user_id, Integer)
+            columns = [
+                literal(probe_id, Integer).label('probe_id'),
+                user_id.label('user_id'),
+                cls.points_to_projected_line(point_group).label('line'),
+                cls.convert_geographic_coordinates_to_projected_point(*point_group[-1])
+                .label('point'),
+            ]
+            if settings.RELEVANCE_MAX_AGE_DAYS is not None:
+                columns.append(select([func.max(Trip.start_time)])
+                               .where(Trip.user_id == user_id).as_scalar().label('latest'))
+            selects.append(select(columns))
+        return union_all(*selects) if len(selects) > 1 else selects[0]
+
+    @classmethod
+    def matching_trips_select(cls, probes, user_id=None):
+        '''Returns (probe_id, trip_id) for every trip matching each probe's line.
+
+        A trip matches when its buffer contains the whole line. With
+        settings.MATCH_FRACTION below 1 it is enough for that fraction of the
+        line's points to be inside the buffer instead, so one GPS outlier doesn't
+        lose the match. The points are unnested and joined against the trips in
+        one grouped query, which can use the (user_id, geom) index however long
+        the line is.
+
+        With settings.MATCH_DIRECTION or settings.ALERT_ALONG_ROUTE, a third
+        column, distance, gives how many metres along the trip the line's last
+        point lies, for comparison with events' route_distance_m. This is the
+        only place the driver is located on a trip. With settings.MATCH_DIRECTION,
+        trips driven the other way along the line are dropped too.
+
+        With settings.RELEVANCE_MAX_AGE_DAYS, trips that started longer than that
+        before the user's newest one are left out. With settings.RELEVANCE_HOURS,
+        a time_zone column carries the trip's start_time_zone.
+
+        Args:
+          cls (SpatialQueries): Class object
+          probes (CTE): as returned by probes_select
+          user_id (int): the user every probe belongs to, if they share one.
+            Comparing trips with it directly, rather than through the CTE, lets
+            Postgres skip other users' partitions (see partitioning.py).
+
+        Returns:
+          Select
+        '''
+        if settings.MATCH_FRACTION < 1:
+            vertex = func.ST_PointN(probes.c.line,
+                                    func.generate_series(1, func.ST_NPoints(probes.c.line)))
+            probe_points = select([probes.c.probe_id, probes.c.user_id,
+                                   func.ST_NPoints(probes.c.line).label('points'),
+                                   vertex.label('vertex')]).alias('probe_points')
+            inside = select([probe_points.c.probe_id, Trip.trip_id])\
+                .where(Trip.user_id == probe_points.c.user_id)\
+                .where(func.ST_Intersects(probe_points.c.vertex, Trip.geom))
+            if user_id is not None:
+                inside = inside.where(Trip.user_id == user_id)
+            inside = inside\
+                .group_by(probe_points.c.probe_id, Trip.trip_id, probe_points.c.points)\
+                .having(func.count() >= literal(settings.MATCH_FRACTION, Float) *
+                        probe_points.c.points - FRACTION_EPSILON)\
+                .alias('fractional_matches')
+            matching_trips = select([probes.c.probe_id, Trip.trip_id])\
+                .select_from(probes.join(inside, inside.c.probe_id == probes.c.probe_id)
+                             .join(Trip, Trip.trip_id == inside.c.trip_id))
+        else:
+            matching_trips = select([probes.c.probe_id, Trip.trip_id])\
+                .where(Trip.user_id == probes.c.user_id)\
+                .where(func.ST_Within(probes.c.line, Trip.geom))
+        if user_id is not None:
+            matching_trips = matching_trips.where(Trip.user_id == user_id)
+        if settings.RELEVANCE_MAX_AGE_DAYS is not None:
+            matching_trips = matching_trips.where(
+                Trip.start_time >= probes.c.latest - settings.RELEVANCE_MAX_AGE_DAYS * MS_PER_DAY)
+        if settings.RELEVANCE_HOURS is not None:
+            matching_trips = matching_trips.column(Trip.start_time_zone.label('time_zone'))
+        if not (settings.MATCH_DIRECTION or settings.ALERT_ALONG_ROUTE):
+            return matching_trips
+        length = func.ST_Length(Trip.geom_path)
+        distance = func.ST_LineLocatePoint(Trip.geom_path, probes.c.point) * length
+        matching_trips = matching_trips.column(distance.label('distance'))
+        if settings.MATCH_DIRECTION:
+            start = func.ST_LineLocatePoint(Trip.geom_path,
+                                            func.ST_StartPoint(probes.c.line)) * length
+            matching_trips = matching_trips.where(start <= distance)
+        return matching_trips
+
+    @classmethod
+    def adjacent_events_query(cls, probes):
+        '''Builds the single query behind adjacent_events_from_point_sequences.
+
+        The probes are a CTE, and the trips matching each probe's line are found
+        once in a second CTE (see matching_trips_select). Each event table is
+        joined against that on trip_id, and an event warns if its point is within
+        settings.ALERT_DISTANCE of the probe's last point (ST_DWithin). With
+        settings.MATCH_DIRECTION, its stored route_distance_m must also be ahead
+        of how far along the trip the driver is.
+
+        With settings.ALERT_ALONG_ROUTE, the distance is measured along the
+        route instead: an event warns if its route_distance_m is within
+        ALERT_DISTANCE of the driver's, or ahead of it by at most that with
+        settings.MATCH_DIRECTION. Those are plain comparisons of numbers, and no
+        geometry is touched per event.
+
+        The three results are combined with UNION ALL. That union only carries
+        (probe_id, event_type, event_id), so it is outer joined back to every
+        event table to hand back mapped objects.
+
+        Events can also be filtered for relevance, see relevance.py: by time of
+        day with settings.RELEVANCE_HOURS, and by their cell's EventCount score
+        with settings.RELEVANCE_MIN_SCORE.
+
+        When all the probes are for one user, and with settings.PARTITION_COUNT,
+        every table is also filtered on that user_id directly, so only that
+        user's partitions are read.
+
+        Args:
+          cls (SpatialQueries): Class object
+          probes (list): (point_group, user_id) pairs, see probes_select
+
+        Returns:
+          Query: yields one (probe_id, SpeedingEvent, HardAccelerationEvent,
+            HardBrakeEvent) tuple per adjacent event, with exactly one of the
+            three events not None. Only SpatialQueries.alert_columns of the
+            events are loaded.
+        '''
+        user_ids = set(user_id for point_group, user_id in probes)
+        user_id = user_ids.pop() if len(user_ids) == 1 else None
+        probes = cls.probes_select(probes).cte('probes')
+        matching_trips = cls.matching_trips_select(probes, user_id).cte('matching_trips')
+        event_selects = []
+        for event_type, event_cls in enumerate(cls.event_classes):
+            event_id = event_cls.__mapper__.primary_key[0]
+            tables = event_cls.__table__\
+                .join(matching_trips, matching_trips.c.trip_id == event_cls.trip_id)\
+                .join(probes, probes.c.probe_id == matching_trips.c.probe_id)
+            if settings.RELEVANCE_MIN_SCORE:
+                cell_x, cell_y = cls.event_cell(event_cls, settings.RELEVANCE_CELL)
+                tables = tables.outerjoin(EventCount, and_(EventCount.user_id == probes.c.user_id,
+                                                           EventCount.event_type == event_type,
+                                                           EventCount.cell_x == cell_x,
+                                                           EventCount.cell_y == cell_y))
+            event_select = select([
+                    matching_trips.c.probe_id,
+                    literal(event_type, Integer).label('event_type'),
+                    event_id.label('event_id'),
+                    event_cls.trip_id.label('trip_id'),
+                ])\
+                .select_from(tables)
+            if settings.ALERT_ALONG_ROUTE:
+                ahead = event_cls.route_distance_m - matching_trips.c.distance
+                if settings.MATCH_DIRECTION:
+                    # only events still ahead of the driver
+                    event_select = event_select.where(
+                        ahead.between(0, settings.ALERT_DISTANCE))
+                else:
+                    event_select = event_select.where(
+                        func.abs(ahead) <= settings.ALERT_DISTANCE)
+            else:
+                event_select = event_select.where(func.ST_DWithin(
+                    event_cls.point, probes.c.point, settings.ALERT_DISTANCE))
+                if settings.MATCH_DIRECTION:
+                    # only events still ahead of the driver
+                    event_select = event_select.where(
+                        event_cls.route_distance_m >= matching_trips.c.distance)
+            if user_id is not None and settings.PARTITION_COUNT:
+                event_select = event_select.where(event_cls.user_id == user_id)
+            if settings.RELEVANCE_HOURS is not None:
+                # only events from around this time of day, in the trip's time zone
+                happened = func.to_timestamp(cls.event_time(event_cls) / 1000.0)
+                hours = func.abs(cls.hour_of_day(happened, matching_trips.c.time_zone) -
+                                 cls.hour_of_day(func.now(), matching_trips.c.time_zone))
+                event_select = event_select.where(
+                    func.least(hours, 24 - hours) <= settings.RELEVANCE_HOURS)
+            if settings.RELEVANCE_MIN_SCORE:
+                # cells without a count are those of users whose counts aren't built
+                event_select = event_select.where(
+                    func.coalesce(EventCount.score, settings.RELEVANCE_MIN_SCORE) >=
+                    settings.RELEVANCE_MIN_SCORE)
+            event_selects.append(event_select)
+        adjacent = union_all(*event_selects).alias('adjacent_events')
+        q = session.query(adjacent.c.probe_id, *cls.event_classes).select_from(adjacent)\
+                   .options(*[Load(event_cls).load_only(*cls.alert_columns)
+                              for event_cls in cls.event_classes])
+        for event_type, event_cls in enumerate(cls.event_classes):
+            event_id = event_cls.__mapper__.primary_key[0]
+            on = and_(adjacent.c.event_type == event_type, adjacent.c.event_id == event_id)
+            if user_id is not None and settings.PARTITION_COUNT:
+                on = and_(on, event_cls.user_id == user_id)
+            q = q.outerjoin(event_cls, on)
+        return q.order_by(adjacent.c.probe_id, adjacent.c.trip_id,
+                          adjacent.c.event_type, adjacent.c.event_id)
+
+    @classmethod
+    def adjacent_events_from_point_sequences(cls, probes):
+        '''Batch form of adjacent_events_from_point_sequence, in one round trip.
+
+        Args:
+          cls (SpatialQueries): Class object
+          probes (list): (point_group, user_id) pairs
+
+        Returns:
+          list: a list of events for each probe, in the same order as probes
+        '''
+        results = [[] for probe in probes]
+        # probes with fewer than two points can't match anything
+        queried = [probe_id for probe_id, (point_group, user_id) in enumerate(probes)
+                   if len(point_group) >= 2]
+        if not queried:
+            return results
+        rows = cls.adjacent_events_query([probes[probe_id] for probe_id in queried])
+        if settings.PREPARED_STATEMENTS and len(queried) == 1:
+            # a single probe always compiles to the same SQL; batches vary in size
+            rows = prepared.query_instances(rows)
+        for row in rows:
+            event = next(event for event in row[1:] if event is not None)
+            results[queried[row[0]]].append(event)
+        return results
+
     @classmethod
     def adjacent_events_from_point_sequence(cls, point_group, user_id):
         '''Returns all events within a certain distance of the end of a point sequence.
         
-        This method builds on find_trips_matching_line, get_associated_events,
-        and find_adjacent_events.
+        This gives the same answer as running find_trips_matching_line,
+        get_associated_events and find_adjacent_events by hand, but does all of it
+        in one round trip (see adjacent_events_query). With
+        settings.ALERT_ALONG_ROUTE, settings.ALERT_DISTANCE is measured along
+        each trip's route from the driver instead.
         
         Args:
           cls (SpatialQueries): Class object
@@ -279,16 +779,7 @@ class SpatialQueries:
           list of events, which can be any of SpeedingEvent, HardAccelerationEvent,
           or HardBrakingEvent.
         '''
-        total_adjacent_events = []
-        if len(point_group) < 2:
-            return total_adjacent_events
-        trips_matching_line = cls.find_trips_matching_line(point_group, user_id)
-        for matching_trip in trips_matching_line:
-            events = cls.get_associated_events(matching_trip)
-            proj_point = cls.\
-                         convert_geographic_coordinates_to_projected_point(*point_group[-1])
-            total_adjacent_events.extend(cls.find_adjacent_events(proj_point, events))
-        return total_adjacent_events
+        return cls.adjacent_events_from_point_sequences([(point_group, user_id)])[0]
 
     @staticmethod
     def point_to_string(lat, lon):
@@ -303,10 +794,18 @@ class SpatialQueries:
         '''
         return "POINT({} {})".format(lon, lat)
     
+    @staticmethod
+    def ewkb_to_geometry(ewkb):
+        '''Wraps EWKB built by the projection module as a PostGIS geometry expression.'''
+        return func.ST_GeomFromEWKB(literal(ewkb, LargeBinary))
+
     @classmethod
     def convert_geographic_coordinates_to_projected_point(cls, lat, lon):
         '''Returns a projected point from geographic coordinates.
         
+        The projection happens in Python (see projection.py); only the finished
+        point is sent to the database.
+
         Args:
           cls (SpatialQueries): Class object
           lat (float): latitude of geographic coordinate
@@ -317,11 +816,8 @@ class SpatialQueries:
             projected point.
           
         '''
-        point_string = cls.point_to_string(lat, lon)
-        return func.ST_Transform(
-            func.ST_GeometryFromText(point_string, settings.TARGET_DATUM),
-            settings.TARGET_PROJECTION
-        )
+        (x, y), = projection.to_projected([(lat, lon)])
+        return cls.ewkb_to_geometry(projection.point_ewkb(x, y))
 
     @classmethod
     def convert_projected_point_to_geographic_coordinates(cls, point):
@@ -329,11 +825,18 @@ class SpatialQueries:
 
         Args:
           cls (SpatialQueries): Class object
-          point (geometry): PostGIS Geometry type of a projected point
+          point (geometry): PostGIS Geometry type of a projected point. Points
+            that have already been fetched (a WKBElement, or the hex EWKB string
+            an untyped query returns) are converted without touching the database.
 
         Returns:
           tuple of (latitude, longitude) coordinates
         '''
+        if isinstance(point, WKBElement):
+            point = point.data
+        if not isinstance(point, ClauseElement):
+            (lat, lon), = projection.to_geographic([projection.wkb_point_coordinates(point)])
+            return lat, lon
         s = select([
             func.ST_Transform(func.ST_WKBToSQL(point), settings.TARGET_DATUM).label('p')
         ])
@@ -366,6 +869,50 @@ class SpatialQueries:
         '''
         return 'SRID={};LINESTRING({})'.format(srid, cls.path_to_string(path))
     
+    @staticmethod
+    def buffered_path(path, distance=None, simplify=True):
+        '''Returns the polygon that lines are matched against for a path.
+
+        A raw GPS path has a vertex every second or so, and buffering it as is
+        gives a polygon with thousands of vertices, all of which ST_Within has to
+        test. The path is first simplified by settings.PATH_SIMPLIFY_TOLERANCE,
+        which moves it by at most that much, and the buffer's rounded ends and
+        joins use only settings.BUFFER_QUAD_SEGS segments per quarter circle.
+        Both would shrink the matched region, so the radius is widened by the
+        simplify tolerance, and then by the most those segments cut inside
+        their arc. The result covers the full resolution buffer of distance.
+
+        Args:
+          path (Geometry): projected linestring
+          distance (float): buffer radius, settings.MAX_GPS_ERROR_TOLERANCE by default
+          simplify (bool): False gives the plain full resolution buffer
+
+        Returns:
+          Geometry: the buffer polygon expression
+        '''
+        if distance is None:
+            distance = settings.MAX_GPS_ERROR_TOLERANCE
+        if not simplify:
+            return func.ST_Buffer(path, distance)
+        return func.ST_Buffer(
+            func.ST_SimplifyPreserveTopology(path, settings.PATH_SIMPLIFY_TOLERANCE),
+            SpatialQueries.buffer_radius(distance),
+            'quad_segs={}'.format(settings.BUFFER_QUAD_SEGS))
+
+    @staticmethod
+    def buffer_radius(distance=None):
+        '''The radius buffered_path buffers a simplified path by, for distance.'''
+        if distance is None:
+            distance = settings.MAX_GPS_ERROR_TOLERANCE
+        # a segment's midpoint is cos(pi / (4 * quad_segs)) of the radius out
+        return (distance + settings.PATH_SIMPLIFY_TOLERANCE) / \
+            math.cos(math.pi / (4 * settings.BUFFER_QUAD_SEGS))
+
+    @staticmethod
+    def match_radius():
+        '''How far from a trip's full resolution path a point inside its buffer can be.'''
+        return SpatialQueries.buffer_radius() + settings.PATH_SIMPLIFY_TOLERANCE
+
     @staticmethod
     def find_line_substring(path, start, end):
         '''Returns a substring from start to end distances of a given path.
@@ -404,10 +951,7 @@ class SpatialQueries:
         Returns:
           Geometry: A postgis Geometry object
         '''
-        return func.ST_Transform(
-            func.ST_GeometryFromText(cls.construct_linestring_string(settings.TARGET_DATUM, line)),
-            settings.TARGET_PROJECTION
-        )
+        return cls.ewkb_to_geometry(projection.linestring_ewkb(projection.to_projected(line)))
         
 
     @classmethod
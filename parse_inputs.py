@@ -1,4 +1,6 @@
+import io
 import json
+import multiprocessing
 
 from polyline.codec import PolylineCodec as PC
 
@@ -13,4 +15,104 @@ def get_json(*paths):
             item['path'] = pc.decode(item['path'])
         all_json.extend(j)
     return all_json
-          
+
+def iter_json_array(f, chunk_size=1 << 20):
+    '''Yields the elements of a top-level json array one at a time.
+
+    Only the element being decoded (plus one chunk) is held in memory, so this
+    works on exports far larger than memory. Raises ValueError on malformed input.
+
+    Args:
+      f (file): text mode file object positioned at the start of the array
+      chunk_size (int): characters to read at a time
+    '''
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    pos = 0
+    eof = not buf
+    expecting = '['
+    while True:
+        # skip whitespace and separators, refilling the buffer as needed
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+        if pos == len(buf):
+            raise ValueError('Unexpected end of json array')
+        if expecting == '[':
+            if buf[pos] != '[':
+                raise ValueError('Expected a json array')
+            pos += 1
+            expecting = 'first'
+            continue
+        if buf[pos] == ']' and expecting in ('first', ','):
+            return
+        if expecting == ',':
+            if buf[pos] != ',':
+                raise ValueError("Expected ',' or ']' at character {}".format(pos))
+            pos += 1
+            expecting = 'value'
+            continue
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            # the element runs past the end of the buffer; read more and retry
+            more = f.read(max(chunk_size, len(buf)))
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield item
+        buf, pos = buf[end:], 0
+        expecting = ','
+
+def decode_path(path):
+    '''Decodes one polyline; top-level so it can be sent to worker processes.'''
+    return PC().decode(path)
+
+def iter_trips(paths, processes=None, window=1000):
+    '''Streaming counterpart of get_json: yields trips one at a time.
+
+    Trips are read incrementally with iter_json_array, and the polyline paths of
+    every `window` trips are decoded in parallel by a process pool. At most one
+    window of trips is held in memory at a time.
+
+    Args:
+      paths (list): json export files, read in order
+      processes (int): worker processes; None means one per cpu, 0 decodes inline
+      window (int): trips read ahead and decoded together
+
+    Yields:
+      dict: a trip with its path decoded to a list of (lat, lon)
+    '''
+    pool = multiprocessing.Pool(processes) if processes != 0 else None
+    try:
+        for path in paths:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                batch = []
+                for trip in iter_json_array(f):
+                    batch.append(trip)
+                    if len(batch) >= window:
+                        for trip in decode_batch(batch, pool):
+                            yield trip
+                        batch = []
+                for trip in decode_batch(batch, pool):
+                    yield trip
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def decode_batch(batch, pool):
+    encoded = [trip['path'] for trip in batch]
+    if pool is None:
+        decoded = [decode_path(path) for path in encoded]
+    else:
+        decoded = pool.map(decode_path, encoded, chunksize=max(1, len(encoded) // 32))
+    for trip, path in zip(batch, decoded):
+        trip['path'] = path
+    return batch
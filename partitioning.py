@@ -0,0 +1,88 @@
+'''Hash partitioning of the per-user tables by user_id.
+
+Every alert query is for a single user, yet with one trips table and one table
+per event type, that user's rows share their indexes with the whole fleet's.
+Index depth, and the cache churn from other users' pages, grow with the fleet.
+With settings.PARTITION_COUNT above 0, tables created afterwards whose info
+has a 'partition_key' are created PARTITION BY HASH on that column, with that
+many partitions. Their indexes are built per partition. When a query filters on
+a single user_id, Postgres only reads that user's partition. It prunes while
+planning if the value is a literal, or when execution starts if it is a
+parameter, as in prepared.py's statements. A user's trips and events then stay
+on a few pages of small indexes, however many other users there are.
+
+This needs Postgres 11 or later. Postgres doesn't allow unique constraints on a
+partitioned table unless they include the partition key, so:
+
+  * primary keys and unique columns of a partitioned table get user_id added;
+    ids stay unique because they come from sequences, but trip_id_string is
+    then only unique per user
+  * foreign keys that reference a partitioned table are left out of the DDL,
+    while the models keep them, so relationships still work
+
+The setting only changes how tables are created. Existing tables are not
+converted. To partition a populated database, export it, set PARTITION_COUNT,
+run DatabaseManager.clear_database_and_create_tables and load it again.
+'''
+from sqlalchemy import Table, UniqueConstraint, ForeignKeyConstraint
+from sqlalchemy.event import listens_for
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import text
+
+import settings
+
+def partition_key(table):
+    '''The column table is partitioned on, or None if it isn't partitioned.'''
+    if not settings.PARTITION_COUNT:
+        return None
+    return table.info.get('partition_key')
+
+def partition_names(table):
+    return ['{}_p{}'.format(table.name, remainder)
+            for remainder in range(settings.PARTITION_COUNT)]
+
+@compiles(CreateTable, 'postgresql')
+def create_table(create, compiler, **kw):
+    '''CREATE TABLE as usual, unless partitioning is on.
+
+    Then a partitioned table is created PARTITION BY HASH on its partition
+    key, with that key added to its primary key and unique constraints.
+    Foreign keys to partitioned tables are dropped from every table.
+    '''
+    if not settings.PARTITION_COUNT:
+        return compiler.visit_create_table(create)
+    table = create.element
+    preparer = compiler.preparer
+    key = partition_key(table)
+
+    def with_key(columns):
+        names = [column.name for column in columns]
+        if key is not None and key not in names:
+            names.append(key)
+        return ', '.join(preparer.quote(name) for name in names)
+
+    lines = [compiler.process(column) for column in create.columns]
+    if table.primary_key:
+        lines.append('PRIMARY KEY ({})'.format(with_key(table.primary_key.columns)))
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            lines.append('UNIQUE ({})'.format(with_key(constraint.columns)))
+        elif isinstance(constraint, ForeignKeyConstraint):
+            if partition_key(constraint.elements[0].column.table) is None:
+                lines.append(compiler.process(constraint))
+    sql = '\nCREATE TABLE {} (\n\t{}\n)'.format(preparer.format_table(table),
+                                              ', \n\t'.join(lines))
+    if key is not None:
+        sql += ' PARTITION BY HASH ({})'.format(preparer.quote(key))
+    return sql + '\n\n'
+
+@listens_for(Table, 'after_create')
+def create_partitions(table, connection, **kw):
+    '''Creates the partitions of a partitioned table once the table exists.'''
+    if partition_key(table) is None:
+        return
+    for remainder, name in enumerate(partition_names(table)):
+        connection.execute(text(
+            'CREATE TABLE {} PARTITION OF {} FOR VALUES WITH (MODULUS {}, REMAINDER {})'
+            .format(name, table.name, settings.PARTITION_COUNT, remainder)))
@@ -0,0 +1,142 @@
+'''Server-side prepared statements for queries with the same shape on every request.
+
+The alert query for one point sequence, and the username lookup, only differ
+between requests in their parameter values, yet Postgres parses and plans them
+from scratch every time. Here a statement is compiled once, its pyformat
+parameters are rewritten to $1, $2, ... and it is sent as PREPARE under a name
+derived from its SQL. After that, each request only sends EXECUTE name(...).
+
+Prepared statements belong to a database connection, so the names already
+prepared on one are remembered in its pool record's info dict, which is
+emptied whenever the pool opens a new connection. A PREPARE is issued inside
+whatever transaction the connection is in, so its name is only recorded as
+prepared once that transaction commits. If it rolls back instead, the name is
+kept aside as unsure, and the next use asks pg_prepared_statements whether the
+statement survived before preparing it again, rather than trusting it and
+failing with "prepared statement does not exist".
+'''
+import hashlib
+import re
+
+from sqlalchemy import event
+from sqlalchemy.sql import bindparam, text
+from sqlalchemy.types import NullType
+
+from engine import engine
+
+# connection info keys: names known to be prepared, names prepared in the open
+# transaction, and names whose transaction rolled back
+PREPARED = 'prepared_statements'
+PENDING = 'prepared_statements_pending'
+UNSURE = 'prepared_statements_unsure'
+
+PARAMETER = re.compile(r'%\((\w+)\)s')
+
+def prepared_form(statement, dialect):
+    '''Splits a statement into what PREPARE and EXECUTE need.
+
+    Args:
+      statement (Select): the statement to prepare
+      dialect (Dialect): a pyformat dialect, as psycopg2's is
+
+    Returns:
+      tuple: (name, prepare_sql, parameters), where parameters is a list of
+        bindparams named p1, p2, ... carrying the statement's values and types
+    '''
+    compiled = statement.compile(dialect=dialect)
+    names = []
+    def placeholder(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return '${}'.format(names.index(name) + 1)
+    sql = PARAMETER.sub(placeholder, compiled.string).replace('%%', '%')
+    values = compiled.construct_params()
+    types = []
+    parameters = []
+    for position, parameter in enumerate(names, 1):
+        type_ = compiled.binds[parameter].type
+        # Postgres infers the type of parameters declared unknown
+        types.append('unknown' if isinstance(type_, NullType)
+                     else type_.compile(dialect=dialect))
+        parameters.append(bindparam('p{}'.format(position), values[parameter], type_=type_))
+    # the same SQL with differently typed values needs a statement of its own
+    definition = '({}) AS {}'.format(', '.join(types), sql) if types else 'AS {}'.format(sql)
+    name = 'prepared_' + hashlib.md5(definition.encode('utf-8')).hexdigest()[:16]
+    prepare_sql = 'PREPARE {} {}'.format(name, definition)
+    return name, prepare_sql, parameters
+
+def execute(connection, statement):
+    '''Executes statement as a prepared statement, preparing it on first use.
+
+    Args:
+      connection (Connection): the connection to run on
+      statement (Select): a statement whose SQL doesn't depend on its values
+
+    Returns:
+      ResultProxy: typed like the result of connection.execute(statement)
+    '''
+    name, prepare_sql, parameters = prepared_form(statement, connection.dialect)
+    prepared = connection.info.setdefault(PREPARED, set())
+    pending = connection.info.setdefault(PENDING, set())
+    if name not in prepared and name not in pending:
+        unsure = connection.info.setdefault(UNSURE, set())
+        # straight to the cursor, so the driver doesn't treat % as a placeholder
+        cursor = connection.connection.cursor()
+        try:
+            if name in unsure:
+                unsure.discard(name)
+                cursor.execute('SELECT 1 FROM pg_prepared_statements WHERE name = %s',
+                               (name,))
+                if cursor.fetchone() is not None:
+                    prepared.add(name)
+            if name not in prepared:
+                cursor.execute(prepare_sql)
+                pending.add(name)
+        finally:
+            cursor.close()
+    if parameters:
+        clause = '({})'.format(', '.join(':' + p.key for p in parameters))
+    else:
+        clause = ''
+    execute_text = text('EXECUTE {}{}'.format(name, clause)).bindparams(*parameters)
+    return connection.execute(execute_text.columns(*statement.c))
+
+def query_instances(query):
+    '''Runs an ORM query as a prepared statement.
+
+    Returns:
+      iterator: what iterating over query would give
+    '''
+    query = query.with_labels()
+    return query.instances(execute(query.session.connection(), query.statement))
+
+def settle(info, committed):
+    '''Moves the names prepared in a transaction that just ended.'''
+    pending = info.pop(PENDING, None)
+    if pending:
+        info.setdefault(PREPARED if committed else UNSURE, set()).update(pending)
+
+@event.listens_for(engine, 'commit')
+def prepared_committed(connection):
+    settle(connection.info, True)
+
+@event.listens_for(engine, 'rollback')
+def prepared_rolled_back(connection):
+    settle(connection.info, False)
+
+@event.listens_for(engine, 'rollback_savepoint')
+def prepared_rolled_back_to_savepoint(connection, name, context):
+    # the names may have been prepared before the savepoint; checked on next use
+    settle(connection.info, False)
+
+@event.listens_for(engine.pool, 'reset')
+def prepared_reset(dbapi_connection, connection_record):
+    '''The pool rolls back what a connection left open as it is returned.'''
+    settle(connection_record.info, False)
+
+@event.listens_for(engine.pool, 'connect')
+def forget_prepared_statements(dbapi_connection, connection_record):
+    '''A new connection has none of the statements prepared on the one it replaces.'''
+    for key in (PREPARED, PENDING, UNSURE):
+        connection_record.info.pop(key, None)
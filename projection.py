@@ -0,0 +1,189 @@
+'''Vectorized conversion between geographic coordinates and UTM, in NumPy.
+
+This replaces sending every coordinate to PostGIS just to ST_Transform it.
+Whole arrays of (lat, lon) are projected in one pass with the Kruger series for
+the transverse Mercator projection (the same one PROJ uses), which is good to
+well under a millimetre inside a UTM zone. Geometries are then handed to PostGIS
+as EWKB built straight from the coordinate array, so no per-point WKT has to be
+formatted either.
+
+Like PostGIS, this treats srid 4326 (WGS84) and the NAD83 datum of the 269xx
+zones as identical, so going from one to the other is just the projection.
+'''
+import binascii
+import struct
+
+import numpy as np
+
+import settings
+
+# (semi-major axis, flattening)
+GRS80 = (6378137.0, 1 / 298.257222101)
+WGS84 = (6378137.0, 1 / 298.257223563)
+
+WKB_POINT = 1
+WKB_LINESTRING = 2
+EWKB_SRID_FLAG = 0x20000000
+
+class TransverseMercator(object):
+    '''A transverse Mercator projection, with Kruger series to fourth order in n.'''
+
+    def __init__(self, ellipsoid, central_meridian, scale_factor=0.9996,
+                 false_easting=500000.0, false_northing=0.0):
+        a, f = ellipsoid
+        n = f / (2 - f)
+        self.lon0 = np.radians(central_meridian)
+        self.k0 = scale_factor
+        self.false_easting = false_easting
+        self.false_northing = false_northing
+        self.e = np.sqrt(f * (2 - f))
+        # rectifying radius
+        self.A = a / (1 + n) * (1 + n ** 2 / 4 + n ** 4 / 64)
+        self.alpha = np.array([
+            n / 2 - 2 * n ** 2 / 3 + 5 * n ** 3 / 16 + 41 * n ** 4 / 180,
+            13 * n ** 2 / 48 - 3 * n ** 3 / 5 + 557 * n ** 4 / 1440,
+            61 * n ** 3 / 240 - 103 * n ** 4 / 140,
+            49561 * n ** 4 / 161280,
+        ])
+        self.beta = np.array([
+            n / 2 - 2 * n ** 2 / 3 + 37 * n ** 3 / 96 - n ** 4 / 360,
+            n ** 2 / 48 + n ** 3 / 15 - 437 * n ** 4 / 1440,
+            17 * n ** 3 / 480 - 37 * n ** 4 / 840,
+            4397 * n ** 4 / 161280,
+        ])
+        self.delta = np.array([
+            2 * n - 2 * n ** 2 / 3 - 2 * n ** 3 + 116 * n ** 4 / 45,
+            7 * n ** 2 / 3 - 8 * n ** 3 / 5 - 227 * n ** 4 / 45,
+            56 * n ** 3 / 15 - 136 * n ** 4 / 35,
+            4279 * n ** 4 / 630,
+        ])
+        # 2j for j = 1..4, shaped to broadcast against a column of coordinates
+        self.harmonics = np.arange(2, 10, 2)[:, np.newaxis]
+
+    @classmethod
+    def from_srid(cls, srid):
+        '''Returns the projection for a NAD83 (269xx) or WGS84 (326xx, 327xx) UTM srid.'''
+        if 26901 <= srid <= 26923:
+            ellipsoid, zone, false_northing = GRS80, srid - 26900, 0.0
+        elif 32601 <= srid <= 32660:
+            ellipsoid, zone, false_northing = WGS84, srid - 32600, 0.0
+        elif 32701 <= srid <= 32760:
+            ellipsoid, zone, false_northing = WGS84, srid - 32700, 10000000.0
+        else:
+            raise ValueError('srid {} is not a supported UTM zone'.format(srid))
+        return cls(ellipsoid, zone * 6 - 183, false_northing=false_northing)
+
+    def forward(self, lat, lon):
+        '''Returns (easting, northing) arrays for arrays of degrees.'''
+        phi = np.radians(np.asarray(lat, dtype=np.float64))
+        lam = np.radians(np.asarray(lon, dtype=np.float64)) - self.lon0
+        sin_phi = np.sin(phi)
+        # tangent of the conformal latitude
+        t = np.sinh(np.arctanh(sin_phi) - self.e * np.arctanh(self.e * sin_phi))
+        xi_prime = np.arctan2(t, np.cos(lam))
+        eta_prime = np.arctanh(np.sin(lam) / np.sqrt(1 + t ** 2))
+        xi = xi_prime + np.sum(self.alpha[:, np.newaxis] *
+                               np.sin(self.harmonics * xi_prime) *
+                               np.cosh(self.harmonics * eta_prime), axis=0)
+        eta = eta_prime + np.sum(self.alpha[:, np.newaxis] *
+                                 np.cos(self.harmonics * xi_prime) *
+                                 np.sinh(self.harmonics * eta_prime), axis=0)
+        x = self.false_easting + self.k0 * self.A * eta
+        y = self.false_northing + self.k0 * self.A * xi
+        return x, y
+
+    def inverse(self, x, y):
+        '''Returns (lat, lon) arrays in degrees for arrays of easting and northing.'''
+        xi = (np.asarray(y, dtype=np.float64) - self.false_northing) / (self.k0 * self.A)
+        eta = (np.asarray(x, dtype=np.float64) - self.false_easting) / (self.k0 * self.A)
+        xi_prime = xi - np.sum(self.beta[:, np.newaxis] *
+                               np.sin(self.harmonics * xi) *
+                               np.cosh(self.harmonics * eta), axis=0)
+        eta_prime = eta - np.sum(self.beta[:, np.newaxis] *
+                                 np.cos(self.harmonics * xi) *
+                                 np.sinh(self.harmonics * eta), axis=0)
+        chi = np.arcsin(np.sin(xi_prime) / np.cosh(eta_prime))
+        phi = chi + np.sum(self.delta[:, np.newaxis] * np.sin(self.harmonics * chi), axis=0)
+        lam = self.lon0 + np.arctan2(np.sinh(eta_prime), np.cos(xi_prime))
+        return np.degrees(phi), np.degrees(lam)
+
+projection = TransverseMercator.from_srid(settings.TARGET_PROJECTION)
+
+def to_projected(points):
+    '''Projects a sequence of (lat, lon) pairs.
+
+    Args:
+      points (sequence): (lat, lon) pairs, in settings.TARGET_DATUM
+
+    Returns:
+      numpy.ndarray: shape (n, 2) array of (x, y) in settings.TARGET_PROJECTION
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    x, y = projection.forward(points[:, 0], points[:, 1])
+    return np.column_stack((x, y))
+
+def to_geographic(xy):
+    '''Inverse of to_projected: (n, 2) array of (x, y) to (n, 2) array of (lat, lon).'''
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    lat, lon = projection.inverse(xy[:, 0], xy[:, 1])
+    return np.column_stack((lat, lon))
+
+def path_distances(xy):
+    '''Cumulative distance along a projected path, starting at 0.'''
+    segment_lengths = np.hypot(*np.diff(xy, axis=0).T)
+    return np.concatenate(([0.0], np.cumsum(segment_lengths)))
+
+def line_substring(xy, distances, start, end):
+    '''Returns the part of a path between two distances from its start.
+
+    This is ST_LineSubstring(path, start / ST_Length(path), end / ST_Length(path)),
+    except that out of range distances are clamped instead of raising.
+    '''
+    start = min(max(start, 0.0), distances[-1])
+    end = min(max(end, start), distances[-1])
+    inside = (distances > start) & (distances < end)
+    start_point = [np.interp(start, distances, xy[:, 0]), np.interp(start, distances, xy[:, 1])]
+    end_point = [np.interp(end, distances, xy[:, 0]), np.interp(end, distances, xy[:, 1])]
+    return np.vstack(([start_point], xy[inside], [end_point]))
+
+def locate_distance(xy, distances, x, y):
+    '''Metres along the path to its point nearest (x, y).
+
+    ST_LineLocatePoint times ST_Length, given path_distances(xy).
+    '''
+    a = xy[:-1]
+    d = xy[1:] - a
+    length_squared = (d * d).sum(axis=1)
+    t = ((x - a[:, 0]) * d[:, 0] + (y - a[:, 1]) * d[:, 1]) / np.where(length_squared == 0, 1.0,
+                                                                     length_squared)
+    t = np.clip(t, 0.0, 1.0)
+    nearest = np.argmin(np.hypot(a[:, 0] + t * d[:, 0] - x, a[:, 1] + t * d[:, 1] - y))
+    return float(distances[nearest] + t[nearest] * np.sqrt(length_squared[nearest]))
+
+def locate_point(xy, distances, x, y):
+    '''ST_LineLocatePoint: the fraction of the path's length up to its point nearest (x, y).'''
+    if distances[-1] == 0:
+        return 0.0
+    return locate_distance(xy, distances, x, y) / distances[-1]
+
+def point_ewkb(x, y, srid=settings.TARGET_PROJECTION):
+    '''Little-endian EWKB for a single point.'''
+    return struct.pack('<BIIdd', 1, WKB_POINT | EWKB_SRID_FLAG, srid, x, y)
+
+def linestring_ewkb(xy, srid=settings.TARGET_PROJECTION):
+    '''Little-endian EWKB for a linestring through the rows of an (n, 2) array.'''
+    xy = np.ascontiguousarray(xy, dtype='<f8')
+    header = struct.pack('<BIII', 1, WKB_LINESTRING | EWKB_SRID_FLAG, srid, len(xy))
+    return header + xy.tobytes()
+
+def wkb_point_coordinates(wkb):
+    '''Returns (x, y) of a WKB or EWKB point, given as raw bytes or a hex string.'''
+    if isinstance(wkb, type(u'')):
+        wkb = wkb.encode('ascii')
+    wkb = bytes(wkb)
+    if wkb[:2] in (b'00', b'01'):
+        wkb = binascii.unhexlify(wkb)
+    byte_order = '<' if wkb[:1] == b'\x01' else '>'
+    geometry_type, = struct.unpack(byte_order + 'I', wkb[1:5])
+    offset = 9 if geometry_type & EWKB_SRID_FLAG else 5
+    return struct.unpack(byte_order + 'dd', wkb[offset:offset + 16])
@@ -0,0 +1,102 @@
+'''Which of a user's past events are still worth a warning.
+
+Left alone, every event ever recorded near a driver's position warns. A long
+history then means more candidate events on every request, and warnings about
+spots the driver had trouble with years ago, or only at rush hour. Three
+settings narrow this down, each off by default. They apply to the SpatialQueries
+backend:
+
+  * RELEVANCE_MAX_AGE_DAYS: only trips that started within this many days of
+    the user's newest trip are matched, so neither they nor their events are
+    read. Age is measured from the newest trip, not the clock, so a history
+    doesn't go stale while its driver isn't driving. The (user_id, start_time)
+    index on trips finds both the newest trip and the window.
+  * RELEVANCE_HOURS: an event only warns if it happened within this many hours
+    of the current time of day, local to its trip's time zone.
+  * RELEVANCE_MIN_SCORE: an event only warns where events of its type keep
+    happening. A user's events are counted per type and per RELEVANCE_CELL metre
+    grid cell into event_counts. Each event weighs 1, halved for every
+    RELEVANCE_HALF_LIFE_DAYS it happened before the newest trip. Events in
+    cells whose total is below the minimum are dropped.
+
+The counts are built here, in one aggregate query per event type.
+DatabaseManager rebuilds a user's counts whenever their history changes,
+while RELEVANCE_MIN_SCORE is set. A user without counts gets every event, as
+though the setting were off. Rebuild the counts after changing the cell size,
+half-life or maximum age:
+
+  python relevance.py [username ...]
+'''
+import sys
+import time
+
+from sqlalchemy import Integer, func, literal
+from sqlalchemy.sql import select
+
+from engine import engine
+from models import EventCount, Trip, User, MS_PER_DAY
+from models import SpatialQueries as SQ
+import settings
+
+def counts_select(user_id, event_type, latest):
+    '''Rows of event_counts for one user and event type.
+
+    Args:
+      user_id (int)
+      event_type (int): index into SpatialQueries.event_classes
+      latest (int): start_time of the user's newest trip
+    '''
+    event_cls = SQ.event_classes[event_type]
+    happened = SQ.event_time(event_cls)
+    cell_x, cell_y = SQ.event_cell(event_cls, settings.RELEVANCE_CELL)
+    if settings.RELEVANCE_HALF_LIFE_DAYS is None:
+        weight = literal(1.0)
+    else:
+        weight = func.power(0.5, (latest - happened) /
+                            float(settings.RELEVANCE_HALF_LIFE_DAYS * MS_PER_DAY))
+    s = select([literal(user_id, Integer), literal(event_type, Integer), cell_x, cell_y,
+                func.count(), func.sum(weight), func.max(happened)])\
+        .select_from(event_cls.__table__.join(Trip, Trip.trip_id == event_cls.trip_id))\
+        .where(Trip.user_id == user_id)\
+        .group_by(cell_x, cell_y)
+    if settings.RELEVANCE_MAX_AGE_DAYS is not None:
+        s = s.where(Trip.start_time >= latest - settings.RELEVANCE_MAX_AGE_DAYS * MS_PER_DAY)
+    return s
+
+def build(user_id):
+    '''Replaces a user's event counts with freshly computed ones.
+
+    Returns:
+      int: number of cells written
+    '''
+    columns = [EventCount.user_id, EventCount.event_type, EventCount.cell_x,
+               EventCount.cell_y, EventCount.events, EventCount.score, EventCount.last_time]
+    written = 0
+    with engine.begin() as connection:
+        delete(connection, user_id)
+        latest = connection.execute(select([func.max(Trip.start_time)])
+                                    .where(Trip.user_id == user_id)).scalar()
+        if latest is None:
+            return 0
+        for event_type in range(len(SQ.event_classes)):
+            result = connection.execute(EventCount.__table__.insert().from_select(
+                columns, counts_select(user_id, event_type, latest)))
+            written += result.rowcount
+    return written
+
+def delete(connection, user_id):
+    connection.execute(EventCount.__table__.delete().where(EventCount.user_id == user_id))
+
+def invalidate(user_id):
+    '''Drops a user's counts, which are stale once their history changes.'''
+    with engine.begin() as connection:
+        delete(connection, user_id)
+
+if __name__ == '__main__':
+    users = select([User.user_id, User.username])
+    if len(sys.argv) > 1:
+        users = users.where(User.username.in_(sys.argv[1:]))
+    for user_id, username in engine.execute(users).fetchall():
+        start = time.time()
+        count = build(user_id)
+        print('{}: {} cells in {:.2f}s'.format(username, count, time.time() - start))
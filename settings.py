@@ -5,6 +5,81 @@ TARGET_PROJECTION = 26910 # UTM Zone 10 (Western portion of California)
 TARGET_DATUM = 4326
 MAX_GPS_ERROR_TOLERANCE = 20 # in meters, arbitrary choice
 ALERT_DISTANCE = 200 # in meters, also arbitrary
+# trip buffers are built from paths simplified by this much (meters), with this
+# many segments per quarter circle; see SpatialQueries.buffered_path
+PATH_SIMPLIFY_TOLERANCE = MAX_GPS_ERROR_TOLERANCE / 4.0
+BUFFER_QUAD_SEGS = 2
+# only match trips driven the same way as the driver, and only warn about events
+# ahead of them (postgis backend only)
+MATCH_DIRECTION = False
+# fraction of a line's points that must be inside a trip's buffer for the trip to
+# match; 1 means the whole line must be within it
+MATCH_FRACTION = 1.0
+# measure ALERT_DISTANCE along each matching trip's route from the driver, with
+# events' stored route_distance_m, instead of in a straight line from the driver
+ALERT_ALONG_ROUTE = False
+# which backend answers alerts: 'postgis', 'memory' for spatial_index,
+# 'tiles' for alert_tiles, or 'corridors' for corridors
+ALERT_BACKEND = 'postgis'
+# user histories the memory backend (spatial_index.py) keeps loaded before the
+# least recently used go
+SPATIAL_INDEX_SIZE = 1000
+# seconds a process trusts its copy of a user's history version before asking the
+# database again; histories and trip sessions older than the version are reloaded,
+# so loads from other processes show up within this long (spatial_index.py)
+HISTORY_VERSION_TTL = 5
+# trip sessions (trip_sessions.py): seconds a device's session outlives its last
+# ping, and how many sessions are kept before the least recently used go
+TRIP_SESSION_TTL = 300
+TRIP_SESSION_MAX = 10000
+# alert tiles (alert_tiles.py): cell edge in meters, and whether warnings are
+# checked against the exact position or just the cell
+ALERT_TILE_SIZE = 25.0
+ALERT_TILE_EXACT = True
+# corridors (corridors.py): how far apart two trips' paths may be and still be
+# the same route, and how close events must be to be counted as the same spot
+CORRIDOR_TOLERANCE = 10
+CORRIDOR_EVENT_MERGE_DISTANCE = 30
+# alert response cache (caching.py): entries, seconds they stay valid, grid cell
+# edge in meters, heading sectors, and meters a device must move to have a heading
+ALERT_CACHE_SIZE = 10000
+ALERT_CACHE_TTL = 10
+ALERT_CACHE_CELL = 25.0
+ALERT_CACHE_HEADINGS = 8
+ALERT_CACHE_MIN_MOVEMENT = 5.0
+# username -> user_id cache (caching.py); unknown usernames are remembered for
+# the shorter USER_ID_NEGATIVE_TTL, so a new user isn't turned away for long
+USER_ID_CACHE_SIZE = 10000
+USER_ID_CACHE_TTL = 300
+USER_ID_NEGATIVE_TTL = 30
+# run the username lookup and single point sequence alert queries as server-side
+# prepared statements (prepared.py)
+PREPARED_STATEMENTS = True
+# positions a streaming connection keeps as its point sequence (async_app.py)
+STREAM_WINDOW = 3
+# event relevance for SpatialQueries (relevance.py). Trips that started more than
+# RELEVANCE_MAX_AGE_DAYS before the user's newest trip are ignored, and events
+# only warn within RELEVANCE_HOURS of the time of day they happened at; None
+# turns either off. With RELEVANCE_MIN_SCORE, an event only warns if its
+# RELEVANCE_CELL meter cell has events of its type weighing at least that much,
+# where each weighs 1, halving every RELEVANCE_HALF_LIFE_DAYS before the newest trip
+RELEVANCE_MAX_AGE_DAYS = None
+RELEVANCE_HOURS = None
+RELEVANCE_HALF_LIFE_DAYS = None
+RELEVANCE_MIN_SCORE = 0
+RELEVANCE_CELL = 25.0
+# hash partitions of trips and the event tables by user_id, for tables created
+# from now on (partitioning.py); 0 leaves them unpartitioned. Needs Postgres 11+
+PARTITION_COUNT = 0
+# connection pool, see engine.py
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 30 # seconds to wait for a free connection
+DB_POOL_RECYCLE = 3600 # seconds before a connection is replaced
+DB_POOL_PRE_PING = True
+# statements of the web app (app.py, async_app.py) running longer than this are
+# cancelled; ingestion, migrations and other maintenance run without a limit
+DB_STATEMENT_TIMEOUT_MS = 10000
 USERNAME = os.environ['AUTOMATIC_TEST_USERNAME']
 OS_USERNAME = 'jdp'
 SERVER_IP = os.environ['JPOLER_SERVER_IP']
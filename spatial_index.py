@@ -0,0 +1,318 @@
+'''In-process spatial index, so alerts can be answered without querying PostGIS.
+
+A user's history only changes when new trips are inserted, so the first alert
+for a user loads every trip path and event point for that user into a uniform
+grid keyed on projected (UTM) coordinates. Later alerts are projected with
+projection.py and answered from the grid, without any database access, until
+the user's history changes. Only settings.SPATIAL_INDEX_SIZE users' histories
+are kept; the least recently used are dropped and loaded again when needed.
+
+Trips are usually loaded by another process (ingest.py, a migration) than the
+one answering alerts, so DatabaseManager.user_history_changed bumps
+users.history_version as well as dropping this process's copies. Every history
+remembers the version it was loaded at, and is reloaded once the database has
+a newer one. A process only reads the version once per
+settings.HISTORY_VERSION_TTL seconds per user, so another process's load shows
+up within that long, for the cost of a primary key lookup.
+
+ST_Within(line, trip.geom) is approximated by checking that every vertex of
+the line is within SpatialQueries.match_radius() of the path. trip.geom is the
+simplified path buffered by SpatialQueries.buffered_path, and nothing inside it
+is further than that from the full resolution path, so the memory backend
+matches every trip PostGIS does, and sometimes a few more whose buffer the line
+misses by a few metres. Otherwise the two only disagree when a segment between
+two vertices bulges out of the buffer, which can't really happen for a few
+points sampled seconds apart.
+
+With settings.MATCH_DIRECTION or settings.ALERT_ALONG_ROUTE, where the line
+ends along each matching trip is measured in metres on the in-memory path, and
+compared with the events' stored route_distance_m, as in
+SpatialQueries.adjacent_events_query.
+'''
+import math
+import threading
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Load
+from sqlalchemy.sql import select
+
+from caching import MISSING, LRUCache
+from engine import engine, session_factory
+from models import FRACTION_EPSILON, Trip, User, SpatialQueries as SQ
+import projection
+import settings
+
+def parse_linestring(wkt):
+    '''Returns [(x, y), ...] from a 'LINESTRING(x y,x y,...)' WKT string.'''
+    coordinates = wkt[wkt.index('(') + 1:wkt.rindex(')')]
+    return [tuple(float(c) for c in pair.split()) for pair in coordinates.split(',')]
+
+def point_segment_distance(px, py, ax, ay, bx, by):
+    '''Euclidean distance from point p to the segment ab.'''
+    dx = bx - ax
+    dy = by - ay
+    length_squared = float(dx * dx + dy * dy)
+    if length_squared == 0:
+        return math.hypot(px - ax, py - ay)
+    t = ((px - ax) * dx + (py - ay) * dy) / length_squared
+    t = max(0.0, min(1.0, t))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+class GridIndex(object):
+    '''Uniform grid of buckets. Items are filed under every cell their bbox touches.'''
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = defaultdict(list)
+
+    def cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def insert(self, item, min_x, min_y, max_x, max_y):
+        min_i, min_j = self.cell(min_x, min_y)
+        max_i, max_j = self.cell(max_x, max_y)
+        for i in range(min_i, max_i + 1):
+            for j in range(min_j, max_j + 1):
+                self.cells[(i, j)].append(item)
+
+    def query(self, x, y, radius=0):
+        '''Returns every item filed within radius of (x, y); may include extras.'''
+        min_i, min_j = self.cell(x - radius, y - radius)
+        max_i, max_j = self.cell(x + radius, y + radius)
+        items = []
+        for i in range(min_i, max_i + 1):
+            for j in range(min_j, max_j + 1):
+                items.extend(self.cells.get((i, j), ()))
+        return items
+
+class UserHistory(object):
+    '''A grid of one user's trip path segments, and their events by trip.'''
+
+    def __init__(self, paths, events):
+        '''
+        Args:
+          paths (dict): trip_id -> list of projected (x, y) vertices
+          events (list): (event_type, event, x, y) tuples, where event_type is the
+            index of the event's class in SpatialQueries.event_classes
+        '''
+        tolerance = SQ.match_radius()
+        self.paths = paths
+        # trip_id -> (path array, projection.path_distances of it), filled lazily
+        self.routes = {}
+        self.segments = GridIndex(settings.ALERT_DISTANCE)
+        for trip_id, path in paths.items():
+            for (ax, ay), (bx, by) in zip(path, path[1:]):
+                self.segments.insert((trip_id, ax, ay, bx, by),
+                                     min(ax, bx) - tolerance, min(ay, by) - tolerance,
+                                     max(ax, bx) + tolerance, max(ay, by) + tolerance)
+        # trip_id -> [(event_type, event, x, y), ...]
+        self.events_by_trip = defaultdict(list)
+        for event_type, event, x, y in events:
+            self.events_by_trip[event.trip_id].append((event_type, event, x, y))
+
+    def trips_near_point(self, x, y):
+        tolerance = SQ.match_radius()
+        return set(trip_id for trip_id, ax, ay, bx, by in self.segments.query(x, y)
+                   if point_segment_distance(x, y, ax, ay, bx, by) <= tolerance)
+
+    def find_trips_matching_line(self, line):
+        '''In-memory counterpart of SpatialQueries.find_trips_matching_line.
+
+        Honours settings.MATCH_FRACTION like SpatialQueries.matching_trips_select.
+
+        Args:
+          line (list): projected (x, y) vertices
+
+        Returns:
+          set of trip_ids whose buffered path contains enough vertices of line
+        '''
+        if settings.MATCH_FRACTION < 1:
+            required = settings.MATCH_FRACTION * len(line) - FRACTION_EPSILON
+            counts = defaultdict(int)
+            for x, y in line:
+                for trip_id in self.trips_near_point(x, y):
+                    counts[trip_id] += 1
+            return set(trip_id for trip_id, count in counts.items() if count >= required)
+        matching = None
+        for x, y in line:
+            near = self.trips_near_point(x, y)
+            matching = near if matching is None else matching & near
+            if not matching:
+                break
+        return matching or set()
+
+    def route(self, trip_id):
+        route = self.routes.get(trip_id)
+        if route is None:
+            xy = np.asarray(self.paths[trip_id], dtype=float)
+            route = self.routes[trip_id] = (xy, projection.path_distances(xy))
+        return route
+
+    def route_positions(self, line, matching):
+        '''Metres along each matching trip to line[-1].
+
+        The in-memory counterpart of the distance column of
+        SpatialQueries.matching_trips_select. With settings.MATCH_DIRECTION,
+        trips the line doesn't follow forwards are left out.
+        '''
+        positions = {}
+        for trip_id in matching:
+            xy, distances = self.route(trip_id)
+            end = projection.locate_distance(xy, distances, *line[-1])
+            if settings.MATCH_DIRECTION and \
+               projection.locate_distance(xy, distances, *line[0]) > end:
+                continue
+            positions[trip_id] = end
+        return positions
+
+    def adjacent_events(self, line, matching=None):
+        '''Returns events of matching trips within settings.ALERT_DISTANCE of line[-1].
+
+        matching defaults to find_trips_matching_line(line). With
+        settings.ALERT_ALONG_ROUTE, the distance is measured along each trip's
+        route. With settings.MATCH_DIRECTION, only trips the line follows
+        forwards are kept, and only their events still ahead of line[-1].
+        '''
+        if matching is None:
+            matching = self.find_trips_matching_line(line)
+        if settings.MATCH_DIRECTION or settings.ALERT_ALONG_ROUTE:
+            positions = self.route_positions(line, matching)
+        else:
+            positions = dict.fromkeys(matching)
+        x, y = line[-1]
+        adjacent = []
+        for trip_id, position in positions.items():
+            for event_type, event, ex, ey in self.events_by_trip.get(trip_id, ()):
+                if position is not None:
+                    if event.route_distance_m is None:
+                        continue
+                    ahead = event.route_distance_m - position
+                    if settings.MATCH_DIRECTION and ahead < 0:
+                        continue
+                if settings.ALERT_ALONG_ROUTE:
+                    if abs(ahead) > settings.ALERT_DISTANCE:
+                        continue
+                elif math.hypot(ex - x, ey - y) > settings.ALERT_DISTANCE:
+                    continue
+                event_id = SQ.event_classes[event_type].__mapper__\
+                                                      .primary_key_from_instance(event)
+                adjacent.append(((trip_id, event_type, event_id), event))
+        # same ordering as SpatialQueries.adjacent_events_query
+        adjacent.sort(key=lambda item: item[0])
+        return [event for key, event in adjacent]
+
+def load_history(user_id, line=None):
+    '''Reads a user's trips and events from the database into a UserHistory.
+
+    Args are as for read_history.
+    '''
+    return UserHistory(*read_history(user_id, line))
+
+def read_history(user_id, line=None):
+    '''Reads a user's trip paths and events, in the form UserHistory takes them.
+
+    A throwaway session is used and closed straight away, so the events are
+    detached and later commits on the shared session can't expire them. Only
+    the columns the memory backend and corridors.py read are loaded.
+
+    Args:
+      user_id (int): whose trips to read
+      line (list): optional geographic points; if given, only the trips
+        SpatialQueries.matching_trips_select matches the line against are read,
+        so settings.MATCH_FRACTION applies as it does to alerts
+    '''
+    load_session = session_factory()
+    try:
+        if line is None:
+            trip_ids = load_session.query(Trip.trip_id)\
+                                   .filter(Trip.user_id == user_id).subquery()
+        else:
+            probes = SQ.probes_select([(line, user_id)]).cte('probes')
+            matching_trips = SQ.matching_trips_select(probes, user_id).alias('matching_trips')
+            trip_ids = select([matching_trips.c.trip_id])
+        paths = dict(
+            (trip_id, parse_linestring(wkt)) for trip_id, wkt in
+            load_session.query(Trip.trip_id, func.ST_AsText(Trip.geom_path))
+            .filter(Trip.trip_id.in_(trip_ids))
+        )
+        events = []
+        for event_type, event_cls in enumerate(SQ.event_classes):
+            q = load_session.query(event_cls,
+                                   func.ST_X(event_cls.point),
+                                   func.ST_Y(event_cls.point))\
+                            .options(Load(event_cls).load_only('trip_id', 'route_distance_m',
+                                                               event_cls.time_column))\
+                            .filter(event_cls.trip_id.in_(trip_ids))
+            events.extend((event_type, event, x, y) for event, x, y in q)
+    finally:
+        load_session.close()
+    return paths, events
+
+# user_id -> users.history_version, as last read from the database
+history_versions = LRUCache(settings.SPATIAL_INDEX_SIZE, settings.HISTORY_VERSION_TTL)
+
+def history_version(user_id):
+    '''The user's history version, read at most settings.HISTORY_VERSION_TTL seconds ago.'''
+    version = history_versions.get(user_id, MISSING)
+    if version is MISSING:
+        version = engine.execute(select([func.coalesce(User.history_version, 0)])
+                                 .where(User.user_id == user_id)).scalar()
+        history_versions.put(user_id, version)
+    return version
+
+class SpatialIndex(object):
+    '''Lazily loaded, size bounded per-user UserHistory cache, reloaded when stale.'''
+
+    def __init__(self, max_size=None, version=history_version):
+        '''
+        Args:
+          max_size (int): histories kept, settings.SPATIAL_INDEX_SIZE by default
+          version (callable): user_id -> current history version
+        '''
+        if max_size is None:
+            max_size = settings.SPATIAL_INDEX_SIZE
+        # user_id -> (history version, UserHistory)
+        self.histories = LRUCache(max_size)
+        self.version = version
+        self.lock = threading.Lock()
+        # bumped on every invalidation, so a load that raced with one is not kept
+        self.generation = 0
+
+    def load(self, user_id):
+        return load_history(user_id)
+
+    def history(self, user_id):
+        # read before loading, so a change made during the load is seen next time
+        version = self.version(user_id)
+        entry = self.histories.get(user_id)
+        if entry is None or entry[0] != version:
+            generation = self.generation
+            entry = version, self.load(user_id)
+            with self.lock:
+                if generation == self.generation:
+                    self.histories.put(user_id, entry)
+        return entry[1]
+
+    def invalidate(self, user_id=None):
+        '''Forget one user's history, or everybody's if user_id is None.'''
+        with self.lock:
+            self.generation += 1
+            if user_id is None:
+                self.histories.invalidate()
+            else:
+                self.histories.discard(user_id)
+
+    def adjacent_events_from_point_sequence(self, point_group, user_id):
+        '''Same contract as SpatialQueries.adjacent_events_from_point_sequence.'''
+        if len(point_group) < 2:
+            return []
+        return self.history(user_id).adjacent_events(projection.to_projected(point_group))
+
+    def adjacent_events_from_point_sequences(self, probes):
+        '''Same contract as SpatialQueries.adjacent_events_from_point_sequences.'''
+        return [self.adjacent_events_from_point_sequence(point_group, user_id)
+                for point_group, user_id in probes]
+
+spatial_index = SpatialIndex()
@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+
+from alert_tiles import rasterize
+from spatial_index import GridIndex, UserHistory
+import settings
+
+class TestRasterize(unittest.TestCase):
+    cell_size = 25.0
+
+    def setUp(self):
+        self.history = UserHistory({
+            1: [(0.0, 0.0), (300.0, 0.0), (300.0, 300.0)],
+            2: [(0.0, 1000.0), (300.0, 1000.0)],
+        }, [])
+        self.tiles = rasterize(self.history, self.cell_size)
+
+    def test_every_point_in_a_buffer_lands_in_its_trips_cell(self):
+        grid = GridIndex(self.cell_size)
+        for x, y in np.random.uniform(-50, 350, (2000, 2)):
+            near = self.history.trips_near_point(x, y)
+            tile = self.tiles.get(grid.cell(x, y))
+            trip_ids = set(tile[0]) if tile is not None else set()
+            self.assertTrue(near <= trip_ids, (x, y, near, trip_ids))
+
+    def test_far_cells_are_not_stored(self):
+        grid = GridIndex(self.cell_size)
+        self.assertNotIn(grid.cell(150.0, 500.0), self.tiles)
+        self.assertEqual(self.tiles[grid.cell(150.0, 1000.0)], ([2], []))
+
+if __name__ == '__main__':
+    unittest.main()
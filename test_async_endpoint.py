@@ -0,0 +1,97 @@
+# async_app monkey patches the standard library, so it has to be imported first
+import async_app
+
+import json
+import unittest
+from urllib import urlencode
+
+from app import app
+from caching import alert_cache
+from engine import Session
+from insert import DatabaseManager as DBM
+from models import User
+from models import SpatialQueries as SQ
+from trip_sessions import trip_sessions
+import settings
+
+class FakeWebSocket(object):
+    '''Replays messages to serve_stream and collects its replies.'''
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.replies = []
+
+    def receive(self):
+        return self.messages.pop(0) if self.messages else None
+
+    def send(self, message):
+        self.replies.append(json.loads(message))
+
+class TestAsyncEndpoint(unittest.TestCase):
+    username = settings.USERNAME
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+
+    def test_invalid_username_returns_403(self):
+        rv = self.app.get('/async/alerts/sadflkjsfdal')
+        self.assertEqual(rv.status_code, 403)
+
+    def test_no_json_param_returns_400(self):
+        rv = self.app.get('/async/alerts/{}?useless_param=foo'.format(self.username))
+        self.assertEqual(rv.status_code, 400)
+
+    def test_matches_sync_endpoint(self):
+        points = SQ.segmentized_line_with_geographic_points(1)
+        for i in range(0, len(points), 3):
+            point_group = [list(pair) for pair in points[i:i+3]]
+            qs = urlencode(dict(json=json.dumps(dict(points=point_group))))
+            sync_rv = self.app.get('/alerts/{}?{}'.format(self.username, qs))
+            async_rv = self.app.get('/async/alerts/{}?{}'.format(self.username, qs))
+            self.assertEqual(async_rv.status_code, 200)
+            self.assertEqual(json.loads(async_rv.get_data()),
+                             json.loads(sync_rv.get_data()))
+
+class TestStreamingEndpoint(unittest.TestCase):
+    username = settings.USERNAME
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.user_id = DBM.session.query(User.user_id)\
+                                  .filter(User.username == self.username).scalar()
+        Session.remove()
+
+    def test_plain_http_returns_400(self):
+        rv = self.app.get('/stream/alerts/{}'.format(self.username))
+        self.assertEqual(rv.status_code, 400)
+
+    def test_updates_are_answered_like_polling(self):
+        points = [list(pair) for pair in SQ.segmentized_line_with_geographic_points(1)]
+        # one position per message; the connection remembers the rest
+        ws = FakeWebSocket(json.dumps(dict(points=[point])) for point in points)
+        open_sessions = len(trip_sessions)
+        async_app.serve_stream(ws, self.user_id)
+        # the connection's trip session goes when it closes
+        self.assertEqual(len(trip_sessions), open_sessions)
+        self.assertEqual(len(ws.replies), len(points))
+        for i, reply in enumerate(ws.replies):
+            window = points[max(0, i + 1 - settings.STREAM_WINDOW):i + 1]
+            alert_cache.invalidate()
+            qs = urlencode(dict(json=json.dumps(dict(points=window))))
+            polled = json.loads(self.app.get('/alerts/{}?{}'.format(self.username, qs)).get_data())
+            # like any trip session, a stream can only drop warnings, never add them
+            for warning in reply['warnings']:
+                self.assertIn(warning, polled['warnings'])
+
+    def test_malformed_update_returns_400_and_keeps_the_connection(self):
+        point = list(SQ.segmentized_line_with_geographic_points(1)[0])
+        ws = FakeWebSocket(['not json', json.dumps(dict(points=[[1]])),
+                            json.dumps(dict(points=[point]))])
+        async_app.serve_stream(ws, self.user_id)
+        self.assertEqual([reply.get('status') for reply in ws.replies], [400, 400, None])
+        self.assertEqual(ws.replies[-1], dict(warnings=[]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from caching import MISSING, LRUCache, alert_cache_key
+from fakes import FakeClock
+import projection
+import settings
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(2, ttl=10, clock=self.clock)
+
+    def test_entries_expire_after_ttl(self):
+        self.cache.put('a', 1)
+        self.clock.now += 9
+        self.assertEqual(self.cache.get('a'), 1)
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_put_can_override_ttl(self):
+        self.cache.put('a', None, ttl=1)
+        self.clock.now += 1
+        self.assertEqual(self.cache.get('a', 0), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_cached_none_is_told_apart_with_a_default(self):
+        self.cache.put('a', None)
+        self.assertIsNone(self.cache.get('a', MISSING))
+        self.assertIs(self.cache.get('b', MISSING), MISSING)
+
+    def test_invalidate_matching_keys(self):
+        self.cache.put((1, 'a'), 1)
+        self.cache.put((2, 'a'), 2)
+        self.cache.invalidate(lambda key: key[0] == 1)
+        self.assertIsNone(self.cache.get((1, 'a')))
+        self.assertEqual(self.cache.get((2, 'a')), 2)
+
+    def test_contains_skips_expired_entries_without_counting(self):
+        self.cache.put('a', 1)
+        self.assertIn('a', self.cache)
+        self.clock.now += 10
+        self.assertNotIn('a', self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+
+    def test_stats_count_hits_and_misses(self):
+        self.cache.put('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+class TestAlertCacheKey(unittest.TestCase):
+    def setUp(self):
+        # San Francisco, inside the projection's UTM zone
+        self.x, self.y = projection.to_projected([(37.7749, -122.4194)])[0]
+
+    def point_group(self, *offsets):
+        return projection.to_geographic([(self.x + dx, self.y + dy) for dx, dy in offsets])
+
+    def test_heading_buckets(self):
+        east = alert_cache_key(1, self.point_group((0, 0), (20, 0)))
+        north = alert_cache_key(1, self.point_group((0, 0), (0, 20)))
+        self.assertNotEqual(east[3], north[3])
+        self.assertEqual((north[3] - east[3]) % settings.ALERT_CACHE_HEADINGS,
+                         settings.ALERT_CACHE_HEADINGS // 4)
+
+    def test_stationary_device_has_no_heading(self):
+        self.assertIsNone(alert_cache_key(1, self.point_group((0, 0), (1, 1)))[3])
+
+    def test_keyed_by_user(self):
+        point_group = self.point_group((0, 0), (20, 0))
+        self.assertNotEqual(alert_cache_key(1, point_group), alert_cache_key(2, point_group))
+
+if __name__ == '__main__':
+    unittest.main()
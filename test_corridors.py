@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+
+from corridors import cluster, distances_to_path, same_route
+import settings
+
+class FakeEvent(object):
+    time_column = 'ts'
+
+    def __init__(self, trip_id, ts):
+        self.trip_id = trip_id
+        self.ts = ts
+
+class TestCorridors(unittest.TestCase):
+    commute = [(0.0, 0.0), (1000.0, 0.0), (1000.0, 1000.0)]
+
+    def shifted(self, dx, dy):
+        return [(x + dx, y + dy) for x, y in self.commute]
+
+    def test_distances_to_path(self):
+        path = np.array([(0.0, 0.0), (10.0, 0.0)])
+        points = np.array([(5.0, 3.0), (-4.0, 3.0), (10.0, 0.0)])
+        np.testing.assert_allclose(distances_to_path(points, path), [3.0, 5.0, 0.0])
+
+    def test_same_route_is_symmetric(self):
+        short = np.array(self.commute[:2])
+        full = np.array(self.commute)
+        # short is within tolerance of full, but not the other way around
+        self.assertFalse(same_route(short, full, 10))
+        self.assertFalse(same_route(full, short, 10))
+        self.assertTrue(same_route(full, full + 5, 10))
+
+    def test_repeated_commutes_share_a_corridor(self):
+        paths = {1: self.commute, 2: self.shifted(3, -4), 3: self.shifted(0, 500),
+                 4: self.shifted(-2, 2)}
+        clusters = cluster(paths, [])
+        self.assertEqual([c.trip_ids for c in clusters], [[1, 2, 4], [3]])
+
+    def test_events_at_the_same_spot_are_counted_once(self):
+        paths = {1: self.commute, 2: self.shifted(3, -4)}
+        merge_distance = settings.CORRIDOR_EVENT_MERGE_DISTANCE
+        events = [(2, FakeEvent(1, 100), 500.0, 0.0),
+                  (2, FakeEvent(2, 300), 500.0 + merge_distance / 2.0, 0.0),
+                  # a different type, and a different spot
+                  (1, FakeEvent(2, 200), 500.0, 0.0),
+                  (2, FakeEvent(2, 400), 900.0, 0.0)]
+        c, = cluster(paths, events)
+        self.assertEqual(sorted((e[0], e[3], e[4]) for e in c.events),
+                         [(1, 1, 200), (2, 1, 400), (2, 2, 300)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,30 @@
+import json
 import math
+import os
+import pickle
 import random
+import tempfile
+import threading
 import unittest
+from collections import Counter
 
-from sqlalchemy import func
+from sqlalchemy import event, func
 from sqlalchemy.sql import select, text
 
+import alert_tiles
+from bulk_load import BulkLoader, SyncLoader, delete_trips
+import corridors
 from engine import engine, session
+from ingest import ingest
 from insert import DatabaseManager as DBM
-from models import User, Trip
+from models import User, Trip, Corridor, CorridorEvent, CorridorTrip, EventCount
 from models import SpatialQueries as SQ
 from parse_inputs import get_json
+from spatial_index import (history_versions, point_segment_distance, read_history,
+                           spatial_index)
+import prepared
+import projection
+import relevance
 
 import settings
 
@@ -60,6 +75,215 @@ class TestDatabaseInsertionTestCase(unittest.TestCase):
 
 
 
+def delete_user(username):
+    user = session.query(User).filter_by(username=username).first()
+    for trip in user.trips:
+        for event in SQ.get_associated_events(trip):
+            session.delete(event)
+        session.delete(trip)
+    session.delete(user)
+    session.commit()
+
+class TestBulkLoad(unittest.TestCase):
+    json = get_json(settings.DATAPATH)
+    username = 'bulk_load_test_user'
+
+    @classmethod
+    def setUpClass(cls):
+        DBM.create_new_user(username=cls.username)
+        trips = []
+        for trip in cls.json:
+            trip = dict(trip)
+            trip['id'] = trip['id'] + '_bulk'
+            trips.append(trip)
+        cls.stats = DBM.bulk_insert_json_into_db(cls.username, trips, batch_size=7)
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_user(cls.username)
+
+    def test_rows_match_orm_insert(self):
+        self.assertEqual(self.stats.trips, len([trip for trip in self.json
+                                                if len(trip['path']) > 1]))
+        for trip in self.json:
+            if len(trip['path']) > 1:
+                orm_trip = session.query(Trip).filter_by(trip_id_string=trip['id']).first()
+                bulk_trip = session.query(Trip).filter_by(
+                    trip_id_string=trip['id'] + '_bulk').first()
+                self.assertEqual(orm_trip.path, bulk_trip.path)
+                self.assertEqual(orm_trip.score, bulk_trip.score)
+                self.assertAlmostEqual(engine.execute(func.ST_HausdorffDistance(
+                    orm_trip.geom_path, bulk_trip.geom_path)).scalar(), 0, places=3)
+                self.assertAlmostEqual(engine.execute(func.ST_Area(
+                    bulk_trip.geom)).scalar(), engine.execute(func.ST_Area(
+                        orm_trip.geom)).scalar(), places=0)
+                orm_events = SQ.get_associated_events(orm_trip)
+                bulk_events = SQ.get_associated_events(bulk_trip)
+                self.assertEqual(len(orm_events), len(bulk_events))
+                for orm_event, bulk_event in zip(orm_events, bulk_events):
+                    self.assertEqual(type(orm_event), type(bulk_event))
+                    self.assertAlmostEqual(engine.execute(func.ST_Distance(
+                        orm_event.point, bulk_event.point)).scalar(), 0, places=3)
+                    self.assertAlmostEqual(orm_event.route_fraction,
+                                           bulk_event.route_fraction, places=4)
+
+    def test_sync_only_replaces_changed_trips(self):
+        trips = [dict(trip, id=trip['id'] + '_bulk') for trip in self.json
+                 if len(trip['path']) > 1]
+        stats = DBM.bulk_insert_json_into_db(self.username, trips, batch_size=7, sync=True)
+        self.assertEqual((stats.trips, stats.unchanged, stats.replaced), (0, len(trips), 0))
+        changed = dict(trips[0], end_time=trips[0]['end_time'] + 1000)
+        stats = DBM.bulk_insert_json_into_db(self.username, [changed], sync=True)
+        self.assertEqual((stats.trips, stats.unchanged, stats.replaced), (1, 0, 1))
+        self.assertEqual(session.query(Trip).filter_by(trip_id_string=changed['id'])
+                         .one().end_time, changed['end_time'])
+        self.assertEqual(session.query(Trip).join(User)
+                         .filter(User.username == self.username).count(), len(trips))
+
+    def test_sync_skips_trips_another_user_has(self):
+        other = 'bulk_load_other_test_user'
+        DBM.create_new_user(username=other)
+        try:
+            trip = [dict(trip, id=trip['id'] + '_bulk') for trip in self.json
+                    if len(trip['path']) > 1][0]
+            changed = dict(trip, end_time=trip['end_time'] + 1000)
+            stats = DBM.bulk_insert_json_into_db(other, [changed], sync=True)
+            self.assertEqual((stats.trips, stats.events, stats.conflicts), (0, 0, 1))
+            stored = session.query(Trip).filter_by(trip_id_string=trip['id']).one()
+            self.assertEqual(stored.users.username, self.username)
+        finally:
+            delete_user(other)
+
+    def test_failed_batches_are_not_counted(self):
+        trips = [dict(trip, id=trip['id'] + '_bulk') for trip in self.json
+                 if len(trip['path']) > 1]
+        user_id = session.query(User.user_id).filter_by(username=self.username).scalar()
+        loader = BulkLoader(user_id)
+        # already stored, so the COPY breaks trip_id_string's uniqueness
+        with self.assertRaises(Exception):
+            loader.load(trips[:1])
+        self.assertEqual((loader.stats.trips, loader.stats.events), (0, 0))
+
+    def test_parallel_syncs_of_one_user_do_not_race(self):
+        trips = [dict(trip, id=trip['id'] + '_race') for trip in self.json
+                 if len(trip['path']) > 1]
+        user_id = session.query(User.user_id).filter_by(username=self.username).scalar()
+        loaders = [SyncLoader(user_id) for i in range(2)]
+        errors = []
+
+        def load(loader):
+            try:
+                loader.load(trips)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=load, args=(loader,)) for loader in loaders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(loader.stats.trips for loader in loaders), [0, len(trips)])
+        raced = session.query(Trip.trip_id).filter(Trip.user_id == user_id)\
+                       .filter(Trip.trip_id_string.like('%_race')).all()
+        self.assertEqual(len(raced), len(trips))
+        with engine.begin() as connection:
+            delete_trips(connection, [trip_id for trip_id, in raced])
+
+
+class TestParallelIngest(unittest.TestCase):
+    json = get_json(settings.DATAPATH)
+    username = 'parallel_ingest_test_user'
+
+    @classmethod
+    def setUpClass(cls):
+        # the raw export, with its paths still encoded, owned by a new user
+        with open(settings.DATAPATH) as f:
+            trips = json.load(f)
+        for trip in trips:
+            trip['id'] = trip['id'] + '_ingest'
+        cls.usernames = dict((trip['user']['id'], cls.username) for trip in trips)
+        fd, cls.path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(trips, f)
+        cls.job = ingest([cls.path], usernames=cls.usernames, processes=2, batch_size=7,
+                         create_users=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.path)
+        delete_user(cls.username)
+
+    def test_every_trip_and_event_is_loaded_once(self):
+        trips = [trip for trip in self.json if len(trip['path']) > 1]
+        self.assertEqual(self.job.stats.trips, len(trips))
+        self.assertEqual(self.job.stats.events,
+                         sum(len(trip['drive_events']) for trip in trips))
+        user = session.query(User).filter_by(username=self.username).first()
+        self.assertEqual(sorted(trip.trip_id_string for trip in user.trips),
+                         sorted(trip['id'] + '_ingest' for trip in trips))
+        for trip in user.trips:
+            self.assertIsNotNone(trip.geom)
+
+    def test_sync_of_the_same_export_writes_nothing(self):
+        job = ingest([self.path], usernames=self.usernames, processes=2, batch_size=7,
+                     sync=True)
+        self.assertEqual(job.stats.trips, 0)
+        self.assertEqual(job.stats.unchanged, self.job.stats.trips)
+        self.assertEqual(job.changed_user_ids, set())
+
+    def test_stages_are_timed(self):
+        for stage in ['read', 'decode', 'prepare', 'copy', 'buffer']:
+            self.assertGreater(self.job.stats.stages[stage], 0)
+
+class TestSchemaManagement(unittest.TestCase):
+
+    def test_declared_indexes_exist(self):
+        for model in DBM.tables:
+            existing = DBM.existing_indexes(model.__tablename__)
+            for index in model.__table__.indexes:
+                self.assertIn(index.name, existing)
+
+    def test_trip_buffers_are_prepared(self):
+        # the simplified buffer still covers the full resolution buffer, with far
+        # fewer vertices
+        raw = func.ST_Buffer(Trip.geom_path, settings.MAX_GPS_ERROR_TOLERANCE)
+        for covers, vertices, raw_vertices in session.query(
+                func.ST_Covers(Trip.geom, raw), func.ST_NPoints(Trip.geom),
+                func.ST_NPoints(raw)):
+            self.assertTrue(covers)
+            self.assertLessEqual(vertices, raw_vertices)
+
+    def test_prepare_trip_geometries_is_idempotent(self):
+        before = session.query(func.sum(func.ST_NPoints(Trip.geom))).scalar()
+        trips = session.query(func.count(Trip.trip_id)).scalar()
+        self.assertEqual(DBM.prepare_trip_geometries(batch_size=7), trips)
+        session.expire_all()
+        self.assertEqual(session.query(func.sum(func.ST_NPoints(Trip.geom))).scalar(), before)
+
+    def test_migrate_converts_pickled_columns(self):
+        # put score back the way PickleType stored it, then migrate it again
+        expected = dict(engine.execute(select([Trip.trip_id, Trip.score])).fetchall())
+        engine.execute(text('ALTER TABLE trips RENAME COLUMN score TO score_before; '
+                            'ALTER TABLE trips ADD COLUMN score bytea')
+                       .execution_options(autocommit=True))
+        try:
+            for trip_id, score in expected.items():
+                engine.execute(text('UPDATE trips SET score = :score WHERE trip_id = :trip_id'),
+                               score=pickle.dumps(score, pickle.HIGHEST_PROTOCOL),
+                               trip_id=trip_id)
+            self.assertEqual(DBM.migrate_pickled_trip_columns(batch_size=7), ['score'])
+        finally:
+            engine.execute(text('ALTER TABLE trips DROP COLUMN score_before')
+                           .execution_options(autocommit=True))
+        self.assertEqual(DBM.column_type('trips', 'score'), 'jsonb')
+        self.assertEqual(dict(engine.execute(select([Trip.trip_id, Trip.score])).fetchall()),
+                         expected)
+        self.assertEqual(DBM.migrate_pickled_trip_columns(), [])
+
+    def test_ensure_indexes_is_idempotent(self):
+        self.assertEqual(DBM.ensure_indexes(), [])
+
+
 class TestSpatialDatabaseQueries(unittest.TestCase):
     json = get_json(settings.DATAPATH)
     user_id = 1
@@ -72,6 +296,23 @@ class TestSpatialDatabaseQueries(unittest.TestCase):
                 for trip in trips:
                     self.assertTrue(engine.execute(func.ST_Contains(trip.geom, line)).first()[0])
         
+    def test_matching_trips_load_their_events_in_bulk(self):
+        trip = [trip for trip in self.json if len(trip['path']) > 1][0]
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        session.expire_all()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            trips = list(SQ.find_trips_matching_line(trip['path'][:3], self.user_id))
+            for matching_trip in trips:
+                SQ.get_associated_events(matching_trip)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertTrue(trips)
+        # the trips, then one query per event table
+        self.assertEqual(len(statements), 1 + len(SQ.event_classes))
+
     def test_get_associated_events(self):
         for trip in self.json:
             if len(trip['path']) > 1:
@@ -143,6 +384,421 @@ class TestSpatialDatabaseQueries(unittest.TestCase):
                     total_adj_events.extend(adj_events)
                 res = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
                 self.assertEqual(len(res), len(total_adj_events))    
+                self.assertEqual(sorted(str(event) for event in res),
+                                 sorted(str(event) for event in total_adj_events))
+
+class TestAlertTiles(unittest.TestCase):
+    user_id = 1
+
+    @classmethod
+    def setUpClass(cls):
+        alert_tiles.build(cls.user_id)
+
+    def point_groups(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        points = SQ.segmentized_line_with_geographic_points(trip.trip_id)
+        return [points[start:start+3] for start in range(0, len(points) - 1, 3)]
+
+    def test_tiles_never_miss_a_warning(self):
+        for point_group in self.point_groups():
+            expected = Counter(str(event) for event in
+                               SQ.adjacent_events_from_point_sequence(point_group, self.user_id))
+            result = Counter(str(event) for event in alert_tiles.alert_tiles\
+                             .adjacent_events_from_point_sequence(point_group, self.user_id))
+            self.assertEqual(expected - result, Counter())
+
+    def test_unbuilt_tiles_fall_back_to_postgis(self):
+        alert_tiles.invalidate(self.user_id)
+        try:
+            for point_group in self.point_groups():
+                expected = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+                result = alert_tiles.alert_tiles.adjacent_events_from_point_sequence(
+                    point_group, self.user_id)
+                self.assertEqual([str(event) for event in result],
+                                 [str(event) for event in expected])
+        finally:
+            alert_tiles.build(self.user_id)
+
+class TestCorridors(unittest.TestCase):
+    user_id = 1
+
+    @classmethod
+    def setUpClass(cls):
+        corridors.build(cls.user_id)
+
+    def test_every_trip_and_event_is_counted_once(self):
+        trips = session.query(func.count(Trip.trip_id)).filter_by(user_id=self.user_id).scalar()
+        events = sum(session.query(func.count()).select_from(event_cls)
+                     .join(Trip, Trip.trip_id == event_cls.trip_id)
+                     .filter(Trip.user_id == self.user_id).scalar()
+                     for event_cls in SQ.event_classes)
+        self.assertEqual(session.query(func.sum(Corridor.trip_count))
+                         .filter_by(user_id=self.user_id).scalar(), trips)
+        self.assertEqual(session.query(func.sum(CorridorEvent.count))
+                         .join(Corridor, Corridor.corridor_id == CorridorEvent.corridor_id)
+                         .filter(Corridor.user_id == self.user_id).scalar(), events)
+
+    def test_route_stays_inside_its_corridor(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        corridor_id = session.query(CorridorTrip.corridor_id)\
+                             .filter_by(trip_id=trip.trip_id).scalar()
+        points = SQ.segmentized_line_with_geographic_points(trip.trip_id)
+        for start in range(0, len(points) - 1, 3):
+            line = SQ.points_to_projected_line(points[start:start+3])
+            matching = session.query(Corridor.corridor_id)\
+                              .filter(Corridor.user_id == self.user_id)\
+                              .filter(func.ST_Within(line, Corridor.geom))
+            self.assertIn(corridor_id, [row[0] for row in matching])
+
+    def test_event_last_seen_comes_from_the_events(self):
+        latest = max(session.query(func.max(SQ.event_time(event_cls)))
+                     .join(Trip, Trip.trip_id == event_cls.trip_id)
+                     .filter(Trip.user_id == self.user_id).scalar() or 0
+                     for event_cls in SQ.event_classes)
+        self.assertGreater(latest, 0)
+        self.assertEqual(session.query(func.max(CorridorEvent.last_seen))
+                         .join(Corridor, Corridor.corridor_id == CorridorEvent.corridor_id)
+                         .filter(Corridor.user_id == self.user_id).scalar(), latest)
+
+class TestDirectionAwareMatching(unittest.TestCase):
+    user_id = 1
+
+    def setUp(self):
+        settings.MATCH_DIRECTION = True
+
+    def tearDown(self):
+        settings.MATCH_DIRECTION = False
+
+    def point_groups(self, trip):
+        points = SQ.segmentized_line_with_geographic_points(trip.trip_id)
+        return [points[start:start+3] for start in range(0, len(points) - 1, 3)]
+
+    def test_route_fractions_are_stored(self):
+        for event_cls in SQ.event_classes:
+            self.assertEqual(session.query(func.count()).select_from(event_cls)
+                             .filter(event_cls.route_fraction == None).scalar(), 0)
+
+    def test_route_distances_are_stored(self):
+        for trip in session.query(Trip).filter_by(user_id=self.user_id):
+            length = engine.execute(func.ST_Length(trip.geom_path)).scalar()
+            self.assertEqual(trip.route_distances[0], 0)
+            self.assertAlmostEqual(trip.route_distances[-1], length, places=3)
+            for event in SQ.get_associated_events(trip):
+                self.assertAlmostEqual(event.route_distance_m, event.route_fraction * length,
+                                       places=3)
+
+    def test_memory_backend_agrees_on_the_trip_driven(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        spatial_index.invalidate(self.user_id)
+        for point_group in self.point_groups(trip):
+            expected = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+            result = spatial_index.adjacent_events_from_point_sequence(point_group,
+                                                                       self.user_id)
+            self.assertEqual([str(event) for event in result if event.trip_id == trip.trip_id],
+                             [str(event) for event in expected
+                              if event.trip_id == trip.trip_id])
+
+    def test_only_events_ahead_are_returned(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        for point_group in self.point_groups(trip):
+            ahead = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+            settings.MATCH_DIRECTION = False
+            anywhere = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+            settings.MATCH_DIRECTION = True
+            self.assertTrue(set(ahead) <= set(anywhere))
+            for event in ahead:
+                if event.trip_id == trip.trip_id:
+                    fraction = session.query(func.ST_LineLocatePoint(
+                        Trip.geom_path, SQ.convert_geographic_coordinates_to_projected_point(
+                            *point_group[-1]))).filter(Trip.trip_id == trip.trip_id).scalar()
+                    self.assertGreaterEqual(event.route_fraction, fraction)
+
+    def test_opposite_direction_does_not_match(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        for point_group in self.point_groups(trip):
+            point_group = list(reversed(point_group))
+            events = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+            self.assertNotIn(trip.trip_id, [event.trip_id for event in events])
+
+class TestAlongRouteAlerts(unittest.TestCase):
+    user_id = 1
+
+    def setUp(self):
+        settings.ALERT_ALONG_ROUTE = True
+
+    def tearDown(self):
+        settings.ALERT_ALONG_ROUTE = False
+        settings.MATCH_DIRECTION = False
+
+    def point_groups(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        points = SQ.segmentized_line_with_geographic_points(trip.trip_id)
+        return [points[start:start+3] for start in range(0, len(points) - 1, 3)]
+
+    def driver_distance(self, trip_id, point_group):
+        point = SQ.convert_geographic_coordinates_to_projected_point(*point_group[-1])
+        return session.query(func.ST_LineLocatePoint(Trip.geom_path, point) *
+                             func.ST_Length(Trip.geom_path))\
+                      .filter(Trip.trip_id == trip_id).scalar()
+
+    def test_alert_distance_is_measured_along_the_route(self):
+        for point_group in self.point_groups():
+            expected = []
+            for trip in SQ.find_trips_matching_line(point_group, self.user_id):
+                distance = self.driver_distance(trip.trip_id, point_group)
+                expected.extend(
+                    event for event in SQ.get_associated_events(trip)
+                    if abs(event.route_distance_m - distance) <= settings.ALERT_DISTANCE)
+            result = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+            self.assertEqual(event_keys(result), event_keys(expected))
+
+    def test_only_events_up_to_alert_distance_ahead_are_returned(self):
+        settings.MATCH_DIRECTION = True
+        for point_group in self.point_groups():
+            for event in SQ.adjacent_events_from_point_sequence(point_group, self.user_id):
+                distance = self.driver_distance(event.trip_id, point_group)
+                self.assertGreaterEqual(event.route_distance_m, distance - 1e-6)
+                self.assertLessEqual(event.route_distance_m,
+                                     distance + settings.ALERT_DISTANCE + 1e-6)
+
+    def test_memory_backend_covers_postgis(self):
+        for point_group in self.point_groups():
+            expected = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+            result = spatial_index.adjacent_events_from_point_sequence(point_group,
+                                                                       self.user_id)
+            self.assertTrue(event_keys(expected) <= event_keys(result))
+
+    def test_tiles_never_miss_a_warning(self):
+        alert_tiles.build(self.user_id)
+        try:
+            for point_group in self.point_groups():
+                expected = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+                result = alert_tiles.alert_tiles.adjacent_events_from_point_sequence(
+                    point_group, self.user_id)
+                self.assertTrue(event_keys(expected) <=
+                                set((event.event_cls.__name__, event.trip_id, event.event_id)
+                                    for event in result))
+        finally:
+            settings.ALERT_ALONG_ROUTE = False
+            alert_tiles.build(self.user_id)
+
+class TestPartitioning(unittest.TestCase):
+    user_id = 1
+
+    def tearDown(self):
+        settings.PARTITION_COUNT = 0
+
+    def test_events_store_their_trips_user_id(self):
+        for event_cls in SQ.event_classes:
+            mismatched = session.query(func.count()).select_from(event_cls)\
+                .join(Trip, Trip.trip_id == event_cls.trip_id)\
+                .filter(func.coalesce(event_cls.user_id, -1) != Trip.user_id).scalar()
+            self.assertEqual(mismatched, 0)
+
+    def test_partition_filters_do_not_change_alerts(self):
+        points = SQ.segmentized_line_with_geographic_points(1)
+        for start in range(0, len(points) - 1, 3):
+            point_group = points[start:start+3]
+            expected = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+            settings.PARTITION_COUNT = 4
+            result = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+            settings.PARTITION_COUNT = 0
+            self.assertEqual(result, expected)
+
+class TestRelevance(unittest.TestCase):
+    user_id = 1
+
+    def tearDown(self):
+        settings.RELEVANCE_MAX_AGE_DAYS = None
+        settings.RELEVANCE_HOURS = None
+        settings.RELEVANCE_HALF_LIFE_DAYS = None
+        settings.RELEVANCE_MIN_SCORE = 0
+        relevance.invalidate(self.user_id)
+
+    def alerts(self):
+        points = SQ.segmentized_line_with_geographic_points(1)
+        return [SQ.adjacent_events_from_point_sequence(points[start:start+3], self.user_id)
+                for start in range(0, len(points) - 1, 3)]
+
+    def test_counts_cover_every_event(self):
+        relevance.build(self.user_id)
+        counted = session.query(func.sum(EventCount.events))\
+            .filter(EventCount.user_id == self.user_id).scalar()
+        stored = sum(session.query(func.count()).select_from(event_cls)
+                     .join(Trip, Trip.trip_id == event_cls.trip_id)
+                     .filter(Trip.user_id == self.user_id).scalar()
+                     for event_cls in SQ.event_classes)
+        self.assertEqual(counted, stored)
+
+    def test_recency_weights_are_at_most_one(self):
+        settings.RELEVANCE_HALF_LIFE_DAYS = 30
+        relevance.build(self.user_id)
+        for events, score in session.query(EventCount.events, EventCount.score)\
+                                    .filter(EventCount.user_id == self.user_id):
+            self.assertGreater(score, 0)
+            self.assertLessEqual(score, events + 1e-9)
+
+    def test_min_score_drops_rare_events(self):
+        expected = self.alerts()
+        settings.RELEVANCE_MIN_SCORE = 1
+        # counts aren't built yet, so nothing is dropped
+        self.assertEqual(self.alerts(), expected)
+        relevance.build(self.user_id)
+        self.assertEqual(self.alerts(), expected)
+        settings.RELEVANCE_MIN_SCORE = 1e6
+        self.assertEqual(sum(len(events) for events in self.alerts()), 0)
+
+    def test_max_age_keeps_recent_trips(self):
+        latest = session.query(func.max(Trip.start_time))\
+            .filter(Trip.user_id == self.user_id).scalar()
+        settings.RELEVANCE_MAX_AGE_DAYS = 0
+        for events in self.alerts():
+            for event in events:
+                self.assertEqual(session.query(Trip.start_time)
+                                 .filter(Trip.trip_id == event.trip_id).scalar(), latest)
+
+    def test_a_whole_day_window_keeps_everything(self):
+        expected = self.alerts()
+        settings.RELEVANCE_HOURS = 12
+        self.assertEqual(self.alerts(), expected)
+
+class TestFractionalMatching(unittest.TestCase):
+    user_id = 1
+
+    def tearDown(self):
+        settings.MATCH_FRACTION = 1.0
+
+    def matching_trip_ids(self, point_group):
+        probes = SQ.probes_select([(point_group, self.user_id)]).cte('probes')
+        return set(row.trip_id for row in session.execute(SQ.matching_trips_select(probes)))
+
+    def test_one_outlier_is_tolerated(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        points = SQ.segmentized_line_with_geographic_points(trip.trip_id)
+        point_group = [list(point) for point in points[:5]]
+        # about 500m off the route
+        point_group[2][0] += 0.0045
+        self.assertNotIn(trip.trip_id, self.matching_trip_ids(point_group))
+        settings.MATCH_FRACTION = 0.8
+        self.assertIn(trip.trip_id, self.matching_trip_ids(point_group))
+        settings.MATCH_FRACTION = 0.9
+        self.assertNotIn(trip.trip_id, self.matching_trip_ids(point_group))
+
+    def test_memory_backend_agrees(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        points = SQ.segmentized_line_with_geographic_points(trip.trip_id)
+        history = spatial_index.history(self.user_id)
+        settings.MATCH_FRACTION = 0.6
+        for start in range(0, len(points) - 4, 5):
+            point_group = [list(point) for point in points[start:start+5]]
+            point_group[2][0] += 0.0045
+            # the in-memory distance check covers the simplified buffer, but
+            # reaches a few metres further, so it may match more trips
+            in_memory = history.find_trips_matching_line(projection.to_projected(point_group))
+            self.assertIn(trip.trip_id, in_memory)
+            self.assertTrue(self.matching_trip_ids(point_group) <= in_memory)
+
+    def test_history_read_for_a_line_uses_the_same_match(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        points = SQ.segmentized_line_with_geographic_points(trip.trip_id)
+        point_group = [list(point) for point in points[:5]]
+        point_group[2][0] += 0.0045
+        settings.MATCH_FRACTION = 0.8
+        paths, events = read_history(self.user_id, point_group)
+        self.assertIn(trip.trip_id, paths)
+        self.assertEqual(set(paths), self.matching_trip_ids(point_group))
+        self.assertTrue(set(event.trip_id for event_type, event, x, y in events) <= set(paths))
+
+def event_keys(events):
+    return set((type(event).__name__, event.trip_id,
+                type(event).__mapper__.primary_key_from_instance(event)[0])
+               for event in events)
+
+class TestPreparedStatements(unittest.TestCase):
+
+    def test_statements_survive_a_rolled_back_prepare(self):
+        # a label of its own, so it is prepared afresh on whichever connection
+        statement = select([User.user_id.label('rolled_back_prepare_user_id')])\
+            .where(User.username == settings.USERNAME)
+        expected = engine.execute(statement).scalar()
+        with engine.connect() as connection:
+            name = prepared.prepared_form(statement, connection.dialect)[0]
+            transaction = connection.begin()
+            self.assertEqual(prepared.execute(connection, statement).scalar(), expected)
+            transaction.rollback()
+            self.assertNotIn(name, connection.info.get(prepared.PREPARED, ()))
+            self.assertEqual(prepared.execute(connection, statement).scalar(), expected)
+            transaction = connection.begin()
+            self.assertEqual(prepared.execute(connection, statement).scalar(), expected)
+            transaction.commit()
+            self.assertIn(name, connection.info[prepared.PREPARED])
+            self.assertEqual(prepared.execute(connection, statement).scalar(), expected)
+
+class TestSpatialIndex(unittest.TestCase):
+    user_id = 1
+
+    def assertCoversPostgis(self, point_group):
+        '''The memory backend warns about everything PostGIS does, and the same
+        for every trip both match; it may match a few more trips.'''
+        expected = SQ.adjacent_events_from_point_sequence(point_group, self.user_id)
+        result = spatial_index.adjacent_events_from_point_sequence(point_group, self.user_id)
+        self.assertTrue(event_keys(expected) <= event_keys(result))
+        trip_ids = set(event.trip_id for event in expected)
+        self.assertEqual(event_keys(event for event in result if event.trip_id in trip_ids),
+                         event_keys(expected))
+
+    def test_matches_postgis(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        points = SQ.segmentized_line_with_geographic_points(trip.trip_id)
+        for start in range(0, len(points), 3):
+            point_group = points[start:start+3]
+            if len(point_group) < 2:
+                continue
+            self.assertCoversPostgis(point_group)
+
+    def test_points_beyond_the_gps_tolerance_but_inside_the_buffer_match(self):
+        trip = session.query(Trip).filter_by(user_id=self.user_id).first()
+        path = spatial_index.history(self.user_id).paths[trip.trip_id]
+        # the simplified buffer contains everything this close to a straight stretch
+        offset = SQ.buffer_radius() - settings.PATH_SIMPLIFY_TOLERANCE - 0.5
+        self.assertGreater(offset, settings.MAX_GPS_ERROR_TOLERANCE)
+        tested = 0
+        for (ax, ay), (bx, by) in zip(path, path[1:]):
+            length = math.hypot(bx - ax, by - ay)
+            if length < 100:
+                continue
+            nx, ny = -(by - ay) / length, (bx - ax) / length
+            line = [(ax + (bx - ax) * t + nx * offset, ay + (by - ay) * t + ny * offset)
+                    for t in (0.3, 0.5, 0.7)]
+            nearest = min(point_segment_distance(x, y, px, py, qx, qy)
+                          for x, y in line for (px, py), (qx, qy) in zip(path, path[1:]))
+            if nearest <= settings.MAX_GPS_ERROR_TOLERANCE:
+                # another part of the path runs closer
+                continue
+            point_group = [tuple(point) for point in projection.to_geographic(line)]
+            self.assertIn(trip.trip_id, set(matched.trip_id for matched in
+                                            SQ.find_trips_matching_line(point_group,
+                                                                        self.user_id)))
+            self.assertCoversPostgis(point_group)
+            tested += 1
+        self.assertGreater(tested, 0)
+
+    def test_insert_invalidates_user(self):
+        spatial_index.history(self.user_id)
+        self.assertIn(self.user_id, spatial_index.histories)
+        DBM.insert_json_into_db(settings.USERNAME, [])
+        self.assertNotIn(self.user_id, spatial_index.histories)
+
+    def test_a_change_from_another_process_reloads_the_history(self):
+        history = spatial_index.history(self.user_id)
+        self.assertIs(spatial_index.history(self.user_id), history)
+        # what user_history_changed does in the other process
+        engine.execute(User.__table__.update().where(User.user_id == self.user_id)
+                       .values(history_version=func.coalesce(User.history_version, 0) + 1))
+        self.assertIs(spatial_index.history(self.user_id), history)
+        # once this process's copy of the version has expired
+        history_versions.discard(self.user_id)
+        self.assertIsNot(spatial_index.history(self.user_id), history)
 
 if __name__ == '__main__':
     DBM.clear_database_and_create_tables()
@@ -2,10 +2,16 @@ import json
 import unittest
 from urllib import urlencode
 
+from sqlalchemy import event
+
 from app import app
+from caching import alert_cache, user_ids
+from engine import Session, engine
 from insert import DatabaseManager as DBM
+from models import User
 from models import SpatialQueries as SQ
 from parse_inputs import get_json
+from trip_sessions import trip_sessions
 import settings
 
 class TestRESTEndpoint(unittest.TestCase):
@@ -14,12 +20,23 @@ class TestRESTEndpoint(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
         self.app = app.test_client()
-        
+        alert_cache.invalidate()
+
+    def test_web_connections_have_a_statement_timeout(self):
+        timeout_ms = engine.execute("SELECT EXTRACT(EPOCH FROM CAST("
+                                    "current_setting('statement_timeout') AS interval)) * 1000")\
+                           .scalar()
+        self.assertEqual(timeout_ms, settings.DB_STATEMENT_TIMEOUT_MS)
+
     def test_invalid_username_returns_403(self):
         rv = self.app.get('/alerts/sadflkjsfdal')
         ## assert that 403 is returned on invalid username
         self.assertEqual(rv.status_code, 403)
 
+    def test_session_removed_after_request(self):
+        self.app.get('/alerts/{username}?json={{}}'.format(username=self.username))
+        self.assertFalse(Session.registry.has())
+
     def test_no_json_param_returns_400(self):
         url = '/alerts/{username}?useless_param={useless_param}'.format(
             **{'username': self.username,
@@ -85,6 +102,153 @@ class TestRESTEndpoint(unittest.TestCase):
             print("warnings at {location}:\n{warnings}".format(location=point_group[-1],
                                                               warnings=warnings))
 
+    def test_trip_session_warnings_are_a_subset(self):
+        # a session only ever narrows the trips matched at its start, so it can
+        # miss trips that join the route later but never adds warnings
+        points = SQ.segmentized_line_with_geographic_points(1)
+        requeries = trip_sessions.requeries
+        for i in range(0, len(points) - 1, 3):
+            point_group = [list(pair) for pair in points[i:i+3]]
+            warnings = []
+            alert_cache.invalidate()
+            for device in [None, 'test_device']:
+                qs = urlencode(dict(json=json.dumps(dict(points=point_group, device=device))))
+                rv = self.app.get('/alerts/{}?{}'.format(self.username, qs))
+                self.assertEqual(rv.status_code, 200)
+                warnings.append(json.loads(rv.get_data())['warnings'])
+            stateless, session = warnings
+            for warning in session:
+                self.assertIn(warning, stateless)
+        # the drive follows trip 1 throughout, so trip 1 stays a candidate
+        self.assertEqual(trip_sessions.requeries, requeries + 1)
+
+    def test_unhashable_device_returns_400(self):
+        qs = urlencode(dict(json=json.dumps(dict(points=[], device=[1]))))
+        rv = self.app.get('/alerts/{}?{}'.format(self.username, qs))
+        self.assertEqual(rv.status_code, 400)
+
+    def test_alerts_issue_a_fixed_number_of_statements(self):
+        # the username lookup and the spatial query, however many trips and
+        # events match; loading the events must not add lazy loads per trip.
+        # PREPAREs go straight to the cursor, once per connection.
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        points = SQ.segmentized_line_with_geographic_points(1)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            for i in range(0, len(points) - 1, 3):
+                point_group = [list(pair) for pair in points[i:i+3]]
+                qs = urlencode(dict(json=json.dumps(dict(points=point_group))))
+                del statements[:]
+                alert_cache.invalidate()
+                user_ids.invalidate()
+                rv = self.app.get('/alerts/{}?{}'.format(self.username, qs))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(len(statements), 2, statements)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+    def test_repeated_alert_is_answered_from_cache(self):
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        point_group = [list(pair) for pair in SQ.segmentized_line_with_geographic_points(1)[:3]]
+        url = '/alerts/{}?{}'.format(self.username,
+                                     urlencode(dict(json=json.dumps(dict(points=point_group)))))
+        first = json.loads(self.app.get(url).get_data())
+        hits = alert_cache.stats()['hits']
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            second = json.loads(self.app.get(url).get_data())
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(first, second)
+        # the username is cached as well
+        self.assertEqual(len(statements), 0, statements)
+        self.assertEqual(alert_cache.stats()['hits'], hits + 1)
+        stats = json.loads(self.app.get('/stats').get_data())
+        self.assertEqual(stats['alert_cache']['hits'], hits + 1)
+
+    def test_unknown_username_is_cached_until_created(self):
+        username = 'not_yet_a_user'
+        url = '/alerts/{}?{}'.format(username, urlencode(dict(json=json.dumps(dict(points=[])))))
+        self.assertEqual(self.app.get(url).status_code, 403)
+        self.assertIsNone(user_ids.get(username, 0))
+        DBM.create_new_user(username=username)
+        try:
+            self.assertEqual(self.app.get(url).status_code, 200)
+        finally:
+            DBM.session.query(User).filter(User.username == username).delete()
+            DBM.session.commit()
+            user_ids.invalidate()
+
+    def test_prepared_statements_give_the_same_warnings(self):
+        points = SQ.segmentized_line_with_geographic_points(1)
+        user_id = user_ids.get(self.username) or \
+            DBM.session.query(User.user_id).filter(User.username == self.username).scalar()
+        try:
+            for i in range(0, len(points) - 1, 3):
+                point_group = points[i:i+3]
+                warnings = []
+                for prepare in [False, True]:
+                    settings.PREPARED_STATEMENTS = prepare
+                    events = SQ.adjacent_events_from_point_sequence(point_group, user_id)
+                    warnings.append([(type(e), e.trip_id, e.point.desc) for e in events])
+                self.assertEqual(*warnings)
+        finally:
+            settings.PREPARED_STATEMENTS = True
+            Session.remove()
+
+    def test_batch_matches_individual_requests(self):
+        points = SQ.segmentized_line_with_geographic_points(1)
+        point_groups = [[list(pair) for pair in points[i:i+3]]
+                        for i in range(0, len(points), 3)]
+        devices = [dict(username=self.username, points=point_group)
+                   for point_group in point_groups]
+        rv = self.app.post('/alerts', data=json.dumps(dict(devices=devices)),
+                           content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        results = json.loads(rv.get_data())['results']
+        self.assertEqual(len(results), len(point_groups))
+        for point_group, result in zip(point_groups, results):
+            qs = urlencode(dict(json=json.dumps(dict(points=point_group))))
+            single = self.app.get('/alerts/{}?{}'.format(self.username, qs))
+            self.assertEqual(result['warnings'],
+                             json.loads(single.get_data())['warnings'])
+
+    def test_batch_rejects_devices_individually(self):
+        devices = [dict(username='sadflkjsfdal', points=[]),
+                   dict(username=self.username),
+                   dict(username=self.username, points=[])]
+        rv = self.app.post('/alerts', data=json.dumps(dict(devices=devices)),
+                           content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        results = json.loads(rv.get_data())['results']
+        self.assertEqual([result.get('status') for result in results], [403, 400, None])
+        self.assertEqual(results[2]['warnings'], [])
+
+    def test_batch_rejects_malformed_devices_individually(self):
+        points = [list(pair) for pair in SQ.segmentized_line_with_geographic_points(1)[:3]]
+        devices = [dict(username=[self.username], points=points),
+                   dict(username={'name': self.username}, points=points),
+                   dict(username=self.username, points=[[1]]),
+                   dict(username=self.username, points=[['a', 'b'], [1, 2]]),
+                   dict(username=self.username, points=points)]
+        rv = self.app.post('/alerts', data=json.dumps(dict(devices=devices)),
+                           content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        results = json.loads(rv.get_data())['results']
+        self.assertEqual([result.get('status') for result in results],
+                         [400, 400, 400, 400, None])
+        self.assertIn('warnings', results[4])
+
+    def test_batch_malformed_body_returns_400(self):
+        rv = self.app.post('/alerts', data='{badness>]}', content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.post('/alerts', data=json.dumps(dict(devices='nope')),
+                           content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
     
 
 if __name__ == '__main__':
@@ -0,0 +1,49 @@
+import json
+import os
+import tempfile
+import unittest
+
+from ingest import shards
+import settings
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        # 30 trips spread over 10 Automatic users, 3 each
+        self.trips = [dict(id=str(i), user=dict(id='automatic_{}'.format(i % 10)))
+                      for i in range(30)]
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.trips, f)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_trips_go_to_the_configured_username_by_default(self):
+        batches = list(shards([self.path], 4))
+        self.assertEqual(set(name for name, batch in batches), set([settings.USERNAME]))
+        self.assertEqual([len(batch) for name, batch in batches], [4] * 7 + [2])
+
+    def test_automatic_ids_are_mapped_to_usernames(self):
+        usernames = {'automatic_1': 'alice', 'automatic_2': 'bob'}
+        batches = list(shards([self.path], 4, usernames=usernames))
+        owned = dict((name, []) for name in ['alice', 'bob', None])
+        for name, batch in batches:
+            owned[name].extend(trip['id'] for trip in batch)
+        self.assertEqual(sorted(owned['alice']), ['1', '11', '21'])
+        self.assertEqual(sorted(owned['bob']), ['12', '2', '22'])
+        self.assertEqual(len(owned[None]), 24)
+
+    def test_buffered_trips_stay_under_the_cap(self):
+        # no user ever fills a batch, so only the cap sends them
+        usernames = dict(('automatic_{}'.format(i), str(i)) for i in range(10))
+        read = 0
+        sent = 0
+        for name, batch in shards([self.path], 100, usernames=usernames, max_buffered=5):
+            sent += len(batch)
+            read = max([read] + [int(trip['id']) + 1 for trip in batch])
+            self.assertLessEqual(read - sent, 5)
+        self.assertEqual(sent, 30)
+
+if __name__ == '__main__':
+    unittest.main()
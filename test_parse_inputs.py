@@ -0,0 +1,35 @@
+import io
+import json
+import unittest
+
+from parse_inputs import get_json, iter_json_array, iter_trips
+import settings
+
+class TestStreamingParser(unittest.TestCase):
+    json = get_json(settings.DATAPATH)
+
+    def test_iter_trips_matches_get_json(self):
+        trips = list(iter_trips([settings.DATAPATH], processes=2, window=7))
+        self.assertEqual(trips, self.json)
+
+    def test_iter_trips_inline_decoding(self):
+        trips = list(iter_trips([settings.DATAPATH, settings.DATAPATH], processes=0))
+        self.assertEqual(trips, self.json + self.json)
+
+    def test_elements_larger_than_chunk(self):
+        with io.open(settings.DATAPATH, 'r', encoding='utf-8') as f:
+            items = list(iter_json_array(f, chunk_size=5))
+        self.assertEqual(len(items), len(self.json))
+
+    def test_small_arrays(self):
+        for text in [u'[]', u' [ ] ', u'[1, {"a": [2]} ,"x"]']:
+            self.assertEqual(list(iter_json_array(io.StringIO(text), chunk_size=2)),
+                             json.loads(text))
+
+    def test_malformed_arrays_raise(self):
+        for text in [u'[1 2]', u'[1,', u'{}', u'[{"a":']:
+            items = iter_json_array(io.StringIO(text), chunk_size=2)
+            self.assertRaises(ValueError, list, items)
+
+if __name__ == '__main__':
+    unittest.main()
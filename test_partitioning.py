@@ -0,0 +1,38 @@
+import unittest
+
+from sqlalchemy.dialects.postgresql import psycopg2
+from sqlalchemy.schema import CreateTable
+
+from models import Trip, SpeedingEvent, CorridorTrip, User
+import settings
+
+class TestPartitionedTables(unittest.TestCase):
+    dialect = psycopg2.dialect()
+
+    def tearDown(self):
+        settings.PARTITION_COUNT = 0
+
+    def ddl(self, model):
+        return str(CreateTable(model.__table__).compile(dialect=self.dialect))
+
+    def test_tables_are_plain_without_partitions(self):
+        self.assertNotIn('PARTITION BY', self.ddl(Trip))
+        self.assertIn('REFERENCES trips', self.ddl(SpeedingEvent))
+
+    def test_partitioned_tables_include_user_id_in_their_keys(self):
+        settings.PARTITION_COUNT = 4
+        ddl = self.ddl(Trip)
+        self.assertTrue(ddl.rstrip().endswith('PARTITION BY HASH (user_id)'))
+        self.assertIn('PRIMARY KEY (trip_id, user_id)', ddl)
+        self.assertIn('UNIQUE (trip_id_string, user_id)', ddl)
+        self.assertIn('REFERENCES users', ddl)
+        self.assertIn('PRIMARY KEY (speeding_event_id, user_id)', self.ddl(SpeedingEvent))
+
+    def test_foreign_keys_to_partitioned_tables_are_left_out(self):
+        settings.PARTITION_COUNT = 4
+        self.assertNotIn('REFERENCES trips', self.ddl(SpeedingEvent))
+        self.assertNotIn('REFERENCES trips', self.ddl(CorridorTrip))
+        self.assertNotIn('PARTITION BY', self.ddl(User))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from sqlalchemy import Float, literal
+from sqlalchemy.dialects.postgresql import psycopg2
+from sqlalchemy.sql import select
+
+from models import User
+from prepared import prepared_form
+
+class TestPreparedForm(unittest.TestCase):
+    dialect = psycopg2.dialect()
+
+    def lookup(self, username):
+        return select([User.user_id]).where(User.username == username)
+
+    def test_parameters_become_numbered_placeholders(self):
+        name, sql, parameters = prepared_form(self.lookup('bob'), self.dialect)
+        self.assertTrue(sql.startswith('PREPARE {} (VARCHAR) AS SELECT'.format(name)))
+        self.assertIn('users.username = $1', sql)
+        self.assertEqual([(p.key, p.value) for p in parameters], [('p1', 'bob')])
+
+    def test_name_depends_on_shape_not_values(self):
+        self.assertEqual(prepared_form(self.lookup('bob'), self.dialect)[0],
+                         prepared_form(self.lookup('alice'), self.dialect)[0])
+        floats = select([literal(1.5, Float)])
+        self.assertNotEqual(prepared_form(self.lookup('bob'), self.dialect)[0],
+                            prepared_form(floats, self.dialect)[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import binascii
+import unittest
+
+import numpy as np
+
+import projection
+
+class TestProjection(unittest.TestCase):
+    # (lat, lon) -> (x, y) in srid 26910, as reported by ST_Transform
+    known_points = [
+        ((37.867675, -122.2981588), (561730.7239, 4191365.5409)),
+        ((37.0, -123.0), (500000.0, 4094872.3703)),
+        ((42.0, -120.0), (748464.9207, 4654130.8912)),
+    ]
+
+    def test_forward_matches_postgis(self):
+        points = [geographic for geographic, projected in self.known_points]
+        expected = [projected for geographic, projected in self.known_points]
+        np.testing.assert_allclose(projection.to_projected(points), expected, atol=1e-3)
+
+    def test_round_trip(self):
+        lat = np.random.uniform(32.5, 42.0, 1000)
+        lon = np.random.uniform(-126.0, -120.0, 1000)
+        points = np.column_stack((lat, lon))
+        result = projection.to_geographic(projection.to_projected(points))
+        np.testing.assert_allclose(result, points, atol=1e-9)
+
+    def test_unsupported_srid(self):
+        self.assertRaises(ValueError, projection.TransverseMercator.from_srid, 4326)
+
+    def test_point_ewkb_round_trip(self):
+        ewkb = projection.point_ewkb(561730.5, 4191365.25)
+        self.assertEqual(projection.wkb_point_coordinates(ewkb), (561730.5, 4191365.25))
+        self.assertEqual(projection.wkb_point_coordinates(binascii.hexlify(ewkb)),
+                         (561730.5, 4191365.25))
+
+    def test_linestring_ewkb_length(self):
+        xy = projection.to_projected([(37.0, -123.0), (37.1, -123.1), (37.2, -123.2)])
+        # byte order, type, srid and point count, then two doubles per point
+        self.assertEqual(len(projection.linestring_ewkb(xy)), 13 + 3 * 16)
+
+    def test_locate_distance_along_a_bent_path(self):
+        xy = np.array([(0.0, 0.0), (100.0, 0.0), (100.0, 50.0)])
+        distances = projection.path_distances(xy)
+        np.testing.assert_allclose(distances, [0.0, 100.0, 150.0])
+        self.assertAlmostEqual(projection.locate_distance(xy, distances, 40.0, 5.0), 40.0)
+        self.assertAlmostEqual(projection.locate_distance(xy, distances, 103.0, 30.0), 130.0)
+        self.assertAlmostEqual(projection.locate_point(xy, distances, 103.0, 30.0), 130.0 / 150)
+        # points off either end snap to it
+        self.assertEqual(projection.locate_distance(xy, distances, -10.0, 0.0), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
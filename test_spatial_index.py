@@ -0,0 +1,44 @@
+import unittest
+
+from spatial_index import SpatialIndex
+
+class TestSpatialIndexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.versions = {}
+        self.index = SpatialIndex(max_size=2, version=lambda user_id: self.versions.get(user_id, 0))
+        self.index.load = self.load
+
+    def load(self, user_id):
+        self.loads.append(user_id)
+        return object()
+
+    def test_least_recently_used_history_is_dropped(self):
+        first = self.index.history(1)
+        self.index.history(2)
+        self.assertIs(self.index.history(1), first)
+        self.index.history(3)
+        self.assertEqual(len(self.index.histories), 2)
+        self.assertNotIn(2, self.index.histories)
+        self.index.history(2)
+        self.assertEqual(self.loads, [1, 2, 3, 2])
+
+    def test_a_newer_version_reloads_the_history(self):
+        first = self.index.history(1)
+        self.assertIs(self.index.history(1), first)
+        self.versions[1] = 1
+        self.assertIsNot(self.index.history(1), first)
+        self.assertEqual(self.loads, [1, 1])
+
+    def test_invalidate_drops_one_user(self):
+        self.index.history(1)
+        self.index.history(2)
+        self.index.invalidate(1)
+        self.assertNotIn(1, self.index.histories)
+        self.assertIn(2, self.index.histories)
+        self.index.invalidate()
+        self.assertEqual(len(self.index.histories), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from fakes import FakeClock
+from trip_sessions import TripSession, TripSessionStore
+from spatial_index import UserHistory
+
+class TestTripSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = TripSessionStore(ttl=60, max_sessions=2, clock=self.clock,
+                                      version=lambda user_id: 0)
+
+    def new_session(self):
+        return TripSession(UserHistory({1: [(0.0, 0.0), (100.0, 0.0)]}, []))
+
+    def test_sessions_expire_after_ttl(self):
+        trip_session = self.new_session()
+        self.store.put((1, 'a'), trip_session)
+        self.clock.now += 59
+        self.assertIs(self.store.get((1, 'a')), trip_session)
+        # the get above pushed the expiry back
+        self.clock.now += 59
+        self.assertIs(self.store.get((1, 'a')), trip_session)
+        self.clock.now += 60
+        self.assertIsNone(self.store.get((1, 'a')))
+
+    def test_least_recently_used_is_evicted(self):
+        self.store.put((1, 'a'), self.new_session())
+        self.store.put((1, 'b'), self.new_session())
+        self.store.get((1, 'a'))
+        self.store.put((1, 'c'), self.new_session())
+        self.assertEqual(len(self.store), 2)
+        self.assertIsNone(self.store.get((1, 'b')))
+        self.assertIsNotNone(self.store.get((1, 'a')))
+
+    def test_invalidate_user(self):
+        self.store.put((1, 'a'), self.new_session())
+        self.store.put((2, 'a'), self.new_session())
+        self.store.invalidate(1)
+        self.assertIsNone(self.store.get((1, 'a')))
+        self.assertIsNotNone(self.store.get((2, 'a')))
+
+    def test_candidates_start_as_every_loaded_trip(self):
+        self.assertEqual(self.new_session().candidates, set([1]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+'''Per-device trip sessions, so successive pings from one drive share their work.
+
+A stateless alert matches the last few points against every trip the user has
+ever taken. Consecutive pings from the same drive almost always match the same
+trips, so a session remembers, per (user_id, device), the trips that matched
+the drive so far along with their paths and events. Later pings are checked
+against just those candidates, in memory, and candidates the vehicle has left
+are dropped. The database is only asked again once the vehicle has left every
+candidate's buffer, or once the session has expired.
+
+Trips that only start to overlap the drive after its session was created are
+not picked up until the next re-query. Sessions expire settings.TRIP_SESSION_TTL
+seconds after their last ping, and are dropped when the user's history changes:
+straight away in the process that changed it, and in others once they see the
+new history version (see spatial_index.py).
+'''
+import threading
+import time
+from collections import OrderedDict
+
+from spatial_index import history_version, load_history
+import projection
+import settings
+
+class TripSession(object):
+    '''The candidate trips and last position of one device.'''
+
+    def __init__(self, history, version=None):
+        '''
+        Args:
+          history (UserHistory): candidate trips, with their paths and events
+          version (int): the user's history version when history was read
+        '''
+        self.history = history
+        self.version = version
+        self.candidates = set(history.paths)
+        self.last_position = None
+        self.last_events = []
+        # set by TripSessionStore
+        self.expires = None
+
+class TripSessionStore(object):
+    '''TTL and size bounded sessions keyed by (user_id, device).'''
+
+    def __init__(self, ttl=None, max_sessions=None, clock=time.time, version=history_version):
+        self.ttl = settings.TRIP_SESSION_TTL if ttl is None else ttl
+        self.max_sessions = settings.TRIP_SESSION_MAX if max_sessions is None else max_sessions
+        self.clock = clock
+        # user_id -> current history version
+        self.version = version
+        # least recently used first
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.requeries = 0
+        self.reuses = 0
+
+    def get(self, key):
+        '''Returns the live session for key, or None.'''
+        now = self.clock()
+        with self.lock:
+            trip_session = self.sessions.pop(key, None)
+            if trip_session is None or trip_session.expires <= now:
+                return None
+            trip_session.expires = now + self.ttl
+            self.sessions[key] = trip_session
+            return trip_session
+
+    def put(self, key, trip_session):
+        now = self.clock()
+        with self.lock:
+            self.sessions.pop(key, None)
+            trip_session.expires = now + self.ttl
+            self.sessions[key] = trip_session
+            self.evict(now)
+
+    def evict(self, now):
+        '''Drops expired sessions, then the least recently used past max_sessions.
+
+        The caller holds self.lock. Sessions are kept in least recently used
+        order, and every access pushes the expiry back by the same ttl, so the
+        expired ones are all at the front.
+        '''
+        while self.sessions:
+            key, trip_session = next(iter(self.sessions.items()))
+            if trip_session.expires > now and len(self.sessions) <= self.max_sessions:
+                break
+            del self.sessions[key]
+
+    def discard(self, key):
+        with self.lock:
+            self.sessions.pop(key, None)
+
+    def invalidate(self, user_id=None):
+        '''Forget one user's sessions, or everybody's if user_id is None.'''
+        with self.lock:
+            if user_id is None:
+                self.sessions.clear()
+            else:
+                for key in [key for key in self.sessions if key[0] == user_id]:
+                    del self.sessions[key]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def adjacent_events_from_point_sequence(self, point_group, user_id, device):
+        '''SpatialQueries.adjacent_events_from_point_sequence, reusing device's session.
+
+        Args:
+          point_group (list): geographic (lat, lon) points, oldest first
+          user_id (int): the device's owner
+          device (hashable): identifies the device among the user's devices
+
+        Returns:
+          list: events of the candidate trips within settings.ALERT_DISTANCE of
+            the last point, in the same order as SpatialQueries
+        '''
+        if len(point_group) < 2:
+            return []
+        key = (user_id, device)
+        line = projection.to_projected(point_group)
+        position = tuple(line[-1])
+        version = self.version(user_id)
+        trip_session = self.get(key)
+        if trip_session is not None and trip_session.version != version:
+            # the user's history changed, maybe in another process
+            self.discard(key)
+            trip_session = None
+        if trip_session is not None:
+            if position == trip_session.last_position:
+                # the vehicle hasn't moved since the last ping
+                self.reuses += 1
+                return trip_session.last_events
+            matching = trip_session.history.find_trips_matching_line(line) \
+                       & trip_session.candidates
+            if matching:
+                self.reuses += 1
+                trip_session.candidates = matching
+            else:
+                trip_session = None
+        if trip_session is None:
+            self.requeries += 1
+            trip_session = TripSession(load_history(user_id, point_group), version)
+            matching = trip_session.candidates
+            self.put(key, trip_session)
+        events = trip_session.history.adjacent_events(line, matching) if matching else []
+        trip_session.last_position = position
+        trip_session.last_events = events
+        return events
+
+trip_sessions = TripSessionStore()